@@ -0,0 +1,153 @@
+"""
+Adaptive admission control: a limit on the requests in flight per route class, shedding the excess.
+
+Requests fall into classes that slow down for different reasons: `auth` (bcrypt), `write` and `read` (Postgres).
+Every class admits at most `limit` requests at once and answers any beyond that right away with a 503 and
+`Retry-After`, instead of letting them queue in the event loop, the connection pool or the bcrypt pool, where
+they would slow down everything else too. A login wave then sheds logins but leaves reads alone, and a slow
+database sheds some reads and writes instead of making every one of them time out.
+
+Limits adapt to the observed latency (AIMD): while the smoothed latency of a class stays under its target the
+limit grows by about one per `limit` completed requests, up to its maximum; once it exceeds the target, or a
+request fails with a 5xx, the limit is cut by `ADMISSION_BACKOFF`, at most once per target period, down to one.
+Probes, metrics and long-lived streams are never limited.
+"""
+import os
+import time
+from typing import Dict, Optional
+from urllib.parse import parse_qsl
+
+import orjson
+
+from hashing import HASH_WORKERS
+
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1") == "1"
+ADMISSION_AUTH_LIMIT = int(os.getenv("ADMISSION_AUTH_LIMIT", 4 * HASH_WORKERS))  # most logins in flight
+ADMISSION_WRITE_LIMIT = int(os.getenv("ADMISSION_WRITE_LIMIT", 64))
+ADMISSION_READ_LIMIT = int(os.getenv("ADMISSION_READ_LIMIT", 128))
+ADMISSION_AUTH_TARGET = float(os.getenv("ADMISSION_AUTH_TARGET", 1))  # seconds of smoothed latency
+ADMISSION_WRITE_TARGET = float(os.getenv("ADMISSION_WRITE_TARGET", 0.25))
+ADMISSION_READ_TARGET = float(os.getenv("ADMISSION_READ_TARGET", 0.1))
+ADMISSION_BACKOFF = float(os.getenv("ADMISSION_BACKOFF", 0.9))  # factor a limit is cut by
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 1))  # seconds
+LATENCY_SMOOTHING = 0.2  # weight of the latest request in the moving average
+
+AUTH_PATHS = ("/login", "/register", "/update_user")
+# Never shed: probes and metrics must answer under load, `/` does nothing, and streams stay open for long
+EXEMPT_PATHS = ("/", "/livez", "/readyz", "/metrics", "/.well-known/jwks.json", "/bookings/events",
+                "/bookings/export", "/bookings/import")
+# Paths that stream when the query flag is set, e.g. `/get_bookings?stream=true`
+STREAM_FLAGS = {"/get_bookings": "stream"}
+TRUE_VALUES = ("1", "true", "on", "yes")  # what FastAPI parses as True
+
+
+class AdaptiveLimit:
+    """The concurrency limit of one route class and what it let through."""
+
+    def __init__(self, maximum: int, target: float, backoff: float = ADMISSION_BACKOFF):
+        self.maximum = maximum
+        self.target = target
+        self.backoff = backoff
+        self.limit = float(maximum)
+        self.inflight = 0
+        self.admitted = 0
+        self.shed = 0
+        self.latency = 0.0
+        self._last_decrease = 0.0
+
+    def acquire(self) -> bool:
+        """Take a slot, False if the class is at its limit and the request has to be shed."""
+        if self.inflight >= int(self.limit):
+            self.shed += 1
+            return False
+        self.inflight += 1
+        self.admitted += 1
+        return True
+
+    def release(self, elapsed: float, failed: bool = False):
+        """Give the slot back and adapt the limit to how long the request took."""
+        busy = self.inflight >= self.limit / 2
+        self.inflight -= 1
+        self.latency = elapsed if not self.latency else self.latency + LATENCY_SMOOTHING * (elapsed - self.latency)
+        if failed or self.latency > self.target:
+            # Requests completing right after a cut still show the latency from before it
+            now = time.monotonic()
+            if now - self._last_decrease >= self.target:
+                self.limit = max(1.0, self.limit * self.backoff)
+                self._last_decrease = now
+        elif busy:
+            # An idle class would otherwise grow its limit without ever testing it
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+    def stats(self) -> dict:
+        return {"limit": int(self.limit), "inflight": self.inflight, "admitted": self.admitted, "shed": self.shed,
+                "latency_seconds": round(self.latency, 4)}
+
+
+class AdmissionControl:
+    """The limits of the route classes of this worker."""
+
+    def __init__(self, enabled: bool, limits: Dict[str, AdaptiveLimit]):
+        self.enabled = enabled
+        self.limits = limits
+
+    def limit_for(self, method: str, path: str, query_string: bytes = b"") -> Optional[AdaptiveLimit]:
+        """The limit a request counts against, None if it is never limited."""
+        if path in EXEMPT_PATHS:
+            return None
+        flag = STREAM_FLAGS.get(path)
+        if flag is not None and any(name == flag and value.lower() in TRUE_VALUES
+                                    for name, value in parse_qsl(query_string.decode("latin-1"))):
+            # Held for as long as the client reads, which says nothing about the load
+            return None
+        if path in AUTH_PATHS:
+            return self.limits.get("auth")
+        return self.limits.get("read" if method in ("GET", "HEAD", "OPTIONS") else "write")
+
+    def stats(self) -> Dict[str, dict]:
+        return {route_class: limit.stats() for route_class, limit in self.limits.items()}
+
+
+admission_control = AdmissionControl(ADMISSION_CONTROL, {
+    "auth": AdaptiveLimit(ADMISSION_AUTH_LIMIT, ADMISSION_AUTH_TARGET),
+    "write": AdaptiveLimit(ADMISSION_WRITE_LIMIT, ADMISSION_WRITE_TARGET),
+    "read": AdaptiveLimit(ADMISSION_READ_LIMIT, ADMISSION_READ_TARGET),
+})
+
+
+class AdmissionMiddleware:
+    """ASGI middleware shedding the requests of a route class beyond its limit, see the module docstring."""
+
+    def __init__(self, app, control: AdmissionControl = admission_control):
+        self.app = app
+        self.control = control
+
+    async def __call__(self, scope, receive, send):
+        limit = None
+        if scope["type"] == "http" and self.control.enabled:
+            limit = self.control.limit_for(scope["method"], scope["path"], scope.get("query_string", b""))
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        if not limit.acquire():
+            body = orjson.dumps({"status_code": 503, "message": "Server is busy, try again later."})
+            await send({"type": "http.response.start", "status": 503, "headers": [
+                (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(ADMISSION_RETRY_AFTER).encode()),
+            ]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            limit.release(time.perf_counter() - started, status >= 500)
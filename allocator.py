@@ -0,0 +1,235 @@
+"""
+Picking a free resource for an interval without a query per resource.
+
+Every worker keeps the future bookings of every resource as per-day occupancy bitmaps, one bit per
+`ALLOCATOR_SLOT` seconds held in a Python int: finding the free resources of an interval is one AND per resource
+and day touched, microseconds for hundreds of stations. Bookings not aligned to the slot grid mark every slot
+they touch, so the bitmaps never call a busy resource free.
+
+The bitmaps are a hint and the `bookings_resource_no_overlap` constraint stays the authority. Another worker may
+have taken a resource this one thinks free, then the insert fails and the days of the interval are reloaded from
+Postgres before the next attempt. Bookings freed by other workers are not seen until a reload either, so
+before answering that nothing is free the days are reloaded and checked once more.
+
+Resources added or deactivated by other workers are picked up by re-reading the resources every
+`ALLOCATOR_RESOURCE_SYNC` seconds. Until then a deactivated one may still look free, so the chosen resource is
+checked to be active and locked `FOR SHARE` in the transaction of the insert, which a concurrent deactivation
+waits for. Days before today are dropped from the bitmaps.
+"""
+import math
+import os
+from datetime import date, datetime, time, timedelta
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import violated_constraint
+from models import Booking, Resource
+
+ALLOCATOR_SLOT = int(os.getenv("ALLOCATOR_SLOT", 60))  # seconds per bit, has to divide a day
+ALLOCATOR_RESOURCE_SYNC = float(os.getenv("ALLOCATOR_RESOURCE_SYNC", 10))  # seconds between reads of the resources
+ALLOCATE_ATTEMPTS = 3
+RESOURCE_CONSTRAINT = "bookings_resource_no_overlap"
+
+DAY = 24 * 60 * 60
+
+
+async def lock_active_resource(session: AsyncSession, resource_id: int) -> bool:
+    """
+    Check that a resource is active and keep it so until the transaction of `session` ends.
+
+    Returns:
+        bool: False if the resource does not exist or was deactivated.
+    """
+    return await session.scalar(
+        select(Resource.id).where(Resource.id == resource_id, Resource.active.is_(True)).with_for_update(read=True)
+    ) is not None
+
+
+class DayOccupancy:
+    """The bookings of one resource on one day as slot ranges, and their union as a bitmap."""
+    __slots__ = ("bitmap", "bookings")
+
+    def __init__(self):
+        self.bitmap = 0
+        self.bookings: Dict[int, int] = {}
+
+    def add(self, booking_id: int, mask: int):
+        self.bookings[booking_id] = mask
+        self.bitmap |= mask
+
+    def remove(self, booking_id: int):
+        # Slots may be shared by two bookings not aligned to the grid, so the union is recomputed
+        self.bookings.pop(booking_id, None)
+        self.bitmap = 0
+        for mask in self.bookings.values():
+            self.bitmap |= mask
+
+
+class ResourceAllocator:
+    def __init__(self, slot: int, resource_sync: float = ALLOCATOR_RESOURCE_SYNC):
+        assert DAY % slot == 0, "the slot has to divide a day"
+        self.slot = slot
+        self.resource_sync = resource_sync
+        self.resources: Dict[int, str] = {}
+        self._resources_synced_at = float("-inf")
+        self._days: Dict[date, Dict[int, DayOccupancy]] = {}
+        self._pruned_on: Optional[date] = None
+        self.allocations = 0
+        self.conflicts = 0
+        self.reloads = 0
+
+    def masks(self, start: datetime, end: datetime) -> List[Tuple[date, int]]:
+        """
+        Split an interval into the slots it touches on every day.
+
+        Returns:
+            List[Tuple[date, int]]: Every day the interval touches and the bitmap of its slots on that day.
+        """
+        masks = []
+        day = start.date()
+        while datetime.combine(day, time()) < end:
+            midnight = datetime.combine(day, time())
+            first = int(max((start - midnight).total_seconds(), 0) // self.slot)
+            last = math.ceil(min((end - midnight).total_seconds(), DAY) / self.slot)
+            masks.append((day, ((1 << (last - first)) - 1) << first))
+            day += timedelta(days=1)
+        return masks
+
+    def add(self, booking_id: int, resource_id: int, start: datetime, end: datetime):
+        for day, mask in self.masks(start, end):
+            self._days.setdefault(day, {}).setdefault(resource_id, DayOccupancy()).add(booking_id, mask)
+
+    def remove(self, booking_id: int, resource_id: int, start: datetime, end: datetime):
+        for day, _ in self.masks(start, end):
+            occupancy = self._days.get(day, {}).get(resource_id)
+            if occupancy is not None:
+                occupancy.remove(booking_id)
+
+    def prune(self):
+        """Drop the days before today, once a day."""
+        today = date.today()
+        if self._pruned_on == today:
+            return
+        for day in [day for day in self._days if day < today]:
+            del self._days[day]
+        self._pruned_on = today
+
+    def candidates(self, start: datetime, end: datetime, kind: Optional[str] = None) -> List[int]:
+        """
+        List the resources free for an interval according to the bitmaps, lowest ID first.
+
+        Parameters:
+            start (datetime): The start of the interval.
+            end (datetime): The end of the interval.
+            kind (Optional[str]): Only resources of this kind.
+
+        Returns:
+            List[int]: The IDs of the free resources.
+        """
+        masks = [(self._days.get(day, {}), mask) for day, mask in self.masks(start, end)]
+        free = []
+        for resource_id, resource_kind in self.resources.items():
+            if kind is not None and resource_kind != kind:
+                continue
+            for occupancy, mask in masks:
+                day = occupancy.get(resource_id)
+                if day is not None and day.bitmap & mask:
+                    break
+            else:
+                free.append(resource_id)
+        return free
+
+    async def _load_resources(self, session: AsyncSession):
+        rows = await session.execute(
+            select(Resource.id, Resource.kind).where(Resource.active.is_(True)).order_by(Resource.id)
+        )
+        self.resources = dict(rows.all())
+        self._resources_synced_at = monotonic()
+
+    async def load(self, session: AsyncSession):
+        """Rebuild the bitmaps from every booking of an active resource that has not ended by today."""
+        await self._load_resources(session)
+        today = datetime.combine(date.today(), time())
+        rows = await session.execute(
+            select(Booking.id, Booking.resource_id, Booking.start_time, Booking.end_time)
+            .where(Booking.resource_id.isnot(None), Booking.end_time > today)
+        )
+        self._days = {}
+        for booking_id, resource_id, start, end in rows:
+            self.add(booking_id, resource_id, start, end)
+
+    async def reload(self, session: AsyncSession, start: datetime, end: datetime):
+        """Re-read the resources and the bookings of every day the interval touches."""
+        self.reloads += 1
+        await self._load_resources(session)
+        days = [day for day, _ in self.masks(start, end)]
+        first, last = datetime.combine(days[0], time()), datetime.combine(days[-1] + timedelta(days=1), time())
+        rows = await session.execute(
+            select(Booking.id, Booking.resource_id, Booking.start_time, Booking.end_time)
+            .where(Booking.resource_id.isnot(None), Booking.start_time < last, Booking.end_time > first)
+        )
+        for day in days:
+            self._days.pop(day, None)
+        for booking_id, resource_id, booking_start, booking_end in rows:
+            # Only the reloaded days, the neighbouring ones already hold the rest of the booking
+            self.add(booking_id, resource_id, max(booking_start, first), min(booking_end, last))
+
+    async def allocate(self, session: AsyncSession, booking: Booking, kind: Optional[str] = None) -> bool:
+        """
+        Give a booking the first free resource and insert it in the transaction of `session`.
+
+        The resource is marked busy right away. Every attempt runs in a savepoint, so a resource taken by another
+        worker only costs a reload of the days of the booking and another attempt.
+
+        Parameters:
+            session (AsyncSession): The session to insert with.
+            booking (Booking): The new booking, without a resource.
+            kind (Optional[str]): Only resources of this kind.
+
+        Returns:
+            bool: False if no resource is free for the booking.
+
+        Raises:
+            IntegrityError: If the booking violates another constraint, e.g. overlaps another booking of its user.
+        """
+        self.prune()
+        if monotonic() - self._resources_synced_at >= self.resource_sync:
+            await self._load_resources(session)
+        reloaded = False
+        for _ in range(ALLOCATE_ATTEMPTS):
+            candidates = self.candidates(booking.start_time, booking.end_time, kind)
+            if candidates:
+                booking.resource_id = candidates[0]
+                # Outside the savepoint, whose rollback would release the lock
+                if not await lock_active_resource(session, booking.resource_id):
+                    # Deactivated by another worker since the resources were read
+                    await self._load_resources(session)
+                    continue
+                try:
+                    async with session.begin_nested():
+                        session.add(booking)
+                        await session.flush()
+                except IntegrityError as exc:
+                    if violated_constraint(exc) != RESOURCE_CONSTRAINT:
+                        raise
+                    self.conflicts += 1
+                else:
+                    self.allocations += 1
+                    self.add(booking.id, booking.resource_id, booking.start_time, booking.end_time)
+                    return True
+            elif reloaded:
+                return False
+            await self.reload(session, booking.start_time, booking.end_time)
+            reloaded = True
+        return False
+
+    def stats(self) -> dict:
+        return {"resources": len(self.resources), "days": len(self._days), "allocations": self.allocations,
+                "conflicts": self.conflicts, "reloads": self.reloads}
+
+
+resource_allocator = ResourceAllocator(ALLOCATOR_SLOT)
@@ -0,0 +1,135 @@
+"""
+Tiering of the bookings archive.
+
+`bookings` keeps the hot set only: the `archive_bookings` job moves bookings that ended long ago to
+`bookings_archive`, which is range partitioned by month of `start_time` with a partition per month created as
+rows arrive. Reads of the archive that bound the start time only touch the partitions of those months.
+
+Months that are no longer read are detached, which takes a moment however many rows they hold, unlike a
+`DELETE`. A detached partition is left as a standalone table, or exported to a gzipped CSV and dropped:
+
+    python archive.py list
+    python archive.py detach --before 01-2023 --export archive
+"""
+import argparse
+import asyncio
+import gzip
+import os
+from datetime import date, datetime
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+ARCHIVE_TABLE = "bookings_archive"
+
+PARTITIONS_QUERY = text("""
+SELECT c.relname AS name, c.reltuples::bigint AS estimated_rows
+FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = CAST(:parent AS regclass)
+ORDER BY c.relname
+""")
+
+
+def partition_month(name: str) -> date:
+    """The first day of the month of a partition named <parent>_pYYYYMM."""
+    return datetime.strptime(name.rsplit("_p", 1)[1], "%Y%m").date()
+
+
+async def list_partitions(conn: AsyncConnection, parent: str = ARCHIVE_TABLE) -> List[dict]:
+    """
+    List the partitions attached to `parent`, oldest month first.
+
+    Returns:
+        List[dict]: The name, month and estimated row count of every partition.
+    """
+    rows = await conn.execute(PARTITIONS_QUERY, {"parent": parent})
+    return [{"name": name, "month": partition_month(name), "estimated_rows": max(estimated_rows, 0)}
+            for name, estimated_rows in rows]
+
+
+async def export_table(conn: AsyncConnection, table: str, path: str) -> int:
+    """
+    Write a table to a gzipped CSV file with a header, streamed with `COPY`.
+
+    The file is written under a temporary name and renamed once complete, so an existing file is always whole.
+
+    Parameters:
+        conn (AsyncConnection): The connection to copy with.
+        table (str): The table to export.
+        path (str): The file to write.
+
+    Returns:
+        int: The number of rows written.
+    """
+    raw = await conn.get_raw_connection()
+    partial = path + ".partial"
+    with gzip.open(partial, "wb") as file:
+        async def write(chunk: bytes):
+            file.write(chunk)
+
+        status = await raw.driver_connection.copy_from_table(table, output=write, format="csv", header=True)
+    os.replace(partial, path)
+    return int(status.split()[-1])
+
+
+async def detach_partitions(engine: AsyncEngine, before: date, export_dir: Optional[str] = None,
+                            parent: str = ARCHIVE_TABLE) -> List[dict]:
+    """
+    Detach the partitions of months before `before`, optionally exporting and dropping them.
+
+    Every partition is detached in its own transaction, an interrupted run leaves the remaining months attached.
+    A partition is only dropped once its export is complete.
+
+    Parameters:
+        engine (AsyncEngine): The engine of the database.
+        before (date): Detach months starting before this day.
+        export_dir (Optional[str]): Export every detached partition to <export_dir>/<name>.csv.gz and drop it.
+            Without it the partitions are kept as standalone tables.
+        parent (str): The partitioned table.
+
+    Returns:
+        List[dict]: The detached partitions, with the file and number of exported rows when exported.
+    """
+    async with engine.connect() as conn:
+        partitions = [partition for partition in await list_partitions(conn, parent) if partition["month"] < before]
+    if export_dir:
+        os.makedirs(export_dir, exist_ok=True)
+    for partition in partitions:
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql(f'ALTER TABLE "{parent}" DETACH PARTITION "{partition["name"]}"')
+        if export_dir:
+            path = os.path.join(export_dir, f"{partition['name']}.csv.gz")
+            async with engine.begin() as conn:
+                partition["exported_rows"] = await export_table(conn, partition["name"], path)
+                await conn.exec_driver_sql(f'DROP TABLE "{partition["name"]}"')
+            partition["file"] = path
+    return partitions
+
+
+async def main():
+    from database import dispose_engine, get_engine
+
+    parser = argparse.ArgumentParser(description="Manage the monthly partitions of the bookings archive.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="list the attached partitions")
+    detach = commands.add_parser("detach", help="detach the partitions of old months")
+    detach.add_argument("--before", required=True, help='the first month to keep, "%%m-%%Y"')
+    detach.add_argument("--export", metavar="DIR", help="export the detached partitions to DIR and drop them")
+    args = parser.parse_args()
+
+    engine = get_engine()
+    if args.command == "list":
+        async with engine.connect() as conn:
+            for partition in await list_partitions(conn):
+                print(f"{partition['name']}\t~{partition['estimated_rows']} rows")
+    else:
+        before = datetime.strptime(args.before, "%m-%Y").date()
+        for partition in await detach_partitions(engine, before, args.export):
+            exported = f" -> {partition['file']} ({partition['exported_rows']} rows)" if args.export else ""
+            print(f"detached {partition['name']}{exported}")
+    await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
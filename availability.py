@@ -0,0 +1,67 @@
+"""
+Free and busy time of a user, computed in the database.
+
+The window is cut into slots with `generate_series`, every slot probes the GiST index behind the
+`bookings_no_overlap` constraint for an overlapping booking, and runs of consecutive free or busy slots are
+merged into intervals (gaps and islands), so one query returns the finished answer. A slot is busy if any
+booking overlaps it, even partially, so intervals are aligned to the slot grid.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import format_datetime
+
+# The int4range equality matches the indexed expression of the exclusion constraint, a plain user_id equality
+# would not use its index
+AVAILABILITY_QUERY = text("""
+WITH flagged AS (
+    SELECT slot_start, slot_end, EXISTS (
+        SELECT 1 FROM bookings b
+        WHERE int4range(b.user_id, b.user_id, '[]') = int4range(:user_id, :user_id, '[]')
+          AND b.during && tsrange(slot_start, slot_end, '[)')
+    ) AS busy
+    FROM (
+        SELECT s AS slot_start, least(s + :step, CAST(:window_end AS timestamp)) AS slot_end
+        FROM generate_series(CAST(:window_start AS timestamp), CAST(:window_end AS timestamp), :step) s
+        WHERE s < CAST(:window_end AS timestamp)
+    ) slots
+)
+SELECT busy, min(slot_start) AS start_time, max(slot_end) AS end_time
+FROM (
+    SELECT slot_start, slot_end, busy,
+           row_number() OVER (ORDER BY slot_start) - row_number() OVER (PARTITION BY busy ORDER BY slot_start) AS run
+    FROM flagged
+) runs
+GROUP BY busy, run
+ORDER BY start_time
+""")
+
+
+async def find_availability(session: AsyncSession, user_id: int, start: datetime, end: datetime,
+                            step: timedelta) -> Dict[str, List[dict]]:
+    """
+    Split a window into the free and busy intervals of a user.
+
+    Parameters:
+        session (AsyncSession): The session to query with.
+        user_id (int): The user.
+        start (datetime): The start of the window.
+        end (datetime): The end of the window, the last slot is cut short at it.
+        step (timedelta): The slot length.
+
+    Returns:
+        Dict[str, List[dict]]: The "free" and "busy" intervals in chronological order, each with a start_time
+            and an end_time.
+    """
+    rows = await session.execute(AVAILABILITY_QUERY, {
+        "user_id": user_id, "window_start": start, "window_end": end, "step": step,
+    })
+    intervals = {"free": [], "busy": []}
+    for busy, start_time, end_time in rows:
+        intervals["busy" if busy else "free"].append(
+            {"start_time": format_datetime(start_time), "end_time": format_datetime(end_time)}
+        )
+    return intervals
@@ -0,0 +1,71 @@
+"""
+Time of picking a free resource with the in-memory slot bitmaps of `allocator.py`.
+
+Fills a `ResourceAllocator` with `--resources` resources and random bookings of 30 minutes to 4 hours over
+`--days` days, then times `candidates()` for random intervals of 1 to 3 hours. No database is needed.
+
+    python benchmarks/allocator.py --resources 300 --days 30
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from allocator import ALLOCATOR_SLOT, ResourceAllocator  # noqa: E402
+from latency import percentile  # noqa: E402
+
+FIRST_DAY = datetime(2023, 9, 1)
+
+
+def fill(allocator: ResourceAllocator, resources: int, days: int, per_day: int) -> int:
+    allocator.resources = {resource_id: "pc" for resource_id in range(1, resources + 1)}
+    booking_id = 0
+    for resource_id in allocator.resources:
+        for day in range(days):
+            # Back to back bookings through the day, with gaps, so some resources stay free for any interval
+            start = FIRST_DAY + timedelta(days=day, hours=random.randint(8, 12))
+            for _ in range(random.randint(0, per_day)):
+                end = start + timedelta(minutes=30 * random.randint(1, 8))
+                booking_id += 1
+                allocator.add(booking_id, resource_id, start, end)
+                start = end + timedelta(minutes=30 * random.randint(0, 4))
+    return booking_id
+
+
+def run(resources: int, days: int, per_day: int, samples: int) -> dict:
+    allocator = ResourceAllocator(ALLOCATOR_SLOT)
+    started = time.perf_counter()
+    bookings = fill(allocator, resources, days, per_day)
+    results = {"resources": resources, "days": days, "bookings": bookings, "samples": samples,
+               "fill_s": round(time.perf_counter() - started, 2)}
+    timings, free = [], []
+    for _ in range(samples):
+        start = FIRST_DAY + timedelta(days=random.randrange(days), hours=random.randint(8, 21))
+        end = start + timedelta(hours=random.randint(1, 3))
+        started = time.perf_counter()
+        candidates = allocator.candidates(start, end)
+        timings.append((time.perf_counter() - started) * 1_000_000)
+        free.append(len(candidates))
+    results["candidates_p50_us"] = round(percentile(timings, 50), 1)
+    results["candidates_p99_us"] = round(percentile(timings, 99), 1)
+    results["free_p50"] = percentile(free, 50)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resources", type=int, default=300)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--per-day", type=int, default=6, help="most bookings of one resource on one day")
+    parser.add_argument("--samples", type=int, default=10000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.resources, args.days, args.per_day, args.samples), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+The monthly partitioned bookings archive against a single table, at archive scale.
+
+Seeds two copies of `bookings_archive` with `--rows` bookings of `--users` users spread over `--months` months:
+`bench_archive_plain`, one table, and `bench_archive_partitioned`, partitioned by month like the archive. Both
+get the primary key and the (user_id, start_time) index of the archive. Times the reads the archive serves (a
+month of one user, a whole month), counts the partitions a read of one month touches, and compares dropping the
+oldest month with `DETACH PARTITION` to a `DELETE`. The copies are dropped afterwards, the application tables
+are not touched.
+
+    python benchmarks/archive_partitions.py --rows 10000000 --months 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import get_engine  # noqa: E402
+from latency import percentile  # noqa: E402
+
+FIRST_MONTH = datetime(2020, 1, 1)
+TABLES = ("bench_archive_plain", "bench_archive_partitioned")
+
+SEED = [
+    "DROP TABLE IF EXISTS bench_archive_plain, bench_archive_partitioned, bench_archive_partitioned_p202001",
+    "CREATE TABLE bench_archive_plain (LIKE bookings_archive INCLUDING DEFAULTS)",
+    "CREATE TABLE bench_archive_partitioned (LIKE bookings_archive INCLUDING DEFAULTS) PARTITION BY RANGE (start_time)",
+    """
+    SELECT create_monthly_partitions('bench_archive_partitioned', timestamp '2020-01-01',
+                                     timestamp '2020-01-01' + make_interval(months => :months) - interval '1 second')
+    """,
+    # Evenly spread over the months, 15 minutes to 3 hours long
+    """
+    INSERT INTO bench_archive_plain (id, user_id, start_time, end_time, comment)
+    SELECT g, 1 + g % :users, start_time, start_time + interval '15 minutes' * (1 + g % 12), NULL
+    FROM generate_series(0, :rows - 1) g,
+         LATERAL (SELECT timestamp '2020-01-01' + (timestamp '2020-01-01' + make_interval(months => :months)
+                                                   - timestamp '2020-01-01') / :rows * g AS start_time) s
+    """,
+    "INSERT INTO bench_archive_partitioned SELECT * FROM bench_archive_plain",
+    "ALTER TABLE bench_archive_plain ADD PRIMARY KEY (id, start_time)",
+    "ALTER TABLE bench_archive_partitioned ADD PRIMARY KEY (id, start_time)",
+    "CREATE INDEX ON bench_archive_plain (user_id, start_time)",
+    "CREATE INDEX ON bench_archive_partitioned (user_id, start_time)",
+    "ANALYZE bench_archive_plain",
+    "ANALYZE bench_archive_partitioned",
+]
+
+QUERIES = {
+    "user_month": """
+        SELECT id, user_id, start_time, end_time, comment FROM {table}
+        WHERE user_id = :user_id
+          AND start_time >= :month AND start_time < CAST(:month AS timestamp) + interval '1 month'
+        ORDER BY start_time, id LIMIT 100
+    """,
+    "month_count": """
+        SELECT count(*) FROM {table}
+        WHERE start_time >= :month AND start_time < CAST(:month AS timestamp) + interval '1 month'
+    """,
+}
+
+
+def month(index: int) -> datetime:
+    return FIRST_MONTH.replace(year=FIRST_MONTH.year + index // 12, month=1 + index % 12)
+
+
+async def time_query(conn, statement: str, users: int, months: int, samples: int) -> dict:
+    timings = []
+    for _ in range(samples):
+        params = {"user_id": random.randint(1, users), "month": month(random.randrange(months))}
+        started = time.perf_counter()
+        await conn.execute(text(statement), params)
+        timings.append((time.perf_counter() - started) * 1000)
+    return {"p50_ms": round(percentile(timings, 50), 3), "p99_ms": round(percentile(timings, 99), 3)}
+
+
+async def run(rows: int, users: int, months: int, samples: int) -> dict:
+    engine = get_engine()
+    params = {"rows": rows, "users": users, "months": months}
+    started = time.perf_counter()
+    async with engine.begin() as conn:
+        for statement in SEED:
+            await conn.execute(text(statement), params)
+    results = {"rows": rows, "users": users, "months": months, "samples": samples,
+               "seed_s": round(time.perf_counter() - started, 1)}
+    try:
+        async with engine.connect() as conn:
+            plan = await conn.execute(text("EXPLAIN " + QUERIES["month_count"].format(table=TABLES[1])),
+                                      {"month": month(months // 2)})
+            results["partitions_scanned_per_month"] = sum("bench_archive_partitioned_p" in line
+                                                          for line, in plan)
+            for name, statement in QUERIES.items():
+                for table in TABLES:
+                    results[f"{name}_{table}"] = await time_query(conn, statement.format(table=table), users,
+                                                                  months, samples)
+        first = {"month": FIRST_MONTH}
+        async with engine.begin() as conn:
+            started = time.perf_counter()
+            await conn.execute(text(
+                "DELETE FROM bench_archive_plain WHERE start_time < CAST(:month AS timestamp) + interval '1 month'"
+            ), first)
+            results["drop_month_delete_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        async with engine.begin() as conn:
+            started = time.perf_counter()
+            await conn.execute(text(
+                "ALTER TABLE bench_archive_partitioned DETACH PARTITION bench_archive_partitioned_p202001"
+            ))
+            results["drop_month_detach_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text(SEED[0]))
+        await engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--months", type=int, default=60)
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.rows, args.users, args.months, args.samples)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
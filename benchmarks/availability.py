@@ -0,0 +1,87 @@
+"""
+Latency of the availability query for a week-view grid.
+
+Seeds a user `bench-availability` with `--bookings` bookings of random length spread over a year, then times
+`find_availability` for random weeks at `--slot` minute slots. The user and their bookings are removed
+afterwards.
+
+    python benchmarks/availability.py --bookings 5000 --slot 15
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from availability import find_availability  # noqa: E402
+from database import async_session, get_engine  # noqa: E402
+from latency import percentile  # noqa: E402
+
+YEAR_START = datetime(2032, 1, 1)
+
+SEED = [
+    "DELETE FROM users WHERE username = 'bench-availability'",
+    """
+    INSERT INTO users (username, password, created_at, updated_at)
+    VALUES ('bench-availability', 'x', current_date, current_date)
+    """,
+    # One booking per slot of a year cut into `bookings` slots, 15 minutes to 3 hours long, never overlapping
+    """
+    INSERT INTO bookings (user_id, start_time, end_time, comment)
+    SELECT u.id, timestamp '2032-01-01' + g * interval '365 days' / :bookings,
+           timestamp '2032-01-01' + g * interval '365 days' / :bookings
+               + least(interval '15 minutes' * (1 + floor(random() * 12)), interval '365 days' / :bookings),
+           NULL
+    FROM users u CROSS JOIN generate_series(0, :bookings - 1) g
+    WHERE u.username = 'bench-availability'
+    """,
+    "ANALYZE bookings",
+]
+
+
+async def run(bookings: int, slot: int, samples: int) -> dict:
+    engine = get_engine()
+    async with engine.begin() as conn:
+        for statement in SEED:
+            await conn.execute(text(statement), {"bookings": bookings})
+        user_id = await conn.scalar(text("SELECT id FROM users WHERE username = 'bench-availability'"))
+    timings = []
+    intervals = 0
+    try:
+        async with async_session() as session:
+            for _ in range(samples):
+                start = YEAR_START + timedelta(days=random.randrange(358))
+                started = time.perf_counter()
+                result = await find_availability(session, user_id, start, start + timedelta(weeks=1),
+                                                 timedelta(minutes=slot))
+                timings.append((time.perf_counter() - started) * 1000)
+                intervals += len(result["free"]) + len(result["busy"])
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text("DELETE FROM users WHERE username = 'bench-availability'"))
+        await engine.dispose()
+    return {
+        "bookings": bookings, "slot_minutes": slot, "slots_per_week": 7 * 24 * 60 // slot, "samples": samples,
+        "avg_intervals": round(intervals / samples, 1),
+        "p50_ms": round(percentile(timings, 50), 3), "p99_ms": round(percentile(timings, 99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bookings", type=int, default=5000)
+    parser.add_argument("--slot", type=int, default=15, help="slot length in minutes")
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.bookings, args.slot, args.samples)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Concurrent latency benchmark for a running instance of the API.
+
+Registers a throwaway user, seeds a few bookings and then lets ``--clients`` concurrent clients poll
+``/get_bookings`` and ``/get_current_user`` for ``--duration`` seconds. Latency percentiles are printed as JSON.
+
+To compare the blocking and the asynchronous database paths, start the server from each revision and run
+the script against it with the same arguments, e.g.:
+
+    uvicorn main:app --port 8000
+    python benchmarks/latency.py --url http://localhost:8000 --clients 50 --duration 20
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def prepare(client: httpx.AsyncClient, bookings: int) -> str:
+    name = f"bench-{uuid.uuid4().hex[:12]}"
+    response = await client.post("/register", params={"name": name, "password": name})
+    response.raise_for_status()
+    response = await client.post("/login", data={"username": name, "password": name})
+    response.raise_for_status()
+    token = response.json()["access_token"]
+    for hour in range(bookings):
+        start = f"01-01-2030 {hour % 24:02d}:00:00"
+        end = f"01-01-2030 {hour % 24:02d}:30:00"
+        await client.post("/create_booking", params={"start_time": start, "end_time": end},
+                          headers={"Authorization": f"Bearer {token}"})
+    return token
+
+
+async def worker(client: httpx.AsyncClient, token: str, deadline: float, samples: dict):
+    headers = {"Authorization": f"Bearer {token}"}
+    endpoints = ["/get_bookings", "/get_current_user"]
+    i = 0
+    while time.perf_counter() < deadline:
+        endpoint = endpoints[i % len(endpoints)]
+        i += 1
+        started = time.perf_counter()
+        response = await client.get(endpoint, headers=headers)
+        elapsed = (time.perf_counter() - started) * 1000
+        samples.setdefault(endpoint, []).append(elapsed)
+        if response.status_code != 200:
+            samples.setdefault("errors", []).append(response.status_code)
+
+
+async def run(url: str, clients: int, duration: float, bookings: int) -> dict:
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        token = await prepare(client, bookings)
+        samples = {}
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(worker(client, token, deadline, samples) for _ in range(clients)))
+        await client.delete("/delete_user", headers={"Authorization": f"Bearer {token}"})
+
+    errors = samples.pop("errors", [])
+    report = {"clients": clients, "duration_s": duration, "errors": len(errors), "endpoints": {}}
+    for endpoint, values in samples.items():
+        report["endpoints"][endpoint] = {
+            "requests": len(values),
+            "rps": round(len(values) / duration, 1),
+            "p50_ms": round(percentile(values, 50), 2),
+            "p99_ms": round(percentile(values, 99), 2),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--bookings", type=int, default=20)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.url, args.clients, args.duration, args.bookings)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Lookup latency before and after the indexes added by migration 2.
+
+Seeds unindexed copies of `users` and `bookings` (`bench_users`, `bench_bookings`) with `--users` users and
+`--bookings` bookings, times the queries every endpoint runs (user by name, bookings of a user), adds the
+same indexes and foreign key as migration 2 and times them again. The copies are dropped afterwards, the
+application tables are not touched.
+
+    python benchmarks/lookup_indexes.py --users 100000 --bookings 1000000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import get_engine  # noqa: E402
+from latency import percentile  # noqa: E402
+
+SEED = [
+    "DROP TABLE IF EXISTS bench_bookings, bench_users",
+    "CREATE TABLE bench_users (LIKE users INCLUDING DEFAULTS)",
+    "CREATE TABLE bench_bookings (LIKE bookings INCLUDING DEFAULTS)",
+    """
+    INSERT INTO bench_users (id, username, password, created_at, updated_at)
+    SELECT g, 'user' || g, 'x', current_date, current_date FROM generate_series(1, :users) g
+    """,
+    """
+    INSERT INTO bench_bookings (id, user_id, start_time, end_time, comment)
+    SELECT g, 1 + g % :users, timestamp '2023-01-01' + g * interval '1 minute',
+           timestamp '2023-01-01' + g * interval '1 minute' + interval '30 minutes', NULL
+    FROM generate_series(1, :bookings) g
+    """,
+    "ANALYZE bench_users",
+    "ANALYZE bench_bookings",
+]
+
+INDEXES = [
+    "ALTER TABLE bench_users ADD PRIMARY KEY (id)",
+    "CREATE UNIQUE INDEX ON bench_users (username)",
+    """
+    ALTER TABLE bench_bookings ADD FOREIGN KEY (user_id) REFERENCES bench_users (id) ON DELETE CASCADE
+    """,
+    "CREATE INDEX ON bench_bookings (user_id, start_time, end_time)",
+    "ANALYZE bench_users",
+    "ANALYZE bench_bookings",
+]
+
+QUERIES = {
+    "user_by_username": ("SELECT * FROM bench_users WHERE username = :username", "username"),
+    "bookings_by_user": ("SELECT * FROM bench_bookings WHERE user_id = :user_id", "user_id"),
+    "booking_duplicate_check": (
+        "SELECT * FROM bench_bookings WHERE user_id = :user_id "
+        "AND start_time = timestamp '2023-01-01 00:01' AND end_time = timestamp '2023-01-01 00:31' LIMIT 1",
+        "user_id",
+    ),
+}
+
+
+async def measure(conn, users: int, samples: int) -> dict:
+    result = {}
+    for name, (query, param) in QUERIES.items():
+        timings = []
+        for _ in range(samples):
+            user = random.randint(1, users)
+            value = f"user{user}" if param == "username" else user
+            started = time.perf_counter()
+            await conn.execute(text(query), {param: value})
+            timings.append((time.perf_counter() - started) * 1000)
+        result[name] = {"p50_ms": round(percentile(timings, 50), 3), "p99_ms": round(percentile(timings, 99), 3)}
+    return result
+
+
+async def run(users: int, bookings: int, samples: int) -> dict:
+    engine = get_engine()
+    async with engine.begin() as conn:
+        for statement in SEED:
+            await conn.execute(text(statement), {"users": users, "bookings": bookings})
+    try:
+        async with engine.connect() as conn:
+            before = await measure(conn, users, samples)
+        async with engine.begin() as conn:
+            for statement in INDEXES:
+                await conn.execute(text(statement))
+        async with engine.connect() as conn:
+            after = await measure(conn, users, samples)
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text("DROP TABLE IF EXISTS bench_bookings, bench_users"))
+        await engine.dispose()
+    return {"users": users, "bookings": bookings, "samples": samples, "before": before, "after": after}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--bookings", type=int, default=1000000)
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.users, args.bookings, args.samples)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Time of the `/stats` queries of `rollups.py` against scanning the bookings themselves.
+
+Creates `--users` users named bench_rollups_<n> with `--bookings` archived bookings of 1 to 3 hours spread over
+two years from 2050, backfills the rollups from them, then times the dashboard queries: a week by hour, a month by
+day, the two years by week and the top 100 users, and the same month by day computed from the bookings instead.
+Also times a single booking insert with the rollup triggers and without them. The bookings are put in the archive,
+which has no exclusion constraints to slow the seeding down; the rollups count them all the same.
+
+Run it against a development database: the backfill recomputes the rollups of the whole database. The users,
+their bookings and their rollups are deleted afterwards.
+
+    python benchmarks/rollups.py --bookings 10000000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import async_session, dispose_engine, get_engine  # noqa: E402
+from latency import percentile  # noqa: E402
+from rollups import occupancy, rebuild_rollups, user_totals  # noqa: E402
+
+FIRST_DAY = datetime(2050, 1, 1)
+LAST_DAY = datetime(2052, 1, 1)
+SEED_BATCH = 1_000_000
+
+SEED_QUERY = text("""
+INSERT INTO bookings_archive (id, user_id, start_time, end_time, comment, resource_id)
+SELECT -n, (CAST(:user_ids AS integer[]))[1 + n % cardinality(CAST(:user_ids AS integer[]))], s,
+       s + (1 + n % 3) * interval '1 hour', 'bench', NULL
+FROM generate_series(CAST(:first AS bigint), CAST(:last AS bigint)) n,
+     LATERAL (SELECT CAST(:start AS timestamp) + (n * 7919 % (730 * 24)) * interval '1 hour' AS s) slot
+""")
+# What `/stats/occupancy` would have to do without rollups
+SCAN_QUERY = text("""
+SELECT date_trunc('day', h.hour), count(*) FILTER (WHERE h.hour = date_trunc('hour', b.start_time)), sum(h.seconds)
+FROM bookings_archive b, LATERAL booking_hours(b.start_time, b.end_time) h
+WHERE b.start_time >= CAST(:start AS timestamp) - interval '1 day' AND b.start_time < :end
+  AND h.hour >= :start AND h.hour < :end
+GROUP BY 1 ORDER BY 1
+""")
+INSERT_QUERY = text("""
+INSERT INTO bookings (user_id, start_time, end_time) VALUES (:user_id, :start, CAST(:start AS timestamp) + interval '1 hour')
+RETURNING id
+""")
+
+
+async def timed(samples: int, query) -> dict:
+    timings = []
+    for _ in range(samples):
+        async with async_session() as session:
+            started = time.perf_counter()
+            await query(session)
+            timings.append((time.perf_counter() - started) * 1000)
+    return {"p50_ms": round(percentile(timings, 50), 2), "p99_ms": round(percentile(timings, 99), 2)}
+
+
+async def time_inserts(user_id: int, samples: int) -> dict:
+    """Insert and delete a booking `samples` times, one transaction each like `create_booking`."""
+    async def insert(session):
+        start = datetime(2053, 1, 1)
+        booking_id = await session.scalar(INSERT_QUERY, {"user_id": user_id, "start": start})
+        await session.commit()
+        await session.execute(text("DELETE FROM bookings WHERE id = :id"), {"id": booking_id})
+        await session.commit()
+
+    return await timed(samples, insert)
+
+
+async def run(bookings: int, users: int, samples: int) -> dict:
+    engine = get_engine()
+    async with engine.begin() as conn:
+        user_ids = (await conn.execute(text("""
+            INSERT INTO users (username, password, created_at, updated_at)
+            SELECT 'bench_rollups_' || n, '', current_date, current_date FROM generate_series(1, :users) n
+            RETURNING id
+        """), {"users": users})).scalars().all()
+        await conn.execute(text("SELECT create_monthly_partitions('bookings_archive', :start, :end)"),
+                           {"start": FIRST_DAY, "end": LAST_DAY - timedelta(days=1)})
+    results = {"bookings": bookings, "users": users}
+    try:
+        started = time.perf_counter()
+        for first in range(1, bookings + 1, SEED_BATCH):
+            async with engine.begin() as conn:
+                await conn.execute(SEED_QUERY, {"user_ids": user_ids, "first": first, "start": FIRST_DAY,
+                                                "last": min(first + SEED_BATCH - 1, bookings)})
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql("ANALYZE bookings_archive")
+        results["seed_s"] = round(time.perf_counter() - started, 1)
+
+        started = time.perf_counter()
+        results["backfilled_bookings"] = await rebuild_rollups(engine)
+        results["backfill_s"] = round(time.perf_counter() - started, 1)
+
+        month = (datetime(2051, 3, 1), datetime(2051, 4, 1))
+        results["week_by_hour"] = await timed(samples, lambda session: occupancy(
+            session, datetime(2051, 3, 6), datetime(2051, 3, 13), "hour"))
+        results["month_by_day"] = await timed(samples, lambda session: occupancy(session, *month, "day"))
+        results["two_years_by_week"] = await timed(samples, lambda session: occupancy(
+            session, FIRST_DAY, LAST_DAY, "week"))
+        results["top_100_users"] = await timed(samples, lambda session: user_totals(session, 100))
+        results["one_user"] = await timed(samples, lambda session: user_totals(session, 1, user_ids[0]))
+        results["month_by_day_scanning_bookings"] = await timed(
+            max(samples // 20, 3), lambda session: session.execute(SCAN_QUERY, dict(zip(("start", "end"), month))))
+
+        results["insert_with_triggers"] = await time_inserts(user_ids[0], samples)
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql("ALTER TABLE bookings DISABLE TRIGGER USER")
+        try:
+            results["insert_without_triggers"] = await time_inserts(user_ids[0], samples)
+        finally:
+            async with engine.begin() as conn:
+                await conn.exec_driver_sql("ALTER TABLE bookings ENABLE TRIGGER USER")
+    finally:
+        # Only the bench users have bookings in these years, their rollups go with them
+        async with engine.begin() as conn:
+            for partition in (await conn.execute(text("""
+                SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'bookings_archive'::regclass AND c.relname >= 'bookings_archive_p205001'
+                  AND c.relname < 'bookings_archive_p205201'
+            """))).scalars():
+                await conn.exec_driver_sql(f'DROP TABLE "{partition}"')
+            await conn.execute(text("DELETE FROM booking_stats_hourly WHERE hour >= :start AND hour < :end"),
+                               {"start": FIRST_DAY, "end": LAST_DAY})
+            await conn.execute(text("DELETE FROM booking_stats_users WHERE user_id = ANY(:ids)"), {"ids": user_ids})
+            await conn.execute(text("DELETE FROM users WHERE id = ANY(:ids)"), {"ids": user_ids})
+        await dispose_engine()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bookings", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.bookings, args.users, args.samples)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
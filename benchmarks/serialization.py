@@ -0,0 +1,84 @@
+"""
+Serialization throughput of a /get_bookings payload.
+
+Compares the original path (ORM objects, `strftime` twice per row, stdlib `json` through `JSONResponse`) with the
+current one (plain rows, column-wise datetime formatting in `serialize_bookings`, `orjson`) on synthetic
+bookings. No database is needed.
+
+    python benchmarks/serialization.py --rows 10000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import orjson
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Booking, serialize_bookings  # noqa: E402
+
+
+def legacy_to_json(booking):
+    return {
+        "id": booking.id,
+        "user_id": booking.user_id,
+        "start_time": str(booking.start_time.strftime("%d-%m-%Y %H:%M:%S")),
+        "end_time": str(booking.end_time.strftime("%d-%m-%Y %H:%M:%S")),
+        "comment": booking.comment
+    }
+
+
+def make_rows(count: int):
+    first = datetime(2023, 9, 1, 10)
+    rows = []
+    for i in range(count):
+        start = first + timedelta(hours=i % 2000)
+        rows.append((i, 1 + i % 50, start, start + timedelta(hours=1), "comment" if i % 3 else None, 1 + i % 20))
+    return rows
+
+
+def legacy(rows):
+    bookings = [Booking(id=i, user_id=u, start_time=s, end_time=e, comment=c) for i, u, s, e, c, _ in rows]
+    content = {"status_code": 200, "message": "bookings retrieved",
+               "bookings": [legacy_to_json(booking) for booking in bookings]}
+    return JSONResponse(content=content).body
+
+
+def current(rows):
+    content = {"status_code": 200, "message": "bookings retrieved", "bookings": serialize_bookings(rows)}
+    return ORJSONResponse(content=content).body
+
+
+def measure(func, rows, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(rows)
+        best = min(best, time.perf_counter() - started)
+    return len(rows) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    assert orjson.loads(current(rows)) == json.loads(legacy(rows))
+    legacy_rate = measure(legacy, rows, args.repeat)
+    current_rate = measure(current, rows, args.repeat)
+    print(json.dumps({
+        "rows": args.rows,
+        "legacy_rows_per_s": round(legacy_rate),
+        "current_rows_per_s": round(current_rate),
+        "speedup": round(current_rate / legacy_rate, 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
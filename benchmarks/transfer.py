@@ -0,0 +1,96 @@
+"""
+Throughput of the bulk import and export of `transfer.py`.
+
+Creates `--users` users named bench_transfer_<n>, imports `--rows` generated bookings of theirs as a streamed
+CSV, imports the same rows again (every one is then found to exist already), and exports them as CSV and
+gzipped NDJSON. Prints rows per minute of every step and the peak RSS of the process, which stays flat however
+many rows are moved. The users and their bookings are deleted afterwards.
+
+    python benchmarks/transfer.py --rows 1000000
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import dispose_engine, get_engine  # noqa: E402
+from transfer import export_bookings, import_bookings  # noqa: E402
+
+FIRST_SLOT = datetime(2024, 1, 1)
+CHUNK_ROWS = 10000
+
+
+async def generate_csv(user_ids, rows: int):
+    """Back to back hour long bookings of every user in turn, as CSV chunks."""
+    yield b"id,user_id,start_time,end_time,comment,resource_id\n"
+    lines = []
+    for index in range(rows):
+        start = FIRST_SLOT + timedelta(hours=index // len(user_ids))
+        lines.append(f",{user_ids[index % len(user_ids)]},{start},{start + timedelta(hours=1)},bench,\n")
+        if len(lines) == CHUNK_ROWS:
+            yield "".join(lines).encode()
+            lines = []
+    if lines:
+        yield "".join(lines).encode()
+
+
+def peak_rss_mb() -> float:
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def per_minute(rows: int, seconds: float) -> int:
+    return int(rows / seconds * 60)
+
+
+async def run(rows: int, users: int) -> dict:
+    engine = get_engine()
+    async with engine.begin() as conn:
+        user_ids = (await conn.execute(text("""
+            INSERT INTO users (username, password, created_at, updated_at)
+            SELECT 'bench_transfer_' || n, '', current_date, current_date FROM generate_series(1, :users) n
+            RETURNING id
+        """), {"users": users})).scalars().all()
+    results = {"rows": rows, "users": users, "rss_before_mb": peak_rss_mb()}
+    try:
+        for step in ("import", "reimport"):
+            started = time.perf_counter()
+            async with engine.begin() as conn:
+                counts, _ = await import_bookings(conn, generate_csv(user_ids, rows))
+            elapsed = time.perf_counter() - started
+            results[step] = {**counts, "seconds": round(elapsed, 1), "rows_per_minute": per_minute(rows, elapsed),
+                             "rss_peak_mb": peak_rss_mb()}
+        for fmt, compress in (("csv", False), ("ndjson", True)):
+            started = time.perf_counter()
+            size = 0
+            async for chunk in export_bookings(fmt, compress):
+                size += len(chunk)
+            elapsed = time.perf_counter() - started
+            results[f"export_{fmt}{'_gzip' if compress else ''}"] = {
+                "seconds": round(elapsed, 1), "rows_per_minute": per_minute(rows, elapsed),
+                "mb": round(size / 2 ** 20, 1), "rss_peak_mb": peak_rss_mb(),
+            }
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text("DELETE FROM users WHERE id = ANY(:ids)"), {"ids": user_ids})
+        await dispose_engine()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.rows, args.users)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from typing import Any, Optional
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")  # "memory" or "redis"
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", 10000))
+CACHE_TTL = int(os.getenv("CACHE_TTL", 300))  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    """
+    In-process LRU with a TTL per entry.
+
+    Every worker has its own copy, so an entry invalidated by one worker may be served by another one until it
+    expires. Use the Redis backend when running several workers.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: int):
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def delete(self, key: str):
+        self._entries.pop(key, None)
+
+
+class RedisBackend:
+    """
+    Cache shared by all workers, stored in Redis as JSON.
+
+    Takes any client with the `redis.asyncio.Redis` get/set/delete interface, so a fake can stand in for it.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    async def get(self, key: str) -> Optional[Any]:
+        raw = await self._client.get(key)
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key: str, value: Any, ttl: int):
+        await self._client.set(key, json.dumps(value), ex=ttl)
+
+    async def delete(self, key: str):
+        await self._client.delete(key)
+
+
+class Cache:
+    """
+    Namespaced read-through cache with hit and miss counters.
+
+    Values have to be JSON serializable so both backends behave the same. Backend failures are logged and
+    treated as misses, the database stays the source of truth.
+    """
+
+    def __init__(self, backend, ttl: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.errors = 0
+
+    async def get(self, namespace: str, key: Any) -> Optional[Any]:
+        try:
+            value = await self.backend.get(f"{namespace}:{key}")
+        except Exception:
+            logger.exception("cache get failed")
+            self.errors += 1
+            value = None
+        if value is None:
+            self.misses[namespace] += 1
+        else:
+            self.hits[namespace] += 1
+        return value
+
+    async def set(self, namespace: str, key: Any, value: Any, ttl: Optional[int] = None):
+        try:
+            await self.backend.set(f"{namespace}:{key}", value, ttl or self.ttl)
+        except Exception:
+            logger.exception("cache set failed")
+            self.errors += 1
+
+    async def delete(self, namespace: str, key: Any):
+        try:
+            await self.backend.delete(f"{namespace}:{key}")
+        except Exception:
+            logger.exception("cache delete failed")
+            self.errors += 1
+
+    def stats(self) -> dict:
+        namespaces = set(self.hits) | set(self.misses)
+        return {
+            "backend": type(self.backend).__name__,
+            "errors": self.errors,
+            "namespaces": {namespace: {"hits": self.hits[namespace], "misses": self.misses[namespace]}
+                           for namespace in sorted(namespaces)},
+        }
+
+
+def create_cache() -> Cache:
+    if CACHE_BACKEND == "redis":
+        import redis.asyncio as redis
+
+        return Cache(RedisBackend(redis.from_url(CACHE_URL)), CACHE_TTL)
+    return Cache(MemoryBackend(CACHE_SIZE), CACHE_TTL)
+
+
+cache = create_cache()
+
+
+async def bookings_version(user_id: int) -> str:
+    """
+    Get the current version of the bookings of a user, cached pages and ETags are tied to it.
+
+    Parameters:
+        user_id (int): The ID of the user.
+
+    Returns:
+        str: An opaque version token, a new one if none is cached.
+    """
+    version = await cache.get("bookings_version", user_id)
+    if version is None:
+        version = await invalidate_bookings(user_id)
+    return version
+
+
+async def invalidate_bookings(user_id: int) -> str:
+    """Start a new version of the bookings of a user, which orphans every cached page and ETag of the old one."""
+    version = uuid.uuid4().hex[:12]
+    await cache.set("bookings_version", user_id, version)
+    return version
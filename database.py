@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+EXCLUSION_VIOLATION = "23P01"
+
+DATABASE_URL = os.getenv("DATABASE_URL") or "postgresql+asyncpg://{user}:{password}@{host}:{port}/{name}".format(
+    user=os.getenv("DB_USER", "cyberuser"),
+    password=os.getenv("DB_PASSWORD", "cyberpassword"),
+    host=os.getenv("DB_HOST", "db"),
+    port=os.getenv("DB_PORT", "5432"),
+    name=os.getenv("DB_NAME", "cyberapi"),
+)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 5))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # seconds before a connection is replaced
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+READINESS_CACHE = float(os.getenv("READINESS_CACHE", 1))  # seconds a database check is reused for
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", 2))  # seconds
+
+logger = logging.getLogger(__name__)
+
+_engine: Optional[AsyncEngine] = None
+# Bound to the engine once it is created, see `get_engine`
+async_session = async_sessionmaker(expire_on_commit=False)
+
+
+def build_engine(url: str) -> AsyncEngine:
+    """Create an engine with the pool settings of this process, for the primary or a replica."""
+    return create_async_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
+def get_engine() -> AsyncEngine:
+    """
+    Return the engine of this process, creating it on first use.
+
+    The engine is created lazily, from the application lifespan or a command, and never at import time, so a
+    forking server such as Gunicorn cannot share pooled connections between its workers.
+
+    Returns:
+        AsyncEngine: The engine.
+    """
+    global _engine
+    if _engine is None:
+        _engine = build_engine(DATABASE_URL)
+        async_session.configure(bind=_engine)
+    return _engine
+
+
+async def dispose_engine():
+    """Close every pooled connection, the engine opens new ones if it is used again."""
+    if _engine is not None:
+        await _engine.dispose()
+
+
+class PoolStats:
+    """Counts the connection checkouts made for requests and how long they waited for the pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float):
+        with self._lock:
+            self.acquisitions += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+
+pool_stats = PoolStats()
+
+
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[AsyncSession]:
+    """
+    Open an asynchronous database session with its connection already checked out.
+
+    Checking the connection out up front measures the time spent waiting for the pool. The connection goes back
+    to the pool when the block exits, however it exits.
+
+    Yields:
+        AsyncSession: The session.
+
+    Raises:
+        HTTPException: 503 if no connection became free within `DB_POOL_TIMEOUT`.
+    """
+    async with async_session() as session:
+        started = time.perf_counter()
+        try:
+            await session.connection()
+        except PoolTimeoutError:
+            pool_stats.record_timeout()
+            raise HTTPException(status_code=503, detail="Database is busy, try again later.",
+                                headers={"Retry-After": "1"})
+        pool_stats.record(time.perf_counter() - started)
+        yield session
+
+
+async def get_session() -> AsyncIterator[AsyncSession]:
+    """
+    Provide a database session for a single request, see `session_scope`.
+
+    Yields:
+        AsyncSession: The session bound to the current request.
+    """
+    async with session_scope() as session:
+        yield session
+
+
+def pool_status() -> dict:
+    """
+    Describe the state of the connection pool.
+
+    Returns:
+        dict: Pool size, checked out, idle and overflow connections, and the wait time of request checkouts.
+    """
+    pool = get_engine().pool
+    acquisitions = pool_stats.acquisitions or 1
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "acquisitions": pool_stats.acquisitions,
+        "timeouts": pool_stats.timeouts,
+        "avg_wait_ms": round(pool_stats.total_wait / acquisitions * 1000, 3),
+        "max_wait_ms": round(pool_stats.max_wait * 1000, 3),
+    }
+
+
+class HealthCheck:
+    """
+    `SELECT 1` against the database, cached for `ttl` seconds.
+
+    However often it is polled, and by however many requests at once, it runs at most one query per `ttl`.
+    A check that does not finish within `timeout`, e.g. because the pool is exhausted, counts as failed. Checks
+    the primary unless given another engine, e.g. of a replica.
+    """
+
+    def __init__(self, ttl: float, timeout: float, engine: Optional[AsyncEngine] = None):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.engine = engine
+        self._healthy = False
+        self._checked_at = float("-inf")
+        self._pending: Optional[asyncio.Task] = None
+
+    async def _ping(self):
+        async with (self.engine or get_engine()).connect() as conn:
+            await conn.exec_driver_sql("SELECT 1")
+
+    async def _check(self) -> bool:
+        try:
+            await asyncio.wait_for(self._ping(), self.timeout)
+            healthy = True
+        except Exception as exc:
+            logger.warning("database health check failed: %r", exc)
+            healthy = False
+        self._healthy, self._checked_at = healthy, time.monotonic()
+        return healthy
+
+    async def healthy(self) -> bool:
+        if time.monotonic() - self._checked_at < self.ttl:
+            return self._healthy
+        # Concurrent callers share the check in flight
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.ensure_future(self._check())
+        return await asyncio.shield(self._pending)
+
+    def last_known(self) -> bool:
+        """The result of the last check without waiting for a new one, which is started if it is stale."""
+        if time.monotonic() - self._checked_at >= self.ttl and (self._pending is None or self._pending.done()):
+            self._pending = asyncio.ensure_future(self._check())
+        return self._healthy
+
+    def mark_failed(self):
+        """Count the database as down until the next check, e.g. after a connection to it failed."""
+        self._healthy, self._checked_at = False, time.monotonic()
+
+
+database_health = HealthCheck(READINESS_CACHE, READINESS_TIMEOUT)
+
+
+def is_exclusion_violation(exc: IntegrityError) -> bool:
+    """
+    Check whether an integrity error was raised by an exclusion constraint, e.g. an overlapping booking.
+
+    Parameters:
+        exc (IntegrityError): The error raised on flush or commit.
+
+    Returns:
+        bool: True if Postgres reported an exclusion violation.
+    """
+    return getattr(exc.orig, "pgcode", None) == EXCLUSION_VIOLATION
+
+
+def violated_constraint(exc: IntegrityError) -> Optional[str]:
+    """The name of the constraint an integrity error was raised by, if Postgres reported it."""
+    return getattr(exc.orig.__cause__, "constraint_name", None)
@@ -0,0 +1,4 @@
+#!/bin/bash
+# Run once by the primary when its data directory is initialized: lets the replica service stream the WAL
+set -e
+echo "host replication $POSTGRES_USER all md5" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,235 @@
+"""
+Booking changes pushed to clients instead of polled.
+
+Writes publish their changes with `pg_notify` in the transaction that makes them, so a change is announced
+exactly when it commits and never for a rolled back one. Every worker holds a single `LISTEN` connection and fans
+the notifications out to the subscriptions of its own clients, whichever worker made the change; the payload is
+parsed once per worker and the same string is handed to every subscriber of the user.
+
+A subscription is a small bounded queue. A client that stops reading loses its queued changes and gets a
+`resync` event, telling it to fetch its bookings again, instead of growing the queue without bound. Changes
+notified while the listener is disconnected are lost too, so after reconnecting every subscriber gets `resync`.
+"""
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+import asyncpg
+import orjson
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+FEED_CHANNEL = "booking_changes"
+FEED_QUEUE_SIZE = int(os.getenv("FEED_QUEUE_SIZE", 100))  # events kept for a subscriber that is not reading
+FEED_HEARTBEAT = float(os.getenv("FEED_HEARTBEAT", 15))  # seconds between keepalives of idle streams
+NOTIFY_MAX_PAYLOAD = 7900  # bytes, Postgres rejects notification payloads of 8000 bytes and more
+RESYNC = ("resync", '{"event":"resync"}')
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_QUERY = text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) payload")
+
+
+def pack_notifications(user_id: int, event: str, bookings: List[dict]) -> List[str]:
+    """
+    Pack booking changes into as few notification payloads as fit the Postgres limit.
+
+    A booking too large for a notification on its own, which takes a very long comment, is announced by its ID
+    with `"truncated": true`, the client fetches it to see the rest.
+
+    Returns:
+        List[str]: JSON objects with the user_id, event and a part of the bookings.
+    """
+    head = b'{"user_id":%d,"event":%s,"bookings":[' % (user_id, orjson.dumps(event))
+    room = NOTIFY_MAX_PAYLOAD - len(head) - 2
+    payloads, items, size = [], [], 0
+    for booking in bookings:
+        item = orjson.dumps(booking)
+        if len(item) > room:
+            item = orjson.dumps({"id": booking["id"], "truncated": True})
+        if items and size + len(item) + 1 > room:
+            payloads.append(head + b",".join(items) + b"]}")
+            items, size = [], 0
+        items.append(item)
+        size += len(item) + 1
+    if items:
+        payloads.append(head + b",".join(items) + b"]}")
+    return [payload.decode() for payload in payloads]
+
+
+async def publish(session: AsyncSession, user_id: int, event: str, bookings: List[dict]):
+    """
+    Announce changes of the bookings of a user once the transaction of `session` commits.
+
+    Parameters:
+        session (AsyncSession): The session of the change.
+        user_id (int): The owner of the bookings.
+        event (str): "created" or "deleted".
+        bookings (List[dict]): The created bookings as `Booking.to_json` returns them, or the `id` of every
+            deleted one.
+    """
+    payloads = pack_notifications(user_id, event, bookings)
+    if payloads:
+        await session.execute(PUBLISH_QUERY, {"channel": FEED_CHANNEL, "payloads": payloads})
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Subscription:
+    """The pending events of one connected client. Kept small, a worker may hold thousands of idle ones."""
+    __slots__ = ("user_id", "_maxsize", "_events", "_waiter", "_lost")
+
+    def __init__(self, user_id: int, maxsize: int):
+        self.user_id = user_id
+        self._maxsize = maxsize
+        # The queue and the waiter are only allocated while needed, most subscriptions sit idle
+        self._events: Optional[deque] = None
+        self._waiter: Optional[asyncio.Future] = None
+        self._lost = False
+
+    def push(self, event: str, data: str):
+        if self._events is None:
+            self._events = deque()
+        if len(self._events) >= self._maxsize:
+            self._events.clear()
+            self._lost = True
+        elif not self._lost:
+            self._events.append((event, data))
+        if self._waiter is not None:
+            _wake(self._waiter)
+
+    def resync(self):
+        """Drop the pending events, the client has to fetch its bookings again."""
+        if self._events:
+            self._events.clear()
+        self._lost = True
+        if self._waiter is not None:
+            _wake(self._waiter)
+
+    async def next(self, timeout: float) -> List[Tuple[str, str]]:
+        """
+        Wait for events.
+
+        Returns:
+            List[Tuple[str, str]]: The name and JSON data of the pending events, a single `resync` if events were
+                lost, empty if none arrived within `timeout` seconds.
+        """
+        if not self._events and not self._lost:
+            loop = asyncio.get_running_loop()
+            self._waiter = loop.create_future()
+            # A bare timer instead of `wait_for`, which would wrap the wait in a task of its own
+            timer = loop.call_later(timeout, _wake, self._waiter)
+            try:
+                await self._waiter
+            finally:
+                timer.cancel()
+                self._waiter = None
+        if self._lost:
+            self._lost = False
+            if self._events:
+                self._events.clear()
+            return [RESYNC]
+        if not self._events:
+            return []
+        events = list(self._events)
+        self._events.clear()
+        return events
+
+
+class BookingFeed:
+    """The `LISTEN` connection of this process and the subscriptions it fans out to."""
+
+    def __init__(self, queue_size: int, heartbeat: float):
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.notifications = 0
+        self.delivered = 0
+        self.reconnects = 0
+        self._subscriptions: Dict[int, Set[Subscription]] = {}
+        self._connection: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(user_id, self.queue_size)
+        self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.user_id]
+
+    def _dispatch(self, connection, pid: int, channel: str, payload: str):
+        self.notifications += 1
+        message = orjson.loads(payload)
+        for subscription in self._subscriptions.get(message["user_id"], ()):
+            subscription.push(message["event"], payload)
+            self.delivered += 1
+
+    async def _connect(self, dsn: str):
+        connection = await asyncpg.connect(dsn)
+        try:
+            await connection.add_listener(FEED_CHANNEL, self._dispatch)
+        except Exception:
+            connection.terminate()
+            raise
+        self._connection = connection
+
+    async def _supervise(self, dsn: str):
+        delay = 1
+        while True:
+            try:
+                if self._connection is None:
+                    await self._connect(dsn)
+                    self.reconnects += 1
+                    delay = 1
+                    for subscriptions in self._subscriptions.values():
+                        for subscription in subscriptions:
+                            subscription.resync()
+                # An idle connection does not notice a dead server by itself
+                await asyncio.sleep(self.heartbeat)
+                await self._connection.fetchval("SELECT 1", timeout=self.heartbeat)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("booking feed listener lost its connection, reconnecting in %s s", delay)
+                if self._connection is not None:
+                    self._connection.terminate()
+                    self._connection = None
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def start(self, dsn: str):
+        """Start listening, reconnecting in the background whenever the connection is lost."""
+        try:
+            await self._connect(dsn)
+        except Exception:
+            logger.exception("booking feed listener failed to connect")
+            self._connection = None
+        self._task = asyncio.ensure_future(self._supervise(dsn))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": sum(len(subscriptions) for subscriptions in self._subscriptions.values()),
+            "listening": int(self._connection is not None),
+            "notifications": self.notifications, "delivered": self.delivered, "reconnects": self.reconnects,
+        }
+
+
+booking_feed = BookingFeed(FEED_QUEUE_SIZE, FEED_HEARTBEAT)
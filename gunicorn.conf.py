@@ -0,0 +1,33 @@
+"""
+Gunicorn settings for running several uvicorn workers: `gunicorn main:app -c gunicorn.conf.py`.
+
+Workers do not migrate the schema, run `python migrations.py` once before starting them. The app is not
+preloaded, every worker imports it and creates its own engine and connection pool.
+
+Cached pages, booking versions and users are only invalidated in the worker that made the change unless the
+cache is shared, so several workers need `CACHE_BACKEND=redis`. With the default in-memory cache a single worker
+is started unless `WEB_CONCURRENCY` asks for more, and then a warning is logged at startup.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+shared_cache = os.getenv("CACHE_BACKEND", "memory") == "redis"  # see cache.py
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() if shared_cache else 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+keepalive = int(os.getenv("KEEPALIVE", 5))
+timeout = int(os.getenv("WORKER_TIMEOUT", 30))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+# Recycle workers now and then, with jitter so they do not all restart at once
+max_requests = int(os.getenv("MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", 1000))
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+accesslog = os.getenv("ACCESS_LOG")
+
+
+def when_ready(server):
+    if workers > 1 and not shared_cache:
+        server.log.warning(
+            "%d workers with the in-memory cache: a worker keeps serving pages, 304s and users that another one "
+            "invalidated for up to CACHE_TTL seconds, set CACHE_BACKEND=redis", workers,
+        )
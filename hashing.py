@@ -0,0 +1,134 @@
+import asyncio
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from fastapi import HTTPException
+
+from instrumentation import timed
+from utils import get_hashed_password, verify_password
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", 32))
+HASH_TIMEOUT = float(os.getenv("HASH_TIMEOUT", 5))  # seconds
+
+
+class HashingExecutor:
+    """
+    Runs bcrypt hashing and verification off the event loop.
+
+    bcrypt releases the GIL, so a thread pool is enough to use every core. At most `workers` hashes run at
+    once and at most `queue_size` more may wait for a free worker; anything beyond that is rejected with a
+    503 immediately instead of piling up behind the queue.
+    """
+
+    def __init__(self, workers: int, queue_size: int, timeout: float):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._total_wait = 0.0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+
+    async def run(self, func, *args):
+        """
+        Run `func(*args)` on the pool and wait for the result.
+
+        Raises:
+            HTTPException: 503 if the queue is full or the call does not finish within the timeout.
+        """
+        with self._lock:
+            if self._in_flight >= self.workers + self.queue_size:
+                self._rejected += 1
+                raise HTTPException(status_code=503, detail="Server is busy, try again later.",
+                                    headers={"Retry-After": "1"})
+            self._in_flight += 1
+        future = self._pool.submit(self._timed, time.perf_counter(), func, *args)
+        # The slot is only released once the worker is really done, even if the caller gave up waiting
+        future.add_done_callback(self._release)
+        try:
+            with timed("bcrypt"):
+                return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._timed_out += 1
+            raise HTTPException(status_code=503, detail="Server is busy, try again later.",
+                                headers={"Retry-After": "1"})
+
+    def _timed(self, submitted_at: float, func, *args):
+        started = time.perf_counter()
+        with self._lock:
+            self._running += 1
+            self._total_wait += started - submitted_at
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                self._total_latency += elapsed
+                self._max_latency = max(self._max_latency, elapsed)
+
+    def _release(self, future: Future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            completed = self._completed or 1
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "running": self._running,
+                "queue_depth": self._in_flight - self._running,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "avg_wait_ms": round(self._total_wait / completed * 1000, 3),
+                "avg_latency_ms": round(self._total_latency / completed * 1000, 3),
+                "max_latency_ms": round(self._max_latency * 1000, 3),
+            }
+
+
+hash_executor = HashingExecutor(HASH_WORKERS, HASH_QUEUE_SIZE, HASH_TIMEOUT)
+
+
+async def hash_password(password: str) -> str:
+    return await hash_executor.run(get_hashed_password, password)
+
+
+_dummy_hash = None
+
+
+async def prepare_dummy_hash():
+    """Hash the password unknown usernames are checked against, once at startup, see `check_password`."""
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = await hash_executor.run(get_hashed_password, secrets.token_urlsafe(16))
+
+
+async def check_password(password: str, hashed_pass: Optional[str]) -> bool:
+    """
+    Verify a password against its hash.
+
+    Without a hash, e.g. for an unknown username, the password is verified against a dummy hash of the same cost
+    and rejected, so the response time does not tell whether the user exists. The dummy hash is made at startup,
+    so that check costs exactly one verification like any other.
+    """
+    if hashed_pass is None:
+        # Only outside the app, whose startup prepares it
+        await prepare_dummy_hash()
+        await hash_executor.run(verify_password, password, _dummy_hash)
+        return False
+    return await hash_executor.run(verify_password, password, hashed_pass)
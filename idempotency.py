@@ -0,0 +1,256 @@
+"""
+`Idempotency-Key` support for the mutating endpoints clients retry.
+
+The first request with a key claims it in `idempotency_keys`, runs, and stores its response there; a retry with
+the same key gets the stored response back without running the endpoint again, so no second bcrypt, insert or
+spurious "already exists". Keys are scoped by the user of the access token, and by nothing for `/register`,
+which takes no token, and expire after `IDEMPOTENCY_TTL`. Reusing a key for a different request is a 422.
+
+A duplicate arriving while the first request still runs waits for it instead of running too: on the same worker
+it waits for the response in memory, on another one it polls the table. A request whose worker died before
+storing its response leaves a pending claim, which the next retry takes over after `IDEMPOTENCY_LEASE`.
+Responses with a 5xx, 408 or 429 status are not stored, the claim is released and a retry runs again.
+"""
+import asyncio
+import hashlib
+import hmac
+import os
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+from sqlalchemy import text
+from starlette.datastructures import Headers
+
+from database import async_session
+from utils import decode_principal
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 24 * 60 * 60))  # seconds a stored response is replayed for
+IDEMPOTENCY_LEASE = float(os.getenv("IDEMPOTENCY_LEASE", 60))  # seconds before a pending claim may be taken over
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", 10))  # seconds a duplicate waits for the first request
+# The fingerprint of `/register` covers the password, so it is keyed rather than a bare hash
+IDEMPOTENCY_SECRET = os.getenv("IDEMPOTENCY_SECRET") or os.getenv("JWT_SECRET_KEY") or "TEST"
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+IDEMPOTENT_PATHS = ("/register", "/create_booking", "/bookings/allocate", "/bookings/bulk")
+IDEMPOTENT_PREFIXES = ("/remove_booking/",)
+UNSTORED_STATUSES = {408, 429}
+# Per response, or describing this worker rather than the response
+UNSTORED_HEADERS = {b"content-length", b"date", b"server", b"server-timing", b"x-profile-report"}
+
+CLAIM_QUERY = text("""
+    INSERT INTO idempotency_keys (scope, key, fingerprint, created_at, expires_at)
+    VALUES (:scope, :key, :fingerprint, clock_timestamp(), now() + make_interval(secs => :ttl))
+    ON CONFLICT (scope, key) DO UPDATE
+        SET fingerprint = EXCLUDED.fingerprint, status = NULL, headers = NULL, body = NULL,
+            created_at = EXCLUDED.created_at, expires_at = EXCLUDED.expires_at
+        WHERE idempotency_keys.expires_at < now()
+           OR (idempotency_keys.status IS NULL
+               AND idempotency_keys.created_at < now() - make_interval(secs => :lease))
+    RETURNING created_at
+""")
+LOOKUP_QUERY = text("""
+    SELECT fingerprint, status, headers, body FROM idempotency_keys
+    WHERE scope = :scope AND key = :key AND expires_at >= now()
+""")
+# `claimed` is the claim of this request, a claim taken over after the lease is left alone
+STORE_QUERY = text("""
+    UPDATE idempotency_keys SET status = :status, headers = CAST(:headers AS jsonb), body = :body
+    WHERE scope = :scope AND key = :key AND created_at = :claimed
+""")
+RELEASE_QUERY = text("DELETE FROM idempotency_keys WHERE scope = :scope AND key = :key AND created_at = :claimed")
+
+StoredResponse = Tuple[bytes, int, List[List[str]], bytes]
+
+
+def is_idempotent_path(path: str) -> bool:
+    return path in IDEMPOTENT_PATHS or path.startswith(IDEMPOTENT_PREFIXES)
+
+
+def request_fingerprint(method: str, path: str, query: bytes, body: bytes) -> bytes:
+    """A keyed hash of everything that makes a request, the retry of a request has the same one."""
+    digest = hmac.new(IDEMPOTENCY_SECRET.encode(), digestmod=hashlib.sha256)
+    for part in (method.encode(), path.encode(), query, body):
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.digest()
+
+
+async def _execute(query, params: dict):
+    async with async_session() as session:
+        result = await session.execute(query, params)
+        row = result.first() if result.returns_rows else None
+        await session.commit()
+    return row
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+async def _respond(send, status: int, headers: List[List[str]], body: bytes, replayed: bool = False):
+    raw = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+    raw.append((b"content-length", str(len(body)).encode()))
+    if replayed:
+        raw.append((b"idempotent-replayed", b"true"))
+    await send({"type": "http.response.start", "status": status, "headers": raw})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _respond_json(send, status: int, message: str):
+    body = orjson.dumps({"status_code": status, "message": message})
+    await _respond(send, status, [["content-type", "application/json"]], body)
+
+
+class IdempotencyState:
+    """The keyed requests running on this worker, whose duplicates wait for them, and what became of retries."""
+
+    def __init__(self):
+        self.executed = 0
+        self.replayed = 0
+        self.coalesced = 0
+        self.mismatched = 0
+        self.inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    def stats(self) -> dict:
+        return {"executed": self.executed, "replayed": self.replayed, "coalesced": self.coalesced,
+                "mismatched": self.mismatched, "inflight": len(self.inflight)}
+
+
+idempotency_state = IdempotencyState()
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI middleware replaying the stored response of requests retried with the same `Idempotency-Key`.
+
+    Only the endpoints in `IDEMPOTENT_PATHS` and `IDEMPOTENT_PREFIXES` take part, other requests and requests
+    without the header pass straight through.
+    """
+
+    def __init__(self, app, state: IdempotencyState = idempotency_state):
+        self.app = app
+        self.state = state
+
+    @staticmethod
+    def _scope_of(headers: Headers, path: str) -> Optional[str]:
+        """The user the key belongs to, None if the request has to be rejected by the endpoint as is."""
+        if path == "/register":
+            return ""
+        scheme, _, token = headers.get("authorization", "").partition(" ")
+        principal = decode_principal(token) if scheme == "Bearer" and token else None
+        return principal.username if principal is not None else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "DELETE") \
+                or not is_idempotent_path(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        key = headers.get("idempotency-key")
+        owner = self._scope_of(headers, scope["path"]) if key is not None else None
+        if owner is None:
+            await self.app(scope, receive, send)
+            return
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            await _respond_json(send, 400, "invalid idempotency key")
+            return
+
+        body = await _read_body(receive)
+        fingerprint = request_fingerprint(scope["method"], scope["path"], scope["query_string"], body)
+        stored = await self._resolve(scope, send, owner, key, fingerprint, body)
+        if stored is None:
+            return
+        if stored[0] != fingerprint:
+            self.state.mismatched += 1
+            await _respond_json(send, 422, "idempotency key was used for a different request")
+            return
+        self.state.replayed += 1
+        await _respond(send, *stored[1:], replayed=True)
+
+    async def _resolve(self, scope, send, owner: str, key: str, fingerprint: bytes,
+                       body: bytes) -> Optional[StoredResponse]:
+        """
+        Run the request if this one gets the key, otherwise wait for the response of the one that did.
+
+        Returns:
+            Optional[StoredResponse]: The response of the request that got the key, None once this request was
+                answered, by running it or because the other one did not finish within `IDEMPOTENCY_WAIT`.
+        """
+        params = {"scope": owner, "key": key}
+        waited = 0.0
+        delay = 0.01
+        while True:
+            inflight = self.state.inflight.get((owner, key))
+            if inflight is not None:
+                # The first request is running on this worker, its response arrives without polling
+                self.state.coalesced += 1
+                stored = await asyncio.shield(inflight)
+                if stored is not None:
+                    return stored
+                continue
+            claimed = await _execute(CLAIM_QUERY, dict(params, fingerprint=fingerprint, ttl=IDEMPOTENCY_TTL,
+                                                       lease=IDEMPOTENCY_LEASE))
+            if claimed is not None:
+                await self._run(scope, send, params, claimed[0], fingerprint, body)
+                return None
+            row = await _execute(LOOKUP_QUERY, params)
+            if row is not None and (row.status is not None or row.fingerprint != fingerprint):
+                return bytes(row.fingerprint), row.status or 0, row.headers or [], bytes(row.body or b"")
+            if waited >= IDEMPOTENCY_WAIT:
+                await _respond_json(send, 409, "a request with this idempotency key is in progress")
+                return None
+            # Running on another worker, or released and about to be claimed again
+            await asyncio.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, 0.5)
+
+    async def _run(self, scope, send, params: dict, claimed, fingerprint: bytes, body: bytes):
+        inflight = self.state.inflight[(params["scope"], params["key"])] = asyncio.get_running_loop().create_future()
+        status = 500
+        response_headers: List[List[str]] = []
+        chunks = []
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                # Nothing more to read, the request body was replayed already
+                return {"type": "http.disconnect"}
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def capture(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_headers.extend([name.decode("latin-1"), value.decode("latin-1")]
+                                        for name, value in message.get("headers", [])
+                                        if name.lower() not in UNSTORED_HEADERS)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        stored = None
+        try:
+            self.state.executed += 1
+            await self.app(scope, receive, capture)
+            if status < 500 and status not in UNSTORED_STATUSES:
+                stored = fingerprint, status, response_headers, b"".join(chunks)
+        finally:
+            del self.state.inflight[(params["scope"], params["key"])]
+            try:
+                if stored is not None:
+                    await _execute(STORE_QUERY, dict(params, status=status, headers=orjson.dumps(stored[2]).decode(),
+                                                     body=stored[3], claimed=claimed))
+                else:
+                    await _execute(RELEASE_QUERY, dict(params, claimed=claimed))
+            finally:
+                inflight.set_result(stored)
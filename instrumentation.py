@@ -0,0 +1,243 @@
+"""
+Request instrumentation: per-route latency histograms split into DB, bcrypt, JWT and serialization time,
+query counting through SQLAlchemy events, `Server-Timing` headers, Prometheus text exposition and an opt-in
+sampling profiler.
+"""
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, List, Optional, Tuple
+
+from fastapi import responses
+from starlette.datastructures import MutableHeaders
+
+QUERY_WARN_THRESHOLD = int(os.getenv("QUERY_WARN_THRESHOLD", 20))  # queries per request worth a warning
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"  # lets clients ask for a profile with X-Profile: 1
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))  # share of requests profiled at random
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+COMPONENTS = ("db", "bcrypt", "jwt", "serialization")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimings:
+    """Time spent in each component while serving one request, and the number of SQL statements it ran."""
+
+    def __init__(self):
+        self.components = dict.fromkeys(COMPONENTS, 0.0)
+        self.queries = 0
+
+    def server_timing(self, total: float) -> str:
+        entries = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.components.items() if seconds]
+        if self.queries:
+            entries.append(f'queries;desc="{self.queries} statements"')
+        entries.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(entries)
+
+
+_current_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def timed(component: str):
+    """Add the time spent in the block to `component` of the current request, a no-op outside of requests."""
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.components[component] += time.perf_counter() - started
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...], buckets: Iterable[float]):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value: float, *label_values: str):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["buckets"][index] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self._series.items()):
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labels, label_values))
+            prefix = f"{labels}," if labels else ""
+            for bound, count in zip(self.buckets, series["buckets"]):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series["count"]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series['sum']}")
+            lines.append(f"{self.name}_count{{{labels}}} {series['count']}")
+        return lines
+
+
+request_duration = Histogram("http_request_duration_seconds", "Time to serve a request.",
+                             ("method", "route", "status"), LATENCY_BUCKETS)
+component_duration = Histogram("http_request_component_seconds", "Time a request spent in a component.",
+                               ("route", "component"), LATENCY_BUCKETS)
+request_queries = Histogram("http_request_db_queries", "SQL statements executed by a request.",
+                            ("route",), QUERY_BUCKETS)
+
+
+def render_metrics(gauges: Iterable[Tuple[str, dict, float]]) -> str:
+    """
+    Render the request histograms and the given gauges in the Prometheus text format.
+
+    Parameters:
+        gauges (Iterable[Tuple[str, dict, float]]): Name, labels and value of every gauge sample.
+
+    Returns:
+        str: The exposition text.
+    """
+    lines = []
+    for histogram in (request_duration, component_duration, request_queries):
+        lines.extend(histogram.render())
+    declared = set()
+    for name, labels, value in gauges:
+        if name not in declared:
+            lines.append(f"# TYPE {name} gauge")
+            declared.add(name)
+        rendered = ",".join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f"{name}{{{rendered}}} {value}" if rendered else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, which goes away with the statement whether it succeeds or fails
+    context._query_started = time.perf_counter()
+
+
+def _record_query(context):
+    started = getattr(context, "_query_started", None)
+    context._query_started = None
+    timings = _current_timings.get()
+    if started is not None and timings is not None:
+        timings.components["db"] += time.perf_counter() - started
+        timings.queries += 1
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _record_query(context)
+
+
+def _handle_error(exception_context):
+    # Failed statements take database time too, errors before the cursor executes have no start time
+    _record_query(exception_context.execution_context)
+
+
+def instrument_engine(engine):
+    """Count SQL statements and their execution time against the request being served, once per engine."""
+    from sqlalchemy import event
+
+    if not event.contains(engine.sync_engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine.sync_engine, "handle_error", _handle_error)
+
+
+class ORJSONResponse(responses.ORJSONResponse):
+    """`ORJSONResponse` that accounts its rendering to the serialization time of the request."""
+
+    def render(self, content) -> bytes:
+        with timed("serialization"):
+            return super().render(content)
+
+
+def _load_profiler():
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        logger.warning("profiling requested but pyinstrument is not installed")
+        return None
+    return Profiler
+
+
+class InstrumentationMiddleware:
+    """
+    ASGI middleware timing every HTTP request.
+
+    Adds a `Server-Timing` header with the per-component breakdown, records the histograms once the response is
+    sent and warns about requests running suspiciously many queries, which usually means an N+1 pattern.
+    Requests are profiled with pyinstrument when sampled by `PROFILE_SAMPLE_RATE` or, with `PROFILING_ENABLED`,
+    when they carry `X-Profile: 1`; the report is written to `PROFILE_DIR` and named in `X-Profile-Report`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+
+    def _route(self, scope) -> str:
+        if self._routes is None:
+            self._routes = {getattr(route, "endpoint", None): route.path for route in scope["app"].routes}
+        return self._routes.get(scope.get("endpoint"), "unmatched")
+
+    def _should_profile(self, scope) -> bool:
+        if PROFILING_ENABLED and (b"x-profile", b"1") in scope["headers"]:
+            return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        status = 500
+        profiler = None
+        report = None
+        if self._should_profile(scope):
+            Profiler = _load_profiler()
+            if Profiler is not None:
+                profiler = Profiler(async_mode="enabled")
+                name = scope["path"].strip("/").replace("/", "_") or "root"
+                report = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{name}.html")
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.server_timing(time.perf_counter() - started))
+                if report:
+                    headers.append("X-Profile-Report", os.path.basename(report))
+            await send(message)
+
+        try:
+            if profiler is not None:
+                profiler.start()
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_timings.reset(token)
+            if profiler is not None:
+                profiler.stop()
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                with open(report, "w") as file:
+                    file.write(profiler.output_html())
+            route = self._route(scope)
+            request_duration.observe(elapsed, scope["method"], route, str(status))
+            for component, seconds in timings.components.items():
+                component_duration.observe(seconds, route, component)
+            request_queries.observe(timings.queries, route)
+            if timings.queries > QUERY_WARN_THRESHOLD:
+                logger.warning("%s %s ran %d queries", scope["method"], route, timings.queries)
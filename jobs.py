@@ -0,0 +1,366 @@
+"""
+Durable background jobs stored in Postgres.
+
+Jobs are rows of `jobs`. A runner claims a due job with `SELECT ... FOR UPDATE SKIP LOCKED`, so any number of
+runners, in the web workers or in separate processes, share the queue without handing out a job twice. The
+handler runs in the transaction that holds the claim and the job is deleted in it on success: a crashed runner
+releases its claim and the job runs again, so handlers have to be idempotent. A failing handler is rolled back
+to a savepoint and the job retried with an exponential delay until `max_attempts`, then it is kept with
+`failed_at` set for inspection. Periodic jobs are never given up on: they keep being retried every
+`2 ** max_attempts` seconds, since their key would keep them from being scheduled again.
+
+A handler may return a `timedelta` to run the same job again after that delay instead of deleting it, which is
+how batched and periodic work is done. Web workers run jobs in process unless `JOBS_IN_PROCESS=0`; a dedicated
+worker is started with:
+
+    python jobs.py
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+from sqlalchemy import delete, func, select, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import invalidate_bookings
+from database import async_session
+from models import Booking, BookingStatsUser, IdempotencyKey, Job, User
+
+JOBS_IN_PROCESS = os.getenv("JOBS_IN_PROCESS", "1") == "1"
+JOBS_CONCURRENCY = int(os.getenv("JOBS_CONCURRENCY", 2))
+JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", 1))  # seconds
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", 5000))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 0))  # 0 keeps every booking in `bookings`
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", 3600))  # seconds between archival runs
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 5000))
+REMINDER_LEAD = int(os.getenv("REMINDER_LEAD", 0))  # minutes before a booking starts, 0 sends no reminders
+REMINDER_WEBHOOK_URL = os.getenv("REMINDER_WEBHOOK_URL")
+IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", 3600))  # seconds between purges
+
+logger = logging.getLogger(__name__)
+
+# No trigger watches the archive, so the purged rows are taken out of the hourly rollups by the same statement,
+# upserted in hour order like the triggers on `bookings` do
+PURGE_ARCHIVE_QUERY = text("""
+WITH purged AS (
+    DELETE FROM bookings_archive WHERE (id, start_time) IN (
+        SELECT id, start_time FROM bookings_archive WHERE user_id = :user_id LIMIT :batch
+    )
+    RETURNING start_time, end_time, resource_id
+), subtracted AS (
+    INSERT INTO booking_stats_hourly AS s (hour, bookings, booked_seconds, resource_seconds)
+    SELECT h.hour, -count(*) FILTER (WHERE h.hour = date_trunc('hour', p.start_time)), -sum(h.seconds),
+           -coalesce(sum(h.seconds) FILTER (WHERE p.resource_id IS NOT NULL), 0)
+    FROM purged p, LATERAL booking_hours(p.start_time, p.end_time) h
+    GROUP BY h.hour
+    ORDER BY h.hour
+    ON CONFLICT (hour) DO UPDATE SET bookings = s.bookings + EXCLUDED.bookings,
+        booked_seconds = s.booked_seconds + EXCLUDED.booked_seconds,
+        resource_seconds = s.resource_seconds + EXCLUDED.resource_seconds
+)
+SELECT count(*) FROM purged
+""")
+
+Handler = Callable[[AsyncSession, dict], Awaitable[Optional[timedelta]]]
+handlers: Dict[str, Handler] = {}
+reminder_hooks: List[Callable[[dict], Awaitable[None]]] = []
+
+
+def handler(kind: str):
+    """Register the decorated coroutine as the handler of jobs of `kind`."""
+    def register(func: Handler) -> Handler:
+        handlers[kind] = func
+        return func
+    return register
+
+
+def reminder_hook(func: Callable[[dict], Awaitable[None]]):
+    """Register the decorated coroutine to be called with every booking a reminder is due for."""
+    reminder_hooks.append(func)
+    return func
+
+
+def on_commit(session: AsyncSession, callback: Callable[[], Awaitable[None]]):
+    """Run `callback` once the job transaction of `session` is committed, e.g. to invalidate caches."""
+    session.info.setdefault("on_commit", []).append(callback)
+
+
+async def enqueue(session: AsyncSession, kind: str, payload: Optional[dict] = None,
+                  delay: timedelta = timedelta(0), key: Optional[str] = None):
+    """
+    Add a job in the transaction of `session`, it becomes visible to runners when that commits.
+
+    Parameters:
+        session (AsyncSession): The session of the change the job belongs to.
+        kind (str): The registered handler to run.
+        payload (Optional[dict]): JSON arguments of the handler.
+        delay (timedelta): Run no earlier than this long from now.
+        key (Optional[str]): Deduplication key, nothing is added while a job with the same key is pending.
+    """
+    await session.execute(pg_insert(Job).values(
+        kind=kind, key=key, payload=payload or {}, run_at=func.now() + delay,
+    ).on_conflict_do_nothing(index_elements=[Job.key]))
+
+
+class JobRunner:
+    """Polls the queue with `concurrency` loops, woken early by `wake` and counting what it ran."""
+
+    def __init__(self, concurrency: int, poll_interval: float):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    async def run_one(self) -> bool:
+        """
+        Claim and run one due job.
+
+        Returns:
+            bool: False if no job was due.
+        """
+        async with async_session() as session:
+            async with session.begin():
+                job = (await session.execute(
+                    select(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts)
+                    .where(Job.run_at <= func.now(), Job.failed_at.is_(None))
+                    .order_by(Job.run_at).limit(1).with_for_update(skip_locked=True)
+                )).first()
+                if job is None:
+                    return False
+                try:
+                    async with session.begin_nested():
+                        again = await handlers[job.kind](session, job.payload)
+                except Exception as exc:
+                    session.info.pop("on_commit", None)
+                    logger.exception("job %s (%s) failed", job.id, job.kind)
+                    attempts = job.attempts + 1
+                    failed = attempts >= job.max_attempts and not job.payload.get("periodic")
+                    await session.execute(update(Job).where(Job.id == job.id).values(
+                        attempts=attempts, last_error=repr(exc)[:1000],
+                        run_at=func.now() + timedelta(seconds=2 ** min(attempts, job.max_attempts)),
+                        failed_at=func.now() if failed else None,
+                    ))
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.retried += 1
+                else:
+                    if again is None:
+                        await session.execute(delete(Job).where(Job.id == job.id))
+                    else:
+                        await session.execute(update(Job).where(Job.id == job.id).values(
+                            run_at=func.now() + again, attempts=0,
+                        ))
+                    self.completed += 1
+            for callback in session.info.pop("on_commit", []):
+                await callback()
+        return True
+
+    async def run_pending(self) -> int:
+        """Run due jobs until there are none, returns how many ran."""
+        ran = 0
+        while await self.run_one():
+            ran += 1
+        return ran
+
+    async def _loop(self):
+        while True:
+            try:
+                if await self.run_one():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The database is unreachable or the like, keep polling
+                logger.exception("job runner failed to claim a job")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    async def schedule_periodic(kind: str, payload: dict):
+        """Enqueue a periodic job keyed by its kind, reviving it if it was given up on by an older version."""
+        async with async_session() as session:
+            await enqueue(session, kind, {**payload, "periodic": True}, key=kind)
+            await session.execute(update(Job).where(Job.key == kind, Job.failed_at.isnot(None)).values(
+                failed_at=None, attempts=0, run_at=func.now(), payload={**payload, "periodic": True},
+            ))
+            await session.commit()
+
+    async def start(self):
+        """Schedule the periodic jobs and start `concurrency` polling loops in the running event loop."""
+        self._wakeup = asyncio.Event()
+        if ARCHIVE_AFTER_DAYS > 0:
+            await self.schedule_periodic("archive_bookings", {"older_than_days": ARCHIVE_AFTER_DAYS})
+        await self.schedule_periodic("purge_idempotency_keys", {})
+        self._tasks = [asyncio.ensure_future(self._loop()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wake(self):
+        """Poll right away instead of at the next interval, e.g. after enqueuing a job."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {"completed": self.completed, "retried": self.retried, "failed": self.failed}
+
+
+job_runner = JobRunner(JOBS_CONCURRENCY, JOBS_POLL_INTERVAL)
+
+
+@handler("purge_user")
+async def purge_user(session: AsyncSession, payload: dict) -> Optional[timedelta]:
+    """
+    Delete the bookings of a soft deleted user in batches, archived ones included, then the user.
+
+    The bookings leave the rollups like any deleted booking: the triggers on `bookings` subtract the live ones,
+    `PURGE_ARCHIVE_QUERY` the archived ones, and the totals of the user go with the user.
+    """
+    user_id = payload["user_id"]
+    batch = select(Booking.id).where(Booking.user_id == user_id).limit(PURGE_BATCH_SIZE)
+    result = await session.execute(delete(Booking).where(Booking.id.in_(batch)))
+    if result.rowcount == PURGE_BATCH_SIZE:
+        return timedelta(0)
+    purged = await session.scalar(PURGE_ARCHIVE_QUERY, {"user_id": user_id, "batch": PURGE_BATCH_SIZE})
+    if purged == PURGE_BATCH_SIZE:
+        return timedelta(0)
+    await session.execute(delete(BookingStatsUser).where(BookingStatsUser.user_id == user_id))
+    await session.execute(delete(User).where(User.id == user_id, User.deleted_at.isnot(None)))
+    on_commit(session, lambda: invalidate_bookings(user_id))
+    return None
+
+
+@handler("archive_bookings")
+async def archive_bookings(session: AsyncSession, payload: dict) -> Optional[timedelta]:
+    """
+    Move bookings that ended more than `older_than_days` ago to `bookings_archive`, a batch per run.
+
+    Runs again right away while full batches are moved. Once done, a `periodic` job is rescheduled after
+    `ARCHIVE_INTERVAL`, any other is deleted.
+    """
+    batch = (await session.execute(text("""
+        SELECT id, start_time FROM bookings WHERE end_time < now() - make_interval(days => :days)
+        ORDER BY end_time LIMIT :batch FOR UPDATE
+    """), {"days": payload["older_than_days"], "batch": ARCHIVE_BATCH_SIZE})).all()
+    if batch:
+        # The archive is partitioned by month, the partitions the batch goes to are created first
+        starts = [start_time for _, start_time in batch]
+        await session.execute(text("SELECT create_monthly_partitions('bookings_archive', :start, :end)"),
+                              {"start": min(starts), "end": max(starts)})
+    # Archived bookings keep counting in the rollups, the triggers on `bookings` skip the move
+    await session.execute(text("SELECT set_config('bookings.archiving', 'on', true)"))
+    moved = await session.execute(text("""
+        WITH moved AS (
+            DELETE FROM bookings WHERE id = ANY(:ids)
+            RETURNING id, user_id, start_time, end_time, comment, resource_id
+        )
+        INSERT INTO bookings_archive (id, user_id, start_time, end_time, comment, resource_id)
+        SELECT id, user_id, start_time, end_time, comment, resource_id FROM moved
+        RETURNING user_id
+    """), {"ids": [booking_id for booking_id, _ in batch]})
+    user_ids = moved.scalars().all()
+    await session.execute(text("SELECT set_config('bookings.archiving', 'off', true)"))
+
+    async def invalidate():
+        for user_id in set(user_ids):
+            await invalidate_bookings(user_id)
+
+    on_commit(session, invalidate)
+    if len(batch) == ARCHIVE_BATCH_SIZE:
+        return timedelta(0)
+    return timedelta(seconds=ARCHIVE_INTERVAL) if payload.get("periodic") else None
+
+
+@handler("purge_idempotency_keys")
+async def purge_idempotency_keys(session: AsyncSession, payload: dict) -> Optional[timedelta]:
+    """Delete expired idempotency keys in batches, rescheduled after `IDEMPOTENCY_PURGE_INTERVAL` if `periodic`."""
+    batch = select(IdempotencyKey.scope, IdempotencyKey.key).where(
+        IdempotencyKey.expires_at < func.now()
+    ).limit(PURGE_BATCH_SIZE)
+    result = await session.execute(delete(IdempotencyKey).where(
+        tuple_(IdempotencyKey.scope, IdempotencyKey.key).in_(batch)
+    ))
+    if result.rowcount == PURGE_BATCH_SIZE:
+        return timedelta(0)
+    return timedelta(seconds=IDEMPOTENCY_PURGE_INTERVAL) if payload.get("periodic") else None
+
+
+async def enqueue_reminders(session: AsyncSession, bookings: Iterable[Tuple[int, datetime]]):
+    """
+    Schedule reminders `REMINDER_LEAD` minutes before bookings start, if reminders are enabled.
+
+    Parameters:
+        session (AsyncSession): The session the bookings are created in.
+        bookings (Iterable[Tuple[int, datetime]]): The ID and start time of every booking.
+    """
+    lead = timedelta(minutes=REMINDER_LEAD)
+    values = [{"kind": "booking_reminder", "payload": {"booking_id": booking_id}, "run_at": start_time - lead}
+              for booking_id, start_time in bookings]
+    if REMINDER_LEAD > 0 and values:
+        await session.execute(pg_insert(Job).values(values))
+
+
+@handler("booking_reminder")
+async def booking_reminder(session: AsyncSession, payload: dict) -> Optional[timedelta]:
+    """Call the reminder hooks with the booking, unless it was deleted or already started."""
+    booking = await session.get(Booking, payload["booking_id"])
+    if booking is None or booking.start_time <= datetime.now():
+        return None
+    for hook in reminder_hooks:
+        await hook(booking.to_json())
+    return None
+
+
+@reminder_hook
+async def post_reminder(booking: dict):
+    """POST the booking to `REMINDER_WEBHOOK_URL`, or log it without one."""
+    if not REMINDER_WEBHOOK_URL:
+        logger.info("reminder for booking %s", booking["id"])
+        return
+    async with httpx.AsyncClient(timeout=10) as client:
+        response = await client.post(REMINDER_WEBHOOK_URL, json={"event": "booking_reminder", "booking": booking})
+        response.raise_for_status()
+
+
+async def main():
+    from database import dispose_engine, get_engine
+
+    parser = argparse.ArgumentParser(description="Run background jobs until interrupted.")
+    parser.add_argument("--concurrency", type=int, default=JOBS_CONCURRENCY)
+    parser.add_argument("--once", action="store_true", help="run the jobs that are due and exit")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    get_engine()
+    runner = JobRunner(args.concurrency, JOBS_POLL_INTERVAL)
+    if args.once:
+        print(f"ran {await runner.run_pending()} jobs")
+    else:
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+        await runner.start()
+        await stopped.wait()
+        await runner.stop()
+    await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
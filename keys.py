@@ -0,0 +1,180 @@
+"""
+JWT signing keys.
+
+Access and refresh tokens are signed by separate key rings. A ring signs with its active key and names it in
+the `kid` header, and verifies with whichever of its keys the header names, so keys rotate without downtime:
+add the new key to every worker, make it active, and drop the old one once the tokens it signed have expired.
+
+The rings come from the JSON file named by `JWT_KEYS_FILE`:
+
+    {
+        "access": {"active": "2024-02", "keys": [
+            {"kid": "2024-02", "alg": "EdDSA", "private_key_file": "access-2024-02.pem"},
+            {"kid": "2024-01", "alg": "HS256", "secret_env": "JWT_SECRET_2024_01"}
+        ]},
+        "refresh": {"active": "r1", "keys": [{"kid": "r1", "alg": "HS256", "secret_file": "refresh-r1.key"}]}
+    }
+
+A symmetric key takes its secret from `secret`, `secret_env` or `secret_file`. An EdDSA or ES256 key takes a
+PEM private key from `private_key_file`, or only a public key from `public_key_file` to keep verifying tokens of
+a retired key; asymmetric keys need the optional `cryptography` package. Their public halves are published as a
+JWKS so other services can verify access tokens themselves. Relative paths are resolved against the file.
+
+Without `JWT_KEYS_FILE` each ring has a single HS256 key read from `JWT_SECRET_KEY` and `JWT_REFRESH_SECRET_KEY`.
+"""
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+import jwt
+from jwt.algorithms import get_default_algorithms, has_crypto
+
+JWT_KEYS_FILE = os.getenv("JWT_KEYS_FILE")
+DEVELOPMENT_SECRET = "TEST"
+
+SYMMETRIC_ALGORITHMS = ("HS256", "HS384", "HS512")
+ASYMMETRIC_ALGORITHMS = ("EdDSA", "ES256")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SigningKey:
+    """A key of a ring; `signing_key` is None for keys that only verify tokens signed before a rotation."""
+    kid: str
+    algorithm: str
+    signing_key: Any
+    verification_key: Any
+
+    @property
+    def asymmetric(self) -> bool:
+        return self.algorithm in ASYMMETRIC_ALGORITHMS
+
+
+class KeyRing:
+    """The keys tokens of one kind are signed and verified with."""
+
+    def __init__(self, keys: List[SigningKey], active: str):
+        self.keys = {key.kid: key for key in keys}
+        if active not in self.keys or self.keys[active].signing_key is None:
+            raise ValueError(f"active key {active!r} is not a signing key of the ring")
+        self.active = self.keys[active]
+
+    def encode(self, payload: dict) -> str:
+        """
+        Sign a payload with the active key.
+
+        Parameters:
+            payload (dict): The claims.
+
+        Returns:
+            str: The encoded token, with the `kid` of the active key in its header.
+        """
+        return jwt.encode(payload, self.active.signing_key, self.active.algorithm, headers={"kid": self.active.kid})
+
+    def decode(self, token: str, verify_exp: bool = True) -> Optional[dict]:
+        """
+        Verify a token with the key its header names and return its claims.
+
+        Only the algorithm of that key is accepted, so a token cannot pick a weaker one. Tokens without a `kid`
+        are checked against the active key.
+
+        Parameters:
+            token (str): The encoded token.
+            verify_exp (bool): Reject expired tokens.
+
+        Returns:
+            Optional[dict]: The claims, or None if the token is malformed, signed by an unknown key or expired.
+        """
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+            key = self.active if kid is None else self.keys.get(kid)
+            if key is None:
+                return None
+            return jwt.decode(token, key.verification_key, algorithms=[key.algorithm],
+                              options={"verify_exp": verify_exp})
+        except jwt.InvalidTokenError:
+            return None
+
+    def jwks(self) -> dict:
+        """
+        Publish the public keys of the ring.
+
+        Returns:
+            dict: A JSON Web Key Set with every asymmetric key, symmetric secrets are never published.
+        """
+        algorithms = get_default_algorithms()
+        keys = []
+        for key in self.keys.values():
+            if key.asymmetric:
+                jwk = algorithms[key.algorithm].to_jwk(key.verification_key, as_dict=True)
+                keys.append({**jwk, "kid": key.kid, "alg": key.algorithm, "use": "sig"})
+        return {"keys": keys}
+
+
+def _read(path: str, base_dir: str) -> bytes:
+    with open(os.path.join(base_dir, path), "rb") as file:
+        return file.read()
+
+
+def load_key(spec: dict, base_dir: str = ".") -> SigningKey:
+    """
+    Load one key of a `JWT_KEYS_FILE` ring.
+
+    Parameters:
+        spec (dict): The key entry, see the module documentation.
+        base_dir (str): The directory relative key files are resolved against.
+
+    Returns:
+        SigningKey: The key.
+
+    Raises:
+        ValueError: If the entry names an unsupported algorithm or no key material.
+        RuntimeError: If an asymmetric key is configured but `cryptography` is not installed.
+    """
+    kid = spec["kid"]
+    algorithm = spec.get("alg", "HS256")
+    if algorithm in SYMMETRIC_ALGORITHMS:
+        if "secret" in spec:
+            secret = spec["secret"]
+        elif "secret_env" in spec:
+            secret = os.environ[spec["secret_env"]]
+        elif "secret_file" in spec:
+            secret = _read(spec["secret_file"], base_dir).decode().strip()
+        else:
+            raise ValueError(f"key {kid!r} has no secret")
+        return SigningKey(kid, algorithm, secret, secret)
+    if algorithm not in ASYMMETRIC_ALGORITHMS:
+        raise ValueError(f"key {kid!r} uses the unsupported algorithm {algorithm!r}")
+    if not has_crypto:
+        raise RuntimeError(f"{algorithm} key {kid!r} needs the cryptography package: pip install cryptography")
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
+
+    if "private_key_file" in spec:
+        private_key = load_pem_private_key(_read(spec["private_key_file"], base_dir), password=None)
+        return SigningKey(kid, algorithm, private_key, private_key.public_key())
+    if "public_key_file" in spec:
+        return SigningKey(kid, algorithm, None, load_pem_public_key(_read(spec["public_key_file"], base_dir)))
+    raise ValueError(f"key {kid!r} has neither a private nor a public key file")
+
+
+def load_key_ring(purpose: str, secret_env: str) -> KeyRing:
+    """
+    Load the ring for `purpose` ("access" or "refresh") from `JWT_KEYS_FILE`, or from `secret_env` without it.
+    """
+    if JWT_KEYS_FILE:
+        with open(JWT_KEYS_FILE) as file:
+            config = json.load(file)[purpose]
+        base_dir = os.path.dirname(os.path.abspath(JWT_KEYS_FILE))
+        return KeyRing([load_key(spec, base_dir) for spec in config["keys"]], config["active"])
+    secret = os.getenv(secret_env)
+    if not secret:
+        logger.warning("%s is not set, %s tokens are signed with the development secret", secret_env, purpose)
+        secret = DEVELOPMENT_SECRET
+    return KeyRing([SigningKey(purpose, "HS256", secret, secret)], purpose)
+
+
+access_keys = load_key_ring("access", "JWT_SECRET_KEY")
+refresh_keys = load_key_ring("refresh", "JWT_REFRESH_SECRET_KEY")
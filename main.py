@@ -1,31 +1,119 @@
-from datetime import date
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
 from typing import Optional
-from fastapi import FastAPI, Depends
-from fastapi.responses import JSONResponse
+import asyncpg
+import orjson
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response, WebSocket
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from utils import *
-from models import Base, User, Booking
+from models import User, Booking, BookingArchive, Resource, serialize_bookings
+from admission import AdmissionMiddleware, admission_control
+from allocator import RESOURCE_CONSTRAINT, lock_active_resource, resource_allocator
+from availability import find_availability
+from cache import bookings_version, cache, invalidate_bookings
+from feed import FEED_HEARTBEAT, booking_feed, publish
+from idempotency import IdempotencyMiddleware, idempotency_state
+from replicas import DATABASE_REPLICA_URLS, ReadYourWritesMiddleware, replica_router
+from database import (database_health, dispose_engine, get_engine, get_session, is_exclusion_violation, pool_status,
+                      session_scope, violated_constraint)
+from migrations import migrate
+from hashing import check_password, hash_executor, hash_password, prepare_dummy_hash
+from jobs import JOBS_IN_PROCESS, enqueue, enqueue_reminders, job_runner
+from instrumentation import InstrumentationMiddleware, ORJSONResponse, instrument_engine, render_metrics, timed
+from keys import access_keys
+from ratelimit import login_limiter
+from revocations import token_revocations
+from rollups import GRANULARITIES, occupancy, user_totals
+from schemas import BulkBookingCreate, BulkBookingDelete
+from transfer import export_bookings, import_bookings
 
-DATABASE_URL = 'postgresql://cyberuser:cyberpassword@db/cyberapi'
 reuseable_oauth = OAuth2PasswordBearer(
     tokenUrl="/login",
     scheme_name="JWT"
 )
+jwt_bearer = JWTBearer()
 
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
+BOOKINGS_PAGE_SIZE = 100
+BOOKINGS_MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+BULK_MAX_ITEMS = 500
+AVAILABILITY_MAX_SLOTS = 5000
+STATS_MAX_BUCKETS = 5000
+STATS_USERS_LIMIT = 100
+STATS_USERS_MAX_LIMIT = 1000
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "0") == "1"
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
 
+logger = logging.getLogger(__name__)
 
-def recreate_database():
-    # Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    engine = get_engine()
+    instrument_engine(engine)
+    if MIGRATE_ON_STARTUP:
+        await migrate(engine)
+    await token_revocations.sync()
+    await prepare_dummy_hash()
+    async with session_scope() as session:
+        await resource_allocator.load(session)
+    await booking_feed.start(engine.url.set(drivername="postgresql").render_as_string(hide_password=False))
+    await replica_router.start(DATABASE_REPLICA_URLS)
+    if JOBS_IN_PROCESS:
+        await job_runner.start()
+    yield
+    await job_runner.stop()
+    await booking_feed.stop()
+    await replica_router.stop()
+    await dispose_engine()
 
-recreate_database()
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+# Added first so it runs inside the instrumentation, replays are timed like any other response
+app.add_middleware(IdempotencyMiddleware)
+# Outside the idempotency keys, a replayed write pins its client to the primary like the original did
+app.add_middleware(ReadYourWritesMiddleware)
+# Sheds before anything touches the cache or the database, inside the instrumentation so shed requests are counted
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(InstrumentationMiddleware)
+
+
+async def load_user(username: str, session: Optional[AsyncSession] = None) -> Optional[dict]:
+    """
+    Look a user up by name through the cache.
+
+    Parameters:
+        username (str): The name of the user.
+        session (Optional[AsyncSession]): The session to query on a miss. Without one a read session is opened, on
+            a replica unless the user just wrote something.
+
+    Returns:
+        Optional[dict]: The id, username, created_at and updated_at of the user, or None if there is no such user.
+    """
+    user = await cache.get("user", username)
+    if user is not None:
+        return user
+    if session is None:
+        async with replica_router.read_session(username) as session:
+            row = await session.scalar(select(User).filter_by(username=username))
+    else:
+        row = await session.scalar(select(User).filter_by(username=username))
+    if row is None:
+        return None
+    user = {"id": row.id, "username": row.username,
+            "created_at": str(row.created_at), "updated_at": str(row.updated_at)}
+    await cache.set("user", username, user)
+    return user
 
 
 @app.get("/")
@@ -33,8 +121,45 @@ def root():
     return {"message": "API online"}
 
 
+@app.get("/livez", summary="Liveness probe")
+def livez():
+    return {"status": "ok"}
+
+
+@app.get("/readyz", summary="Readiness probe")
+async def readyz():
+    if not await database_health.healthy():
+        return ORJSONResponse(status_code=503, content={"status": "unavailable", "database": False})
+    return {"status": "ok", "database": True}
+
+
+@app.get("/metrics", summary="Runtime metrics in the Prometheus text format", response_class=PlainTextResponse)
+def metrics():
+    gauges = [(f"hashing_{name}", {}, value) for name, value in hash_executor.stats().items()]
+    gauges += [(f"db_pool_{name}", {}, value) for name, value in pool_status().items()]
+    gauges += [(f"login_rate_limit_{name}", {}, value) for name, value in login_limiter.stats().items()]
+    gauges += [(f"jobs_{name}", {}, value) for name, value in job_runner.stats().items()]
+    gauges += [(f"feed_{name}", {}, value) for name, value in booking_feed.stats().items()]
+    gauges += [(f"allocator_{name}", {}, value) for name, value in resource_allocator.stats().items()]
+    gauges += [(f"idempotency_{name}", {}, value) for name, value in idempotency_state.stats().items()]
+    gauges += [(f"replicas_{name}", {}, value) for name, value in replica_router.stats().items()]
+    for route_class, counters in admission_control.stats().items():
+        gauges += [(f"admission_{name}", {"route_class": route_class}, value) for name, value in counters.items()]
+    cache_stats = cache.stats()
+    gauges.append(("cache_errors", {"backend": cache_stats["backend"]}, cache_stats["errors"]))
+    for namespace, counters in cache_stats["namespaces"].items():
+        for name, value in counters.items():
+            gauges.append((f"cache_{name}", {"namespace": namespace}, value))
+    return PlainTextResponse(render_metrics(gauges), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/.well-known/jwks.json", summary="Public keys access tokens can be verified with")
+def jwks():
+    return access_keys.jwks()
+
+
 @app.post("/register", summary="Register a new user")
-async def create_user(name: str, password: str):
+async def create_user(name: str, password: str, session: AsyncSession = Depends(get_session)):
     """
     Create a new user and register them in the system.
 
@@ -43,23 +168,26 @@ async def create_user(name: str, password: str):
         password (str): The password of the user.
 
     Returns:
-        JSONResponse: A JSON response with a status code and a message indicating that the user has been successfully registered.
+        ORJSONResponse: A JSON response with a status code and a message indicating that the user has been successfully registered.
     """
-    session = Session()
-    existing_user = session.query(User).filter_by(username=name).first()
+    existing_user = await session.scalar(select(User).filter_by(username=name))
     if existing_user:
-        session.close()
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400, content={"status_code": 400, "message": "user already exists"}
         )
-    user = User(username=name, password=get_hashed_password(password), created_at=date.today(), updated_at=date.today())
+    user = User(username=name, password=await hash_password(password), created_at=date.today(), updated_at=date.today())
     session.add(user)
-    session.commit()
-    session.close()
+    try:
+        await session.commit()
+    except IntegrityError:
+        # Registered concurrently under the same name, the unique index on username rejected it
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "user already exists"}
+        )
 
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=200, content={"status_code": 200, "message": "user registered",
-                                  "user_id": session.query(User).filter_by(username=name).first().id}
+                                  "user_id": user.id}
     )
 
 
@@ -68,159 +196,171 @@ async def refresh_token(token: str):
     """
     Refresh JWT access token.
 
-    This function takes a JWT token as input and refreshes it. It first decodes the token using the `decodeJWT` function. If the token is invalid, it returns a `JSONResponse` with a status code of 400 and a message indicating that the token is invalid.
+    This function takes a JWT refresh token as input and refreshes it. It first decodes the token using the `decode_refresh_token` function. If the token is invalid, it returns a `ORJSONResponse` with a status code of 400 and a message indicating that the token is invalid.
 
-    Next, it checks if the token has expired by comparing the expiration time (`exp`) with the current time. If the token has expired, it returns a `JSONResponse` with a status code of 400 and a message indicating that the token has expired.
+    Next, it checks if the token has expired by comparing the expiration time (`exp`) with the current time. If the token has expired, it returns a `ORJSONResponse` with a status code of 400 and a message indicating that the token has expired.
 
-    If the token is valid and has not expired, it retrieves the user associated with the token from the database using the `username` stored in the token. If no user is found, it returns a `JSONResponse` with a status code of 400 and a message indicating that the user was not found.
+    If the token is valid and has not expired, it checks the in-memory revocations of the user the token was issued for, without a database query. If the user changed their name or password or was deleted since the token was issued, it returns a `ORJSONResponse` with a status code of 400 and a message indicating that the token was revoked.
 
-    Finally, if the token is valid, has not expired, and the user is found, it returns a `JSONResponse` with a status code of 200 and a message indicating that the token has been refreshed. It also includes the new access token and refresh token in the response.
+    Finally, if the token is valid, has not expired, and was not revoked, it returns a `ORJSONResponse` with a status code of 200 and a message indicating that the token has been refreshed. It also includes the new access token and refresh token in the response.
 
     Parameters:
     - `token` (str): The JWT token to be refreshed.
 
     Returns:
-    - `JSONResponse`: The response containing the status code, message, access token, and refresh token.
+    - `ORJSONResponse`: The response containing the status code, message, access token, and refresh token.
     """
-    token = decodeJWT(token)
+    token = decode_refresh_token(token)
     if not token:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400, content={"status_code": 400, "message": "Invalid token"}
         )
     if token['exp'] < time.time():
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400, content={"status_code": 400, "message": "Token expired"}
         )
-    session = Session()
-    user = session.query(User).filter_by(username=token['sub']['refresh_for']).first()
-    session.close()
-    if not user:
-        return JSONResponse(
-            status_code=400, content={"status_code": 400, "message": "User not found"}
+    await token_revocations.sync_if_stale()
+    if token_revocations.is_revoked(token['uid'], token['iat']):
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "Token revoked"}
         )
-    return JSONResponse(
+    username = token['sub']['refresh_for']
+    return ORJSONResponse(
         status_code=200, content={"status_code": 200, "message": "Token refreshed",
-                                  "access_token": create_access_token(user.username),
-                                  "refresh_token": create_refresh_token(user.username)}
+                                  "access_token": create_access_token(username),
+                                  "refresh_token": create_refresh_token(username, token['uid'])}
     )
 
 
 @app.post('/login', summary="Get JWT access token for the specified user")
-async def login_user(form_data: OAuth2PasswordRequestForm = Depends()):
+async def login_user(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
     """
     Get JWT access token for the specified user.
 
+    Attempts are rate limited per client IP and per username before the database or bcrypt are touched, and
+    wrong passwords back off exponentially. Unknown usernames take as long as wrong passwords.
+
     Args:
         form_data (OAuth2PasswordRequestForm, optional): The form data containing the username and password for login. Defaults to Depends().
 
     Returns:
-        JSONResponse: The response containing the access token and refresh token if the login is successful, or an error message if the login details are incorrect.
+        ORJSONResponse: The response containing the access token and refresh token if the login is successful, a 429 with Retry-After if there were too many attempts, or an error message if the login details are incorrect.
     """
-    session = Session()
-    user = session.query(User).filter_by(username=form_data.username).first()
-    if not user:
-        return JSONResponse(
-            status_code=400, content={"status_code": 400, "message": "Incorrect login details"}
+    client_ip = request.client.host if request.client else "unknown"
+    retry_after = await login_limiter.check(client_ip, form_data.username)
+    if retry_after is not None:
+        return ORJSONResponse(
+            status_code=429, content={"status_code": 429, "message": "Too many login attempts"},
+            headers={"Retry-After": str(retry_after)}
         )
-    hashed_passwd = user.password
-    if not verify_password(form_data.password, hashed_passwd):
-        return JSONResponse(
+    async with session_scope() as session:
+        user = await session.scalar(select(User).filter_by(username=form_data.username))
+    if not await check_password(form_data.password, user.password if user else None):
+        await login_limiter.failure(client_ip, form_data.username)
+        return ORJSONResponse(
             status_code=400, content={"status_code": 400, "message": "Incorrect login details"}
         )
-    return JSONResponse(
+    await login_limiter.success(client_ip, form_data.username)
+    return ORJSONResponse(
         status_code=200, content={"status_code": 200, "message": "Logged in",
                                   "access_token": create_access_token(user.username),
-                                  "refresh_token": create_refresh_token(user.username)}
+                                  "refresh_token": create_refresh_token(user.username, user.id)}
     )
 
 
-@app.get("/get_current_user", dependencies=[Depends(JWTBearer())], summary="Get current user data")
-async def get_current_user(request: Request):
+@app.get("/get_current_user", summary="Get current user data")
+async def get_current_user(principal: Principal = Depends(jwt_bearer)):
     """
     Get current user data.
 
     Args:
-        request (Request): The request object.
+        principal (Principal): The authenticated caller, resolved from the bearer token.
 
     Returns:
-        JSONResponse: The JSON response containing the current user data.
+        ORJSONResponse: The JSON response containing the current user data.
 
     Dependencies:
-        JWTBearer: The dependency function that validates the JWT token in the request header.
+        JWTBearer: The dependency that validates the JWT token in the request header and returns its principal.
 
     Summary:
         Get current user data.
     """
-    username = decodeJWT(request.headers.get("Authorization").split(' ')[1])['sub']
-    session = Session()
-    user = session.query(User).filter_by(username=username).first()
+    user = await load_user(principal.username)
     if not user:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400, content={"status_code": 400, "message": "user not found"}
         )
-    session.close()
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=200, content={"status_code": 200, "message": "user data",
-                                  "user": {"id": user.id,
-                                           "username": user.username,
-                                           "created_at": str(user.created_at),
-                                           "modified_at": str(user.updated_at)}}
+                                  "user": {"id": user["id"],
+                                           "username": user["username"],
+                                           "created_at": user["created_at"],
+                                           "modified_at": user["updated_at"]}}
     )
 
 
-@app.delete("/delete_user", dependencies=[Depends(JWTBearer())], summary="Delete user")
-async def delete_user(request: Request):
+@app.delete("/delete_user", summary="Delete user")
+async def delete_user(principal: Principal = Depends(jwt_bearer), session: AsyncSession = Depends(get_session)):
     """
     Delete user.
 
+    The user can no longer log in and their name is free right away; their bookings and the user itself are
+    purged by a background job.
+
     Parameters:
-        - request (Request): The HTTP request object.
+        - principal (Principal): The authenticated caller.
 
     Returns:
-        - JSONResponse: The HTTP response object.
+        - ORJSONResponse: The HTTP response object.
     """
-    session = Session()
-    user = session.query(User).filter_by(
-        username=decodeJWT(request.headers.get("Authorization").split(' ')[1])['sub']).first()
+    user = await session.scalar(select(User).filter_by(username=principal.username))
     if not user:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400, content={"status_code": 400, "message": "user not found"}
         )
-    session.delete(user)
-    session.query(Booking).filter_by(user_id=user.id).delete()
-    session.commit()
-    session.close()
-    return JSONResponse(
+    # The name is freed right away, the bookings and the user row are deleted in the background
+    user.username = None
+    user.deleted_at = datetime.now()
+    revoked_before = await token_revocations.revoke(session, user.id)
+    await enqueue(session, "purge_user", {"user_id": user.id}, key=f"purge_user:{user.id}")
+    await session.commit()
+    job_runner.wake()
+    token_revocations.remember(user.id, revoked_before)
+    await cache.delete("user", principal.username)
+    await invalidate_bookings(user.id)
+    return ORJSONResponse(
         status_code=200, content={"status_code": 200, "message": "user deleted"}
     )
 
 
-@app.post("/create_booking", dependencies=[Depends(JWTBearer())], summary="Create booking")
-async def create_booking(request: Request, start_time: str, end_time: str,
-                         comment: Optional[str] = None) -> JSONResponse:
+@app.post("/create_booking", summary="Create booking")
+async def create_booking(start_time: str, end_time: str, comment: Optional[str] = None,
+                         resource_id: Optional[int] = None,
+                         principal: Principal = Depends(jwt_bearer),
+                         session: AsyncSession = Depends(get_session)) -> ORJSONResponse:
     """
     Create a booking with the given start time, end time, and optional comment.
 
     Parameters:
-        - request (Request): The incoming request object.
+        - principal (Principal): The authenticated caller.
         - start_time (str): The start time of the booking in the format "%d-%m-%Y %H:%M:%S".
         - end_time (str): The end time of the booking in the format "%d-%m-%Y %H:%M:%S".
         - comment (Optional[str]): An optional comment for the booking.
+        - resource_id (Optional[int]): The station to book, see `/bookings/allocate` to get any free one.
 
     Returns:
-        - JSONResponse: The response containing the status code, message, booking ID, and user ID.
+        - ORJSONResponse: The response containing the status code, message, booking ID, and user ID.
           If the user is not found, the status code will be 400 and the message will be "user not found".
           If the time format is invalid, the status code will be 400 and the message will be "invalid time format".
+          If the resource does not exist or is deactivated, the status code will be 404.
+          If the booking overlaps another booking of the user or of the resource, the status code will be 409.
           If the booking is created successfully, the status code will be 200 and the message will be "booking created",
           along with the booking ID and user ID.
     """
-    session = Session()
-    user = session.query(User).filter_by(
-        username=decodeJWT(request.headers.get("Authorization").split(' ')[1])['sub']
-    ).first()
+    user = await load_user(principal.username, session)
 
     if not user:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"status_code": 400, "message": "user not found"}
         )
@@ -229,42 +369,56 @@ async def create_booking(request: Request, start_time: str, end_time: str,
         start_datetime = datetime.strptime(start_time, "%d-%m-%Y %H:%M:%S")
         end_datetime = datetime.strptime(end_time, "%d-%m-%Y %H:%M:%S")
     except ValueError:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"status_code": 400, "message": "invalid time format"}
         )
 
-    if start_datetime > end_datetime:
-        return JSONResponse(
+    if start_datetime >= end_datetime:
+        return ORJSONResponse(
             status_code=400,
             content={"status_code": 400, "message": "invalid time range"}
         )
 
-    booking = session.query(Booking).filter_by(
-        user_id=user.id,
-        start_time=start_datetime,
-        end_time=end_datetime,
-    ).first()
-
-    if booking:
-        return JSONResponse(
-            status_code=400,
-            content={"status_code": 400, "message": "booking already exists"}
+    # Held until the commit, a concurrent deactivation of the resource waits for the booking
+    if resource_id is not None and not await lock_active_resource(session, resource_id):
+        return ORJSONResponse(
+            status_code=404,
+            content={"status_code": 404, "message": "resource not found"}
         )
 
     new_booking = Booking(
-        user_id=user.id,
+        user_id=user["id"],
         start_time=start_datetime,
         end_time=end_datetime,
-        comment=comment
+        comment=comment,
+        resource_id=resource_id
     )
     session.add(new_booking)
-    session.commit()
-    session.refresh(new_booking)
-    booking_id = new_booking.id
-    session.close()
+    try:
+        # The exclusion constraints on (user_id, during) and (resource_id, during) are the overlap checks, so
+        # concurrent requests cannot race them
+        await session.flush()
+        await enqueue_reminders(session, [(new_booking.id, new_booking.start_time)])
+        await publish(session, user["id"], "created", [new_booking.to_json()])
+        await session.commit()
+    except IntegrityError as exc:
+        if not is_exclusion_violation(exc):
+            raise
+        if violated_constraint(exc) == RESOURCE_CONSTRAINT:
+            return ORJSONResponse(
+                status_code=409,
+                content={"status_code": 409, "message": "resource is already booked"}
+            )
+        return ORJSONResponse(
+            status_code=409,
+            content={"status_code": 409, "message": "booking overlaps an existing booking"}
+        )
+    if resource_id is not None:
+        resource_allocator.add(new_booking.id, resource_id, start_datetime, end_datetime)
+    await invalidate_bookings(user["id"])
 
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=200,
         content={
             "status_code": 200,
@@ -274,91 +428,763 @@ async def create_booking(request: Request, start_time: str, end_time: str,
     )
 
 
-@app.patch("/update_user", dependencies=[Depends(JWTBearer())], summary="Update user")
-async def update_user_information(request: Request, name: Optional[str] = None, password: Optional[str] = None):
+@app.patch("/update_user", summary="Update user")
+async def update_user_information(name: Optional[str] = None, password: Optional[str] = None,
+                                  principal: Principal = Depends(jwt_bearer),
+                                  session: AsyncSession = Depends(get_session)):
     """
     Update user information.
 
     Parameters:
-        - request (Request): The HTTP request object.
+        - principal (Principal): The authenticated caller.
         - name (Optional[str]): The new name of the user.
         - password (Optional[str]): The new password of the user.
 
     Returns:
-        - JSONResponse: The HTTP response object.
+        - ORJSONResponse: The HTTP response object.
     """
-    session = Session()
-    user = session.query(User).filter_by(
-        username=decodeJWT(request.headers.get("Authorization").split(' ')[1])['sub']).first()
+    user = await session.scalar(select(User).filter_by(username=principal.username))
     if not user:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=404, content={"status_code": 404, "message": "user not found"}
         )
     if name:
         user.username = name
     if password:
-        user.password = get_hashed_password(password)
+        user.password = await hash_password(password)
     user.updated_at = date.today()
     name = user.username
-    session.commit()
-    session.close()
-    return JSONResponse(
+    revoked_before = None
+    if name != principal.username or password:
+        # Refresh tokens issued for the old name or password must not outlive the change
+        revoked_before = await token_revocations.revoke(session, user.id)
+    try:
+        await session.commit()
+    except IntegrityError:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "user already exists"}
+        )
+    if revoked_before is not None:
+        token_revocations.remember(user.id, revoked_before)
+    await cache.delete("user", principal.username)
+    return ORJSONResponse(
         status_code=200, content={"status_code": 200, "message": "user updated",
                                   "access_token": create_access_token(name),
-                                  "refresh_token": create_refresh_token(name)}
+                                  "refresh_token": create_refresh_token(name, user.id)}
     )
 
 
-@app.delete("/remove_booking/{booking_id}", dependencies=[Depends(JWTBearer())], summary="Delete booking")
-async def remove_booking(request: Request, booking_id: int):
-    session = Session()
-    user = session.query(User).filter_by(
-        username=decodeJWT(request.headers.get("Authorization").split(' ')[1])['sub']).first()
+@app.delete("/remove_booking/{booking_id}", summary="Delete booking")
+async def remove_booking(booking_id: int, principal: Principal = Depends(jwt_bearer),
+                         session: AsyncSession = Depends(get_session)):
+    user = await load_user(principal.username, session)
     if not user:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=404, content={"status_code": 404, "message": "user not found"}
         )
-    booking = session.query(Booking).filter_by(
-        user_id=user.id,
+    booking = await session.scalar(select(Booking).filter_by(
+        user_id=user["id"],
         id=booking_id,
-    ).first()
+    ))
     if not booking:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=404, content={"status_code": 404, "message": "booking not found"}
         )
-    session.delete(booking)
-    session.commit()
-    session.close()
-    return JSONResponse(
+    await session.delete(booking)
+    await publish(session, user["id"], "deleted", [{"id": booking_id}])
+    await session.commit()
+    if booking.resource_id is not None:
+        resource_allocator.remove(booking.id, booking.resource_id, booking.start_time, booking.end_time)
+    await invalidate_bookings(user["id"])
+    return ORJSONResponse(
         status_code=200, content={"status_code": 200, "message": "booking deleted"}
     )
 
 
-@app.get("/get_bookings", dependencies=[Depends(JWTBearer())], summary="Get all bookings for the authenticated user")
-async def get_bookings(request: Request):
-    session = Session()
-    user = session.query(User).filter_by(
-        username=decodeJWT(request.headers.get("Authorization").split(' ')[1])['sub']).first()
+@app.post("/bookings/bulk", summary="Create bookings in bulk")
+async def create_bookings_bulk(batch: BulkBookingCreate, principal: Principal = Depends(jwt_bearer),
+                               session: AsyncSession = Depends(get_session)):
+    """
+    Create a batch of bookings, optionally repeated by a recurrence rule, in a single statement.
+
+    Every booking is validated on its own and the valid ones are inserted with one multi-row
+    `INSERT ... ON CONFLICT DO NOTHING RETURNING`, so the overlap check against existing bookings is done by
+    the exclusion constraint in the same round trip. Bookings that overlap each other within the batch keep
+    the earliest one.
+
+    Parameters:
+        - batch (BulkBookingCreate): The bookings to create and an optional recurrence applied to each of them.
+        - principal (Principal): The authenticated caller.
+
+    Returns:
+        - ORJSONResponse: The number of created bookings and a result per booking, in the order they were expanded.
+    """
+    user = await load_user(principal.username, session)
+    if not user:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "user not found"}
+        )
+
+    recurrence = batch.recurrence
+    until = None
+    if recurrence:
+        if recurrence.count is None and recurrence.until is None:
+            return ORJSONResponse(
+                status_code=400, content={"status_code": 400, "message": "recurrence needs count or until"}
+            )
+        if recurrence.until:
+            try:
+                until = datetime.strptime(recurrence.until, "%d-%m-%Y %H:%M:%S")
+            except ValueError:
+                return ORJSONResponse(
+                    status_code=400, content={"status_code": 400, "message": "invalid time format"}
+                )
+
+    results = []
+    pending = []
+    for item in batch.bookings:
+        try:
+            start_datetime = datetime.strptime(item.start_time, "%d-%m-%Y %H:%M:%S")
+            end_datetime = datetime.strptime(item.end_time, "%d-%m-%Y %H:%M:%S")
+        except ValueError:
+            results.append({"start_time": item.start_time, "end_time": item.end_time,
+                            "status_code": 400, "message": "invalid time format"})
+            continue
+        if start_datetime >= end_datetime:
+            results.append({"start_time": item.start_time, "end_time": item.end_time,
+                            "status_code": 400, "message": "invalid time range"})
+            continue
+        if recurrence:
+            occurrences = expand_recurrence(start_datetime, end_datetime, recurrence.freq, recurrence.interval,
+                                            recurrence.count, until, limit=BULK_MAX_ITEMS + 1)
+        else:
+            occurrences = [(start_datetime, end_datetime)]
+        for start, end in occurrences:
+            result = {"start_time": start.strftime("%d-%m-%Y %H:%M:%S"),
+                      "end_time": end.strftime("%d-%m-%Y %H:%M:%S")}
+            results.append(result)
+            pending.append((start, end, item.comment, result))
+
+    if len(results) > BULK_MAX_ITEMS:
+        return ORJSONResponse(
+            status_code=400,
+            content={"status_code": 400, "message": f"at most {BULK_MAX_ITEMS} bookings per batch"}
+        )
+
+    # Sweep over the batch sorted by start time, a booking starting before the latest end seen so far overlaps
+    rows = {}
+    latest_end = None
+    for start, end, comment, result in sorted(pending, key=lambda booking: booking[:2]):
+        if latest_end is not None and start < latest_end:
+            result.update(status_code=409, message="booking overlaps another booking in the batch")
+            continue
+        latest_end = end
+        rows[(start, end)] = (comment, result)
+
+    if rows:
+        inserted = await session.execute(
+            pg_insert(Booking)
+            .values([{"user_id": user["id"], "start_time": start, "end_time": end, "comment": comment}
+                     for (start, end), (comment, _) in rows.items()])
+            .on_conflict_do_nothing()
+            .returning(Booking.id, Booking.start_time, Booking.end_time)
+        )
+        created = []
+        for booking_id, start, end in inserted:
+            comment, result = rows.pop((start, end))
+            result.update(status_code=200, message="booking created", booking_id=booking_id)
+            created.append((booking_id, start, end, comment))
+        await enqueue_reminders(session, [(booking_id, start) for booking_id, start, _, _ in created])
+        await publish(session, user["id"], "created", serialize_bookings(
+            (booking_id, user["id"], start, end, comment, None) for booking_id, start, end, comment in created
+        ))
+        await session.commit()
+        await invalidate_bookings(user["id"])
+    for _, result in rows.values():
+        result.update(status_code=409, message="booking overlaps an existing booking")
+
+    return ORJSONResponse(
+        status_code=200, content={"status_code": 200, "message": "bookings processed",
+                                  "created": sum(result["status_code"] == 200 for result in results),
+                                  "results": results}
+    )
+
+
+@app.delete("/bookings/bulk", summary="Delete bookings in bulk")
+async def delete_bookings_bulk(batch: BulkBookingDelete, principal: Principal = Depends(jwt_bearer),
+                               session: AsyncSession = Depends(get_session)):
+    """
+    Delete a batch of bookings of the authenticated user in a single statement.
+
+    Parameters:
+        - batch (BulkBookingDelete): The IDs of the bookings to delete.
+        - principal (Principal): The authenticated caller.
+
+    Returns:
+        - ORJSONResponse: The number of deleted bookings and a result per requested ID.
+    """
+    user = await load_user(principal.username, session)
     if not user:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400, content={"status_code": 400, "message": "user not found"}
         )
-    bookings = session.query(Booking).filter_by(user_id=user.id).all()
-    session.close()
-    return JSONResponse(
-        status_code=200, content={"status_code": 200, "message": "bookings retrieved",
-                                  "bookings": [booking.to_json() for booking in bookings]}
+    if len(batch.booking_ids) > BULK_MAX_ITEMS:
+        return ORJSONResponse(
+            status_code=400,
+            content={"status_code": 400, "message": f"at most {BULK_MAX_ITEMS} bookings per batch"}
+        )
+
+    rows = (await session.execute(
+        delete(Booking)
+        .where(Booking.user_id == user["id"], Booking.id.in_(batch.booking_ids))
+        .returning(Booking.id, Booking.resource_id, Booking.start_time, Booking.end_time)
+        .execution_options(synchronize_session=False)
+    )).all()
+    deleted = {row.id for row in rows}
+    await publish(session, user["id"], "deleted", [{"id": booking_id} for booking_id in deleted])
+    await session.commit()
+    for booking_id, resource_id, start, end in rows:
+        if resource_id is not None:
+            resource_allocator.remove(booking_id, resource_id, start, end)
+    await invalidate_bookings(user["id"])
+    results = [{"booking_id": booking_id, "status_code": 200, "message": "booking deleted"}
+               if booking_id in deleted else
+               {"booking_id": booking_id, "status_code": 404, "message": "booking not found"}
+               for booking_id in batch.booking_ids]
+    return ORJSONResponse(
+        status_code=200, content={"status_code": 200, "message": "bookings processed",
+                                  "deleted": len(deleted), "results": results}
+    )
+
+
+def admin_bearer(principal: Principal = Depends(jwt_bearer)) -> Principal:
+    """Let only the users named in `ADMIN_USERNAMES` through."""
+    if principal.username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Admin access required.")
+    return principal
+
+
+@app.get("/resources", summary="List the bookable resources")
+async def list_resources(kind: Optional[str] = None, principal: Principal = Depends(jwt_bearer)):
+    """
+    List the active resources, e.g. the stations of the zone.
+
+    Parameters:
+        - kind (Optional[str]): Only resources of this kind.
+        - principal (Principal): The authenticated caller.
+
+    Returns:
+        - ORJSONResponse: The resources ordered by ID.
+    """
+    query = select(Resource).where(Resource.active.is_(True)).order_by(Resource.id)
+    if kind is not None:
+        query = query.where(Resource.kind == kind)
+    async with replica_router.read_session(principal.username) as session:
+        resources = [resource.to_json() for resource in await session.scalars(query)]
+    return ORJSONResponse(
+        status_code=200, content={"status_code": 200, "message": "resources retrieved", "resources": resources}
+    )
+
+
+@app.post("/resources", summary="Add a bookable resource")
+async def create_resource(name: str, kind: str = "pc", principal: Principal = Depends(admin_bearer),
+                          session: AsyncSession = Depends(get_session)):
+    """
+    Add a resource. Admins only.
+
+    Parameters:
+        - name (str): The unique name of the resource, e.g. "PC-12".
+        - kind (str): What the resource is, `/bookings/allocate` can ask for a kind.
+        - principal (Principal): The authenticated admin.
+
+    Returns:
+        - ORJSONResponse: The created resource, or 409 if the name is taken.
+    """
+    resource = Resource(name=name, kind=kind)
+    session.add(resource)
+    try:
+        await session.commit()
+    except IntegrityError:
+        return ORJSONResponse(
+            status_code=409, content={"status_code": 409, "message": "resource already exists"}
+        )
+    resource_allocator.resources[resource.id] = resource.kind
+    return ORJSONResponse(
+        status_code=200,
+        content={"status_code": 200, "message": "resource created", "resource": resource.to_json()}
+    )
+
+
+@app.delete("/resources/{resource_id}", summary="Deactivate a bookable resource")
+async def deactivate_resource(resource_id: int, principal: Principal = Depends(admin_bearer),
+                              session: AsyncSession = Depends(get_session)):
+    """
+    Stop offering a resource. Admins only. Its existing bookings are kept.
+
+    Parameters:
+        - resource_id (int): The resource.
+        - principal (Principal): The authenticated admin.
+
+    Returns:
+        - ORJSONResponse: The HTTP response object.
+    """
+    resource = await session.get(Resource, resource_id)
+    if resource is None or not resource.active:
+        return ORJSONResponse(
+            status_code=404, content={"status_code": 404, "message": "resource not found"}
+        )
+    resource.active = False
+    await session.commit()
+    resource_allocator.resources.pop(resource_id, None)
+    return ORJSONResponse(
+        status_code=200, content={"status_code": 200, "message": "resource deactivated"}
     )
 
 
+@app.post("/bookings/allocate", summary="Book any free resource")
+async def allocate_booking(start_time: str, end_time: str, comment: Optional[str] = None, kind: Optional[str] = None,
+                           principal: Principal = Depends(jwt_bearer),
+                           session: AsyncSession = Depends(get_session)):
+    """
+    Book the first resource free for the whole interval, e.g. any PC from 18:00 to 20:00.
+
+    The free resources are found in the occupancy bitmaps of `allocator.py` instead of a query per resource.
+
+    Parameters:
+        - start_time (str): The start time of the booking in the format "%d-%m-%Y %H:%M:%S".
+        - end_time (str): The end time of the booking in the format "%d-%m-%Y %H:%M:%S".
+        - comment (Optional[str]): An optional comment for the booking.
+        - kind (Optional[str]): Only resources of this kind.
+        - principal (Principal): The authenticated caller.
+
+    Returns:
+        - ORJSONResponse: The booking ID and the allocated resource ID, or 409 if no resource is free or the
+          booking overlaps another booking of the user.
+    """
+    user = await load_user(principal.username, session)
+    if not user:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "user not found"}
+        )
+    try:
+        start_datetime = datetime.strptime(start_time, "%d-%m-%Y %H:%M:%S")
+        end_datetime = datetime.strptime(end_time, "%d-%m-%Y %H:%M:%S")
+    except ValueError:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "invalid time format"}
+        )
+    if start_datetime >= end_datetime:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "invalid time range"}
+        )
+
+    new_booking = Booking(user_id=user["id"], start_time=start_datetime, end_time=end_datetime, comment=comment)
+    try:
+        allocated = await resource_allocator.allocate(session, new_booking, kind)
+    except IntegrityError as exc:
+        if not is_exclusion_violation(exc):
+            raise
+        return ORJSONResponse(
+            status_code=409, content={"status_code": 409, "message": "booking overlaps an existing booking"}
+        )
+    if not allocated:
+        return ORJSONResponse(
+            status_code=409, content={"status_code": 409, "message": "no free resource"}
+        )
+    await enqueue_reminders(session, [(new_booking.id, new_booking.start_time)])
+    await publish(session, user["id"], "created", [new_booking.to_json()])
+    await session.commit()
+    await invalidate_bookings(user["id"])
+    return ORJSONResponse(
+        status_code=200,
+        content={"status_code": 200, "message": "booking created", "booking_id": new_booking.id,
+                 "resource_id": new_booking.resource_id}
+    )
+
+
+@app.get("/bookings/export", summary="Export bookings in bulk")
+async def export_bookings_bulk(fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+                               compress: bool = Query(False, alias="gzip"),
+                               archived: bool = False,
+                               user_id: Optional[int] = None,
+                               from_time: Optional[str] = Query(None, alias="from"),
+                               to_time: Optional[str] = Query(None, alias="to"),
+                               principal: Principal = Depends(admin_bearer)):
+    """
+    Stream bookings of every user straight from `COPY`, e.g. for reporting. Admins only.
+
+    Parameters:
+        - fmt (str): "csv", with a header, or "ndjson".
+        - compress (bool): Gzip the output on the fly.
+        - archived (bool): Export the archive instead.
+        - user_id (Optional[int]): Only the bookings of this user.
+        - from_time (Optional[str]): Only bookings starting at or after this time, "%d-%m-%Y %H:%M:%S".
+        - to_time (Optional[str]): Only bookings starting before this time, "%d-%m-%Y %H:%M:%S".
+        - principal (Principal): The authenticated admin.
+
+    Returns:
+        - StreamingResponse: The bookings ordered by start time, as an attachment.
+    """
+    try:
+        start, end = (datetime.strptime(value, "%d-%m-%Y %H:%M:%S") if value else None
+                      for value in (from_time, to_time))
+    except ValueError:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "invalid time format"}
+        )
+    filename = f"bookings.{fmt}" + (".gz" if compress else "")
+    media_type = "application/gzip" if compress else ("text/csv" if fmt == "csv" else "application/x-ndjson")
+    return StreamingResponse(export_bookings(fmt, compress, archived, user_id, start, end), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@app.post("/bookings/import", summary="Import bookings in bulk")
+async def import_bookings_bulk(request: Request,
+                               fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+                               principal: Principal = Depends(admin_bearer)):
+    """
+    Merge the bookings in the request body into the existing ones, streamed with `COPY`. Admins only.
+
+    The body is in the format of `/bookings/export`, gzipped or not. Invalid rows, rows repeated in the body,
+    rows booked already and rows overlapping another booking of their user or resource are skipped and counted.
+
+    Parameters:
+        - request (Request): The request, whose body is streamed into the database.
+        - fmt (str): "csv" or "ndjson".
+        - principal (Principal): The authenticated admin.
+
+    Returns:
+        - ORJSONResponse: How many rows were read, skipped for every reason and inserted, or 400 if the body
+          cannot be parsed, nothing is imported then.
+    """
+    try:
+        async with session_scope() as session:
+            counts, user_ids = await import_bookings(await session.connection(), request.stream(), fmt)
+            await session.commit()
+    except (asyncpg.PostgresError, DBAPIError) as exc:
+        message = str(getattr(exc, "orig", exc)).splitlines()[0]
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": f"invalid input: {message}"}
+        )
+    for user_id in user_ids:
+        await invalidate_bookings(user_id)
+    if counts["inserted"]:
+        async with session_scope() as session:
+            await resource_allocator.load(session)
+    return ORJSONResponse(
+        status_code=200, content={"status_code": 200, "message": "bookings imported", **counts}
+    )
+
+
+@app.get("/get_bookings", summary="Get all bookings for the authenticated user")
+async def get_bookings(from_time: Optional[str] = Query(None, alias="from"),
+                       to_time: Optional[str] = Query(None, alias="to"),
+                       cursor: Optional[str] = None,
+                       limit: int = Query(BOOKINGS_PAGE_SIZE, ge=1, le=BOOKINGS_MAX_PAGE_SIZE),
+                       stream: bool = False,
+                       archived: bool = False,
+                       if_none_match: Optional[str] = Header(None),
+                       principal: Principal = Depends(jwt_bearer)):
+    """
+    Get the bookings of the authenticated user ordered by start time.
+
+    Pages are cached until the user changes their bookings. Every page carries an ETag, a poll sending it back in
+    `If-None-Match` gets a 304 without the database being queried while the bookings are unchanged.
+
+    Parameters:
+        - from_time (Optional[str]): Only bookings starting at or after this time, "%d-%m-%Y %H:%M:%S".
+        - to_time (Optional[str]): Only bookings starting before this time, "%d-%m-%Y %H:%M:%S".
+        - cursor (Optional[str]): The `next_cursor` of the previous page.
+        - limit (int): The maximum number of bookings in the page.
+        - stream (bool): Stream every matching booking as NDJSON instead of returning a single page.
+        - archived (bool): Get archived bookings instead, bounding the start time with `from` and `to` only reads
+          the archive partitions of those months.
+        - if_none_match (Optional[str]): The ETag of a page the client already has.
+        - principal (Principal): The authenticated caller.
+
+    Returns:
+        - ORJSONResponse: A page of bookings and the cursor of the next page, null on the last page.
+        - StreamingResponse: One booking per line when `stream` is set.
+        - Response: 304 if the page has not changed since the given ETag.
+    """
+    user = await load_user(principal.username)
+    if not user:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "user not found"}
+        )
+
+    table = BookingArchive if archived else Booking
+    query = (
+        select(table.id, table.user_id, table.start_time, table.end_time, table.comment, table.resource_id)
+        .where(table.user_id == user["id"])
+        .order_by(table.start_time, table.id)
+    )
+    try:
+        if from_time:
+            query = query.where(table.start_time >= datetime.strptime(from_time, "%d-%m-%Y %H:%M:%S"))
+        if to_time:
+            query = query.where(table.start_time < datetime.strptime(to_time, "%d-%m-%Y %H:%M:%S"))
+    except ValueError:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "invalid time format"}
+        )
+    if cursor:
+        position = decode_cursor(cursor)
+        if position is None:
+            return ORJSONResponse(
+                status_code=400, content={"status_code": 400, "message": "invalid cursor"}
+            )
+        query = query.where(tuple_(table.start_time, table.id) > tuple_(*position))
+
+    if stream:
+        return StreamingResponse(stream_bookings(query, principal.username), media_type="application/x-ndjson")
+
+    page_key = hashlib.sha1(f"{from_time}|{to_time}|{cursor}|{limit}|{archived}".encode()).hexdigest()[:16]
+    version = await bookings_version(user["id"])
+    etag = f'"{user["id"]}-{version}-{page_key}"'
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    page = await cache.get("bookings", f"{user['id']}:{version}:{page_key}")
+    if page is None:
+        async with replica_router.read_session(principal.username) as session:
+            rows = (await session.execute(query.limit(limit + 1))).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].start_time, rows[-1].id)
+        page = {"bookings": serialize_bookings(rows), "next_cursor": next_cursor}
+        await cache.set("bookings", f"{user['id']}:{version}:{page_key}", page)
+    return ORJSONResponse(
+        status_code=200, content={"status_code": 200, "message": "bookings retrieved", **page},
+        headers={"ETag": etag}
+    )
+
+
+async def stream_bookings(query, username: str):
+    # The request session may already be closed while the body is being sent, so the stream owns its own
+    async with replica_router.read_session(username) as session:
+        result = await session.stream(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+        async for rows in result.partitions():
+            with timed("serialization"):
+                chunk = b"".join(orjson.dumps(booking) + b"\n" for booking in serialize_bookings(rows))
+            yield chunk
+
+
+@app.get("/availability", summary="Get the free and busy intervals of the authenticated user")
+async def get_availability(from_time: str = Query(alias="from"), to_time: str = Query(alias="to"),
+                           slot: int = Query(30, ge=1, le=24 * 60),
+                           if_none_match: Optional[str] = Header(None),
+                           principal: Principal = Depends(jwt_bearer)):
+    """
+    Get the free and busy intervals of the authenticated user within a time window.
+
+    The window is divided into slots of `slot` minutes; a slot is busy if any booking overlaps it, and runs of
+    free or busy slots are merged into intervals. Results are cached and carry an ETag like `/get_bookings`.
+
+    Parameters:
+        - from_time (str): The start of the window, "%d-%m-%Y %H:%M:%S".
+        - to_time (str): The end of the window, "%d-%m-%Y %H:%M:%S".
+        - slot (int): The slot length in minutes.
+        - if_none_match (Optional[str]): The ETag of a response the client already has.
+        - principal (Principal): The authenticated caller.
+
+    Returns:
+        - ORJSONResponse: The free and busy intervals in chronological order.
+        - Response: 304 if the availability has not changed since the given ETag.
+    """
+    try:
+        window_start = datetime.strptime(from_time, "%d-%m-%Y %H:%M:%S")
+        window_end = datetime.strptime(to_time, "%d-%m-%Y %H:%M:%S")
+    except ValueError:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "invalid time format"}
+        )
+    step = timedelta(minutes=slot)
+    if window_start >= window_end:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "the window must end after it starts"}
+        )
+    if (window_end - window_start) / step > AVAILABILITY_MAX_SLOTS:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400,
+                                      "message": f"the window spans more than {AVAILABILITY_MAX_SLOTS} slots"}
+        )
+    user = await load_user(principal.username)
+    if not user:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "user not found"}
+        )
+
+    window_key = hashlib.sha1(f"{from_time}|{to_time}|{slot}".encode()).hexdigest()[:16]
+    version = await bookings_version(user["id"])
+    etag = f'"{user["id"]}-{version}-a{window_key}"'
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    intervals = await cache.get("availability", f"{user['id']}:{version}:{window_key}")
+    if intervals is None:
+        async with replica_router.read_session(principal.username) as session:
+            intervals = await find_availability(session, user["id"], window_start, window_end, step)
+        await cache.set("availability", f"{user['id']}:{version}:{window_key}", intervals)
+    return ORJSONResponse(
+        status_code=200, content={"status_code": 200, "message": "availability retrieved", **intervals},
+        headers={"ETag": etag}
+    )
+
+
+@app.get("/stats/occupancy", summary="Get bookings and booked time per hour, day or week")
+async def get_occupancy(from_time: str = Query(alias="from"), to_time: str = Query(alias="to"),
+                        granularity: str = Query("day", pattern="^(hour|day|week)$"),
+                        principal: Principal = Depends(admin_bearer)):
+    """
+    Get the utilization of the zone over a time window from the hourly rollups, without scanning bookings. Admins
+    only.
+
+    Parameters:
+        - from_time (str): The start of the window, "%d-%m-%Y %H:%M:%S", rounded down to the start of its bucket.
+        - to_time (str): The end of the window, "%d-%m-%Y %H:%M:%S".
+        - granularity (str): "hour", "day" or "week", weeks start on Monday.
+        - principal (Principal): The authenticated admin.
+
+    Returns:
+        - ORJSONResponse: Every bucket of the window with the bookings starting in it, the hours booked in it and
+          the booked share of the time of the active resources.
+    """
+    try:
+        window_start = datetime.strptime(from_time, "%d-%m-%Y %H:%M:%S")
+        window_end = datetime.strptime(to_time, "%d-%m-%Y %H:%M:%S")
+    except ValueError:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "invalid time format"}
+        )
+    if window_start >= window_end:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "the window must end after it starts"}
+        )
+    if (window_end - window_start).total_seconds() / GRANULARITIES[granularity] > STATS_MAX_BUCKETS:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400,
+                                      "message": f"the window spans more than {STATS_MAX_BUCKETS} buckets"}
+        )
+    async with replica_router.read_session() as session:
+        stats = await occupancy(session, window_start, window_end, granularity)
+    return ORJSONResponse(
+        status_code=200, content={"status_code": 200, "message": "occupancy retrieved", **stats}
+    )
+
+
+@app.get("/stats/users", summary="Get the users with the most booked time")
+async def get_user_stats(limit: int = Query(STATS_USERS_LIMIT, ge=1, le=STATS_USERS_MAX_LIMIT),
+                         user_id: Optional[int] = None,
+                         principal: Principal = Depends(admin_bearer)):
+    """
+    Get the bookings and booked hours of users in all, archived bookings included, from the user rollups. Admins
+    only.
+
+    Parameters:
+        - limit (int): How many users to return.
+        - user_id (Optional[int]): Only this user.
+        - principal (Principal): The authenticated admin.
+
+    Returns:
+        - ORJSONResponse: The users with their bookings and booked hours, most booked time first.
+    """
+    async with replica_router.read_session() as session:
+        users = await user_totals(session, limit, user_id)
+    return ORJSONResponse(
+        status_code=200, content={"status_code": 200, "message": "user stats retrieved", "users": users}
+    )
+
+
+@app.get("/bookings/events", summary="Stream booking changes of the authenticated user as Server-Sent Events")
+async def booking_events(request: Request):
+    """
+    Push the booking changes of the authenticated user instead of having the client poll `/get_bookings`.
+
+    Every event is named after the change, "created" or "deleted", with the changed bookings as its JSON data;
+    "resync" means changes were missed and the bookings have to be fetched again. The token may be passed as the
+    `access_token` query parameter, which is all an EventSource can send. The stream ends when the token
+    expires, the client reconnects with a fresh one.
+
+    Parameters:
+        - request (Request): The request, authenticated by `connection_principal`.
+
+    Returns:
+        - StreamingResponse: The `text/event-stream`, with a keepalive comment every `FEED_HEARTBEAT` seconds.
+    """
+    principal = connection_principal(request)
+    if principal is None:
+        raise HTTPException(status_code=403, detail="Invalid token or expired token.")
+    user = await load_user(principal.username)
+    if not user:
+        return ORJSONResponse(
+            status_code=400, content={"status_code": 400, "message": "user not found"}
+        )
+    return StreamingResponse(event_stream(user["id"], principal.exp), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def event_stream(user_id: int, expires_at: float):
+    # Subscribed by the stream itself, so the subscription is dropped with it however the response ends
+    subscription = booking_feed.subscribe(user_id)
+    try:
+        yield b"retry: 3000\n\n"
+        while time.time() < expires_at:
+            events = await subscription.next(min(FEED_HEARTBEAT, max(expires_at - time.time(), 0)))
+            if not events:
+                yield b": keepalive\n\n"
+                continue
+            yield "".join(f"event: {event}\ndata: {data}\n\n" for event, data in events).encode()
+    finally:
+        booking_feed.unsubscribe(subscription)
+
+
+@app.websocket("/bookings/ws")
+async def booking_socket(websocket: WebSocket):
+    """
+    The changes of `/bookings/events` over a WebSocket, one JSON message per change.
+
+    Authenticated like `/bookings/events`, a connection without a valid token is closed with 1008. The socket is
+    closed with 1000 when the token expires.
+    """
+    principal = connection_principal(websocket)
+    user = await load_user(principal.username) if principal else None
+    if not user:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    subscription = booking_feed.subscribe(user["id"])
+
+    async def send_events():
+        while time.time() < principal.exp:
+            for _, data in await subscription.next(min(FEED_HEARTBEAT, max(principal.exp - time.time(), 0))):
+                await websocket.send_text(data)
+
+    async def wait_closed():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    sender, receiver = asyncio.ensure_future(send_events()), asyncio.ensure_future(wait_closed())
+    try:
+        await asyncio.wait([sender, receiver], return_when=asyncio.FIRST_COMPLETED)
+        if sender.done() and sender.exception() is None:
+            await websocket.close(code=1000)
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        booking_feed.unsubscribe(subscription)
+
+
 @app.exception_handler(Exception)
 def exception_handler(request, exc):
+    logger.exception("unhandled error in %s %s", request.method, request.url.path, exc_info=exc)
     json_resp = get_default_error_response()
     return json_resp
 
 
 def get_default_error_response(status_code=500, message="Internal Server Error"):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status_code,
         content={"status_code": status_code, "message": message},
     )
@@ -0,0 +1,368 @@
+"""
+Versioned schema migrations.
+
+Every revision is a list of SQL statements applied in its own transaction and recorded in
+`schema_migrations`, so each one runs exactly once per database. Runs hold a Postgres advisory lock, so
+concurrent ones, e.g. of several containers starting at once, apply every revision once and in order. Bring a
+database up to date with:
+
+    python migrations.py
+"""
+import asyncio
+from typing import List
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+MIGRATION_LOCK = 727_001  # advisory lock key, arbitrary but fixed
+
+MIGRATIONS = [
+    (1, "initial schema", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR,
+            password VARCHAR,
+            created_at DATE,
+            updated_at DATE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bookings (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER,
+            start_time TIMESTAMP WITHOUT TIME ZONE,
+            end_time TIMESTAMP WITHOUT TIME ZONE,
+            comment VARCHAR
+        )
+        """,
+    ]),
+    (2, "username index, bookings foreign key and lookup index", [
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username)",
+        # Bookings of users deleted before the foreign key existed would make the constraint fail
+        "DELETE FROM bookings b WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.id = b.user_id)",
+        """
+        ALTER TABLE bookings ADD CONSTRAINT bookings_user_id_fkey
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_bookings_user_id_start_time_end_time
+            ON bookings (user_id, start_time, end_time)
+        """,
+    ]),
+    (3, "no overlapping bookings per user", [
+        """
+        ALTER TABLE bookings ADD COLUMN during TSRANGE
+            GENERATED ALWAYS AS (tsrange(start_time, end_time, '[)')) STORED
+        """,
+        # Fails if the table already holds overlapping bookings of one user, those have to be resolved by hand.
+        # The user_id equality goes through int4range so the plain range GiST opclass covers it without btree_gist.
+        """
+        ALTER TABLE bookings ADD CONSTRAINT bookings_no_overlap
+            EXCLUDE USING gist (int4range(user_id, user_id, '[]') WITH =, during WITH &&)
+        """,
+    ]),
+    (4, "refresh token revocations", [
+        # No foreign key: the revocation of a deleted user has to outlive the user
+        """
+        CREATE TABLE IF NOT EXISTS token_revocations (
+            user_id INTEGER PRIMARY KEY,
+            revoked_before DOUBLE PRECISION NOT NULL
+        )
+        """,
+    ]),
+    (5, "job queue, soft deleted users and bookings archive", [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            kind VARCHAR NOT NULL,
+            key VARCHAR UNIQUE,
+            payload JSONB NOT NULL DEFAULT '{}',
+            run_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            last_error VARCHAR,
+            failed_at TIMESTAMP WITHOUT TIME ZONE
+        )
+        """,
+        # Workers only ever look for due jobs that have not failed for good
+        "CREATE INDEX IF NOT EXISTS ix_jobs_run_at ON jobs (run_at) WHERE failed_at IS NULL",
+        "ALTER TABLE users ADD COLUMN deleted_at TIMESTAMP WITHOUT TIME ZONE",
+        "CREATE INDEX IF NOT EXISTS ix_bookings_end_time ON bookings (end_time)",
+        """
+        CREATE TABLE IF NOT EXISTS bookings_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            start_time TIMESTAMP WITHOUT TIME ZONE,
+            end_time TIMESTAMP WITHOUT TIME ZONE,
+            comment VARCHAR,
+            archived_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+        )
+        """,
+    ]),
+    (6, "monthly partitions of the bookings archive", [
+        "ALTER TABLE bookings_archive RENAME TO bookings_archive_unpartitioned",
+        "ALTER TABLE bookings_archive_unpartitioned RENAME CONSTRAINT bookings_archive_pkey "
+        "TO bookings_archive_unpartitioned_pkey",
+        # The partition key has to be part of the primary key
+        """
+        CREATE TABLE bookings_archive (
+            id INTEGER NOT NULL,
+            user_id INTEGER,
+            start_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            end_time TIMESTAMP WITHOUT TIME ZONE,
+            comment VARCHAR,
+            archived_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            PRIMARY KEY (id, start_time)
+        ) PARTITION BY RANGE (start_time)
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_bookings_archive_user_id_start_time ON bookings_archive (user_id, start_time)",
+        # Partitions are named <parent>_pYYYYMM. A month whose partition was detached is not recreated, rows for
+        # it fail to route instead of silently landing in a second table of the same month.
+        """
+        CREATE OR REPLACE FUNCTION create_monthly_partitions(parent regclass, from_time timestamp, to_time timestamp)
+        RETURNS integer LANGUAGE plpgsql AS $$
+        DECLARE
+            month timestamp := date_trunc('month', from_time);
+            name text;
+            created integer := 0;
+        BEGIN
+            -- Concurrent callers would race to create the same partition
+            PERFORM pg_advisory_xact_lock(727002, hashtext(parent::text));
+            WHILE month <= to_time LOOP
+                name := parent::text || '_p' || to_char(month, 'YYYYMM');
+                IF to_regclass(name) IS NULL THEN
+                    EXECUTE 'CREATE TABLE ' || quote_ident(name) || ' PARTITION OF ' || parent::text
+                        || ' FOR VALUES FROM (' || quote_literal(month) || ')'
+                        || ' TO (' || quote_literal(month + interval '1 month') || ')';
+                    created := created + 1;
+                END IF;
+                month := month + interval '1 month';
+            END LOOP;
+            RETURN created;
+        END
+        $$
+        """,
+        """
+        SELECT create_monthly_partitions('bookings_archive', min(start_time), max(start_time))
+        FROM bookings_archive_unpartitioned
+        """,
+        """
+        INSERT INTO bookings_archive (id, user_id, start_time, end_time, comment, archived_at)
+        SELECT id, user_id, start_time, end_time, comment, archived_at FROM bookings_archive_unpartitioned
+        """,
+        "DROP TABLE bookings_archive_unpartitioned",
+    ]),
+    (7, "bookable resources", [
+        """
+        CREATE TABLE IF NOT EXISTS resources (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR NOT NULL UNIQUE,
+            kind VARCHAR NOT NULL DEFAULT 'pc',
+            active BOOLEAN NOT NULL DEFAULT true,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+        )
+        """,
+        # Existing bookings hold no resource. A resource with bookings is deactivated rather than deleted.
+        "ALTER TABLE bookings ADD COLUMN resource_id INTEGER REFERENCES resources (id) ON DELETE RESTRICT",
+        # int4range(NULL, NULL) is unbounded and would overlap every other booking without a resource
+        """
+        ALTER TABLE bookings ADD CONSTRAINT bookings_resource_no_overlap
+            EXCLUDE USING gist (int4range(resource_id, resource_id, '[]') WITH =, during WITH &&)
+            WHERE (resource_id IS NOT NULL)
+        """,
+        "ALTER TABLE bookings_archive ADD COLUMN resource_id INTEGER",
+    ]),
+    (8, "idempotency keys", [
+        # A row without a status is a claim of a request still running, see `idempotency.py`
+        """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope VARCHAR NOT NULL,
+            key VARCHAR NOT NULL,
+            fingerprint BYTEA NOT NULL,
+            status INTEGER,
+            headers JSONB,
+            body BYTEA,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (scope, key)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at ON idempotency_keys (expires_at)",
+    ]),
+    (9, "booking rollups", [
+        # Bookings are counted in the hour they start in, their seconds in every hour they span
+        """
+        CREATE TABLE IF NOT EXISTS booking_stats_hourly (
+            hour TIMESTAMP WITHOUT TIME ZONE PRIMARY KEY,
+            bookings BIGINT NOT NULL DEFAULT 0,
+            booked_seconds BIGINT NOT NULL DEFAULT 0,
+            resource_seconds BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS booking_stats_users (
+            user_id INTEGER PRIMARY KEY,
+            bookings BIGINT NOT NULL DEFAULT 0,
+            booked_seconds BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_booking_stats_users_booked_seconds "
+        "ON booking_stats_users (booked_seconds, user_id)",
+        """
+        CREATE OR REPLACE FUNCTION booking_hours(start_time timestamp, end_time timestamp)
+        RETURNS TABLE (hour timestamp, seconds bigint) LANGUAGE sql IMMUTABLE AS $$
+            SELECT h, round(extract(epoch FROM least(end_time, h + interval '1 hour')
+                                               - greatest(start_time, h)))::bigint
+            FROM generate_series(date_trunc('hour', start_time), end_time - interval '1 microsecond',
+                                 interval '1 hour') h
+            WHERE start_time < end_time
+        $$
+        """,
+        # The changed rows are aggregated straight from the transition tables, however many a statement changed.
+        # Rollup rows are upserted in key order, so concurrent statements lock the ones they share in the same
+        # order and never deadlock. The archive job moves bookings with `bookings.archiving` set, they still count.
+        """
+        CREATE OR REPLACE FUNCTION bookings_rollup_trigger()
+        RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            changes text;
+        BEGIN
+            IF current_setting('bookings.archiving', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'INSERT' THEN
+                changes := 'SELECT 1 AS sign, user_id, start_time, end_time, resource_id FROM new_rows';
+            ELSIF TG_OP = 'DELETE' THEN
+                changes := 'SELECT -1 AS sign, user_id, start_time, end_time, resource_id FROM old_rows';
+            ELSE
+                changes := 'SELECT -1 AS sign, user_id, start_time, end_time, resource_id FROM old_rows '
+                    'UNION ALL SELECT 1, user_id, start_time, end_time, resource_id FROM new_rows';
+            END IF;
+            EXECUTE format($sql$
+                INSERT INTO booking_stats_hourly AS s (hour, bookings, booked_seconds, resource_seconds)
+                SELECT h.hour, sum(c.sign * (h.hour = date_trunc('hour', c.start_time))::int),
+                       sum(c.sign * h.seconds),
+                       coalesce(sum(c.sign * h.seconds) FILTER (WHERE c.resource_id IS NOT NULL), 0)
+                FROM (%s) c, LATERAL booking_hours(c.start_time, c.end_time) h
+                GROUP BY h.hour
+                HAVING sum(c.sign * (h.hour = date_trunc('hour', c.start_time))::int) <> 0
+                    OR sum(c.sign * h.seconds) <> 0
+                ORDER BY h.hour
+                ON CONFLICT (hour) DO UPDATE SET bookings = s.bookings + EXCLUDED.bookings,
+                    booked_seconds = s.booked_seconds + EXCLUDED.booked_seconds,
+                    resource_seconds = s.resource_seconds + EXCLUDED.resource_seconds
+            $sql$, changes);
+            EXECUTE format($sql$
+                INSERT INTO booking_stats_users AS s (user_id, bookings, booked_seconds)
+                SELECT c.user_id, sum(c.sign), sum(c.sign * round(extract(epoch FROM c.end_time - c.start_time)))
+                FROM (%s) c
+                WHERE c.user_id IS NOT NULL AND c.start_time < c.end_time
+                GROUP BY c.user_id
+                HAVING sum(c.sign) <> 0 OR sum(c.sign * round(extract(epoch FROM c.end_time - c.start_time))) <> 0
+                ORDER BY c.user_id
+                ON CONFLICT (user_id) DO UPDATE SET bookings = s.bookings + EXCLUDED.bookings,
+                    booked_seconds = s.booked_seconds + EXCLUDED.booked_seconds
+            $sql$, changes);
+            RETURN NULL;
+        END
+        $$
+        """,
+        """
+        CREATE TRIGGER bookings_rollup_insert AFTER INSERT ON bookings
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bookings_rollup_trigger()
+        """,
+        """
+        CREATE TRIGGER bookings_rollup_delete AFTER DELETE ON bookings
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION bookings_rollup_trigger()
+        """,
+        """
+        CREATE TRIGGER bookings_rollup_update AFTER UPDATE ON bookings
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION bookings_rollup_trigger()
+        """,
+        # Recomputes the rollups from `bookings` and `bookings_archive`, blocking booking changes meanwhile.
+        # Months detached from the archive are no longer counted afterwards.
+        """
+        CREATE OR REPLACE FUNCTION rebuild_booking_rollups()
+        RETURNS bigint LANGUAGE plpgsql AS $$
+        BEGIN
+            LOCK TABLE bookings IN SHARE MODE;
+            TRUNCATE booking_stats_hourly, booking_stats_users;
+            INSERT INTO booking_stats_hourly (hour, bookings, booked_seconds, resource_seconds)
+            SELECT h.hour, count(*) FILTER (WHERE h.hour = date_trunc('hour', b.start_time)), sum(h.seconds),
+                   coalesce(sum(h.seconds) FILTER (WHERE b.resource_id IS NOT NULL), 0)
+            FROM (
+                SELECT start_time, end_time, resource_id FROM bookings
+                UNION ALL
+                SELECT start_time, end_time, resource_id FROM bookings_archive
+            ) b, LATERAL booking_hours(b.start_time, b.end_time) h
+            GROUP BY h.hour;
+            INSERT INTO booking_stats_users (user_id, bookings, booked_seconds)
+            SELECT user_id, count(*), sum(round(extract(epoch FROM end_time - start_time))::bigint)
+            FROM (
+                SELECT user_id, start_time, end_time FROM bookings
+                UNION ALL
+                SELECT user_id, start_time, end_time FROM bookings_archive
+            ) b
+            WHERE user_id IS NOT NULL AND start_time < end_time
+            GROUP BY user_id;
+            RETURN (SELECT coalesce(sum(bookings), 0) FROM booking_stats_hourly);
+        END
+        $$
+        """,
+        "SELECT rebuild_booking_rollups()",
+    ]),
+]
+
+
+async def migrate(engine: AsyncEngine) -> List[int]:
+    """
+    Apply every migration that has not been applied to the database yet.
+
+    Parameters:
+        engine (AsyncEngine): The engine of the database to migrate.
+
+    Returns:
+        List[int]: The versions applied by this call.
+    """
+    async with engine.connect() as conn:
+        # A session level lock outlives the transactions below, whoever waited on it sees their result
+        await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK})
+        await conn.commit()
+        try:
+            async with conn.begin():
+                await conn.exec_driver_sql(
+                    "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                    "version INTEGER PRIMARY KEY, name VARCHAR, applied_at TIMESTAMP DEFAULT now())"
+                )
+                applied = set((await conn.exec_driver_sql("SELECT version FROM schema_migrations")).scalars())
+
+            done = []
+            for version, name, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                async with conn.begin():
+                    for statement in statements:
+                        await conn.exec_driver_sql(statement)
+                    await conn.execute(
+                        text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                        {"version": version, "name": name},
+                    )
+                done.append(version)
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK})
+            await conn.commit()
+    return done
+
+
+async def main():
+    from database import dispose_engine, get_engine
+
+    applied = await migrate(get_engine())
+    await dispose_engine()
+    print(f"applied migrations: {applied}" if applied else "database is up to date")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,211 @@
+"""
+Login rate limiting.
+
+Every login attempt takes a token from a bucket of the client IP and one of the username before the database or
+bcrypt are touched, and wrong passwords put the IP and username pair into an exponentially growing backoff.
+A rejected attempt costs a couple of dictionary lookups (or one Redis round trip) instead of a bcrypt verify.
+"""
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # "memory" or "redis"
+RATE_LIMIT_URL = os.getenv("RATE_LIMIT_URL", os.getenv("CACHE_URL", "redis://localhost:6379/0"))
+RATE_LIMIT_SIZE = int(os.getenv("RATE_LIMIT_SIZE", 100000))  # keys kept by the memory backend
+LOGIN_IP_RATE = float(os.getenv("LOGIN_IP_RATE", 30))  # attempts per minute
+LOGIN_IP_BURST = int(os.getenv("LOGIN_IP_BURST", 10))
+LOGIN_USER_RATE = float(os.getenv("LOGIN_USER_RATE", 10))  # attempts per minute
+LOGIN_USER_BURST = int(os.getenv("LOGIN_USER_BURST", 5))
+LOGIN_BACKOFF_AFTER = int(os.getenv("LOGIN_BACKOFF_AFTER", 3))  # failures before the backoff starts
+LOGIN_BACKOFF_BASE = float(os.getenv("LOGIN_BACKOFF_BASE", 1))  # seconds, doubled with every further failure
+LOGIN_BACKOFF_MAX = float(os.getenv("LOGIN_BACKOFF_MAX", 900))  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    """
+    Buckets, failure counters and blocks of this process.
+
+    At most `maxsize` keys are kept, least recently used first out, so spraying usernames cannot exhaust memory.
+    With several workers every worker enforces the limits on its own, use the Redis backend to share them.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def _get(self, key: str, default):
+        value = self._entries.get(key, default)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key: str, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        now = time.monotonic()
+        tokens, updated = self._get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            self._put(key, (tokens - 1, now))
+            return 0
+        self._put(key, (tokens, now))
+        return (1 - tokens) / rate
+
+    async def incr(self, key: str, ttl: float) -> int:
+        now = time.monotonic()
+        count, expires_at = self._get(key, (0, now))
+        count = count + 1 if expires_at > now else 1
+        self._put(key, (count, now + ttl))
+        return count
+
+    async def block(self, key: str, seconds: float):
+        self._put(key, time.monotonic() + seconds)
+
+    async def blocked(self, key: str) -> float:
+        return max(self._get(key, 0) - time.monotonic(), 0)
+
+    async def clear(self, *keys: str):
+        for key in keys:
+            self._entries.pop(key, None)
+
+
+class RedisBackend:
+    """
+    Limits shared by every worker, kept in Redis.
+
+    The bucket is refilled and taken from in a Lua script, so concurrent attempts of several workers cannot both
+    take the last token. Takes any client with the `redis.asyncio.Redis` interface.
+    """
+
+    TAKE = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1e6
+    local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = math.min(burst, (tonumber(state[1]) or burst) + (now - (tonumber(state[2]) or now)) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        return float(await self._client.eval(self.TAKE, 1, key, rate, burst))
+
+    async def incr(self, key: str, ttl: float) -> int:
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.incr(key)
+            pipe.expire(key, math.ceil(ttl))
+            count, _ = await pipe.execute()
+        return count
+
+    async def block(self, key: str, seconds: float):
+        await self._client.set(key, 1, px=max(int(seconds * 1000), 1))
+
+    async def blocked(self, key: str) -> float:
+        return max(await self._client.pttl(key), 0) / 1000
+
+    async def clear(self, *keys: str):
+        await self._client.delete(*keys)
+
+
+class LoginLimiter:
+    """
+    Token buckets per client IP and per username plus a progressive backoff per IP and username pair.
+
+    The backoff starts after `backoff_after` consecutive failures and doubles with every further one up to
+    `backoff_max`; a successful login, or `backoff_max` seconds without failures, forgets them. Keying the
+    backoff by the pair keeps an attacker from locking the owner of an account out, the username bucket still
+    caps guesses against one account from many addresses. Backend failures are logged and let the attempt
+    through, the limiter must not take logins down with it.
+    """
+
+    def __init__(self, backend, ip_rate: float, ip_burst: int, user_rate: float, user_burst: int,
+                 backoff_after: int, backoff_base: float, backoff_max: float):
+        self.backend = backend
+        self.ip_limit = (ip_rate / 60, ip_burst)
+        self.user_limit = (user_rate / 60, user_burst)
+        self.backoff_after = backoff_after
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rejected = 0
+        self.errors = 0
+
+    @staticmethod
+    def _keys(ip: str, username: str) -> Tuple[str, str]:
+        return f"login:failures:{ip}:{username}", f"login:backoff:{ip}:{username}"
+
+    async def check(self, ip: str, username: str) -> Optional[int]:
+        """
+        Admit a login attempt.
+
+        Parameters:
+            ip (str): The client address.
+            username (str): The username the attempt is for.
+
+        Returns:
+            Optional[int]: None if the attempt may proceed, otherwise the seconds to wait before retrying.
+        """
+        try:
+            wait = await self.backend.blocked(self._keys(ip, username)[1])
+            if not wait:
+                wait = max(await self.backend.take(f"login:ip:{ip}", *self.ip_limit),
+                           await self.backend.take(f"login:user:{username}", *self.user_limit))
+        except Exception:
+            logger.exception("rate limit check failed")
+            self.errors += 1
+            return None
+        if not wait:
+            return None
+        self.rejected += 1
+        return max(math.ceil(wait), 1)
+
+    async def failure(self, ip: str, username: str):
+        """Record a wrong password and start or extend the backoff of the pair."""
+        failures_key, backoff_key = self._keys(ip, username)
+        try:
+            failures = await self.backend.incr(failures_key, self.backoff_max)
+            if failures >= self.backoff_after:
+                delay = self.backoff_base * 2 ** min(failures - self.backoff_after, 32)
+                await self.backend.block(backoff_key, min(delay, self.backoff_max))
+        except Exception:
+            logger.exception("rate limit update failed")
+            self.errors += 1
+
+    async def success(self, ip: str, username: str):
+        """Forget the failures of the pair."""
+        try:
+            await self.backend.clear(*self._keys(ip, username))
+        except Exception:
+            logger.exception("rate limit update failed")
+            self.errors += 1
+
+    def stats(self) -> dict:
+        return {"rejected": self.rejected, "errors": self.errors}
+
+
+def create_login_limiter() -> LoginLimiter:
+    if RATE_LIMIT_BACKEND == "redis":
+        import redis.asyncio as redis
+
+        backend = RedisBackend(redis.from_url(RATE_LIMIT_URL))
+    else:
+        backend = MemoryBackend(RATE_LIMIT_SIZE)
+    return LoginLimiter(backend, LOGIN_IP_RATE, LOGIN_IP_BURST, LOGIN_USER_RATE, LOGIN_USER_BURST,
+                        LOGIN_BACKOFF_AFTER, LOGIN_BACKOFF_BASE, LOGIN_BACKOFF_MAX)
+
+
+login_limiter = create_login_limiter()
@@ -0,0 +1,185 @@
+"""
+Read-only endpoints served by streaming replicas, writes by the primary.
+
+Reads go round-robin to the replicas of `DATABASE_REPLICA_URLS` that passed their last health check, and to the
+primary when there are none, none is healthy or a connection to the chosen one fails. Without replicas
+configured everything keeps going to the primary.
+
+A replica may lag, so a client must not read from one right after changing something. Every mutating request
+pins its client to the primary for `READ_YOUR_WRITES_WINDOW` seconds, twice:
+
+- with a `primary_until` cookie, so the next reads of that client go to the primary whichever worker serves them;
+- with an entry of the user in the cache, for clients without cookies and the other devices of the user. The pin
+  is set before the write runs, so no read racing the write can cache replica rows under the bookings version
+  the write bumps.
+
+The window has to exceed the replication lag, which is normally well under a second.
+"""
+import logging
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+from starlette.datastructures import Headers
+from starlette.requests import cookie_parser
+
+from cache import cache
+from database import READINESS_TIMEOUT, HealthCheck, build_engine, session_scope
+from instrumentation import instrument_engine
+from utils import decode_principal
+
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", 5))  # seconds on the primary after a write
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 2))  # seconds between replica health checks
+PIN_COOKIE = "primary_until"
+
+logger = logging.getLogger(__name__)
+
+# Set for the requests of a client whose cookie pins it to the primary
+_cookie_pinned: ContextVar[bool] = ContextVar("cookie_pinned", default=False)
+
+
+class Replica:
+    def __init__(self, url: str, check_interval: float):
+        self.engine: AsyncEngine = build_engine(url)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.health = HealthCheck(check_interval, READINESS_TIMEOUT, self.engine)
+
+
+class ReplicaRouter:
+    """The replicas of this process and the choice between them and the primary for every read."""
+
+    def __init__(self, window: float, check_interval: float):
+        self.window = window
+        self.check_interval = check_interval
+        self.replicas: List[Replica] = []
+        self.primary_reads = 0
+        self.replica_reads = 0
+        self.fallbacks = 0
+        self._next = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    async def start(self, urls: List[str]):
+        """Create the replica engines and check them once, so reads use the healthy ones from the start."""
+        self.replicas = [Replica(url, self.check_interval) for url in urls]
+        for replica in self.replicas:
+            instrument_engine(replica.engine)
+            await replica.health.healthy()
+
+    async def stop(self):
+        replicas, self.replicas = self.replicas, []
+        for replica in replicas:
+            await replica.engine.dispose()
+
+    def pick(self) -> Optional[Replica]:
+        """The next healthy replica in turn, None if there is none. Never waits for a health check."""
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self._next % len(self.replicas)]
+            self._next += 1
+            if replica.health.last_known():
+                return replica
+        return None
+
+    async def pin(self, username: str):
+        await cache.set("primary_pin", username, True, ttl=math.ceil(self.window))
+
+    async def pinned(self, username: Optional[str]) -> bool:
+        if _cookie_pinned.get():
+            return True
+        return username is not None and await cache.get("primary_pin", username) is not None
+
+    @asynccontextmanager
+    async def read_session(self, username: Optional[str] = None) -> AsyncIterator[AsyncSession]:
+        """
+        Open a session for reads only, on a replica unless the caller is pinned to the primary.
+
+        Parameters:
+            username (Optional[str]): The caller, whose recent writes pin their reads to the primary.
+
+        Yields:
+            AsyncSession: The session.
+        """
+        replica = self.pick() if self.replicas and not await self.pinned(username) else None
+        session = None
+        if replica is not None:
+            session = replica.sessions()
+            try:
+                await session.connection()
+            except Exception as exc:
+                logger.warning("replica unavailable, reading from the primary: %r", exc)
+                replica.health.mark_failed()
+                await session.close()
+                self.fallbacks += 1
+                session = None
+        if session is None:
+            self.primary_reads += 1
+            async with session_scope() as session:
+                yield session
+            return
+        self.replica_reads += 1
+        try:
+            yield session
+        finally:
+            await session.close()
+
+    def stats(self) -> dict:
+        return {
+            "configured": len(self.replicas),
+            "healthy": sum(replica.health.last_known() for replica in self.replicas),
+            "primary_reads": self.primary_reads, "replica_reads": self.replica_reads, "fallbacks": self.fallbacks,
+        }
+
+
+replica_router = ReplicaRouter(READ_YOUR_WRITES_WINDOW, REPLICA_CHECK_INTERVAL)
+
+
+class ReadYourWritesMiddleware:
+    """
+    ASGI middleware pinning clients to the primary after they write, see the module docstring.
+
+    Requests other than GET and HEAD count as writes. Does nothing while no replicas are configured.
+    """
+
+    def __init__(self, app, router: ReplicaRouter = replica_router):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.router.enabled:
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        if scope["method"] in ("GET", "HEAD"):
+            try:
+                until = float(cookie_parser(headers.get("cookie", "")).get(PIN_COOKIE, 0))
+            except ValueError:
+                until = 0
+            # A forged cookie can only make its own client read from the primary, and not for long
+            now = time.time()
+            token = _cookie_pinned.set(now < until <= now + self.router.window)
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                _cookie_pinned.reset(token)
+            return
+
+        scheme, _, credentials = headers.get("authorization", "").partition(" ")
+        principal = decode_principal(credentials) if scheme == "Bearer" and credentials else None
+        if principal is not None:
+            await self.router.pin(principal.username)
+        cookie = (f"{PIN_COOKIE}={time.time() + self.router.window:.3f}; Max-Age={math.ceil(self.router.window)}; "
+                  "Path=/; HttpOnly; SameSite=Lax")
+
+        async def send_with_pin(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_pin)
@@ -0,0 +1,103 @@
+"""
+Refresh token revocation without a database round trip per refresh.
+
+A refresh token stays valid until it expires unless its user revoked every token issued up to some moment, by
+changing the name or the password or by deleting the account. Those moments are kept in memory per user, and
+only for as long as a refresh token lives, after that every token they could revoke has expired anyway: the set
+is as small as the number of recent revocations. Revocations are written to `token_revocations` in the
+transaction of the change that causes them, and every worker re-reads the table at most every
+`TOKEN_REVOCATION_SYNC` seconds, which bounds how long another worker may still accept a revoked token.
+"""
+import os
+import time
+from typing import Dict
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import async_session
+from models import TokenRevocation
+from utils import REFRESH_TOKEN_EXPIRE_MINUTES
+
+TOKEN_REVOCATION_SYNC = float(os.getenv("TOKEN_REVOCATION_SYNC", 10))  # seconds
+
+
+class TokenRevocations:
+    def __init__(self, lifetime: float, sync_interval: float):
+        self.lifetime = lifetime
+        self.sync_interval = sync_interval
+        self._revoked_before: Dict[int, float] = {}
+        self._synced_at = float("-inf")
+        self._syncing = False
+
+    def is_revoked(self, user_id: int, issued_at: float) -> bool:
+        """
+        Check a refresh token against the revocations of its user.
+
+        Parameters:
+            user_id (int): The `uid` claim of the token.
+            issued_at (float): The `iat` claim of the token.
+
+        Returns:
+            bool: True if the user revoked their tokens after this one was issued.
+        """
+        revoked_before = self._revoked_before.get(user_id)
+        return revoked_before is not None and issued_at <= revoked_before
+
+    async def revoke(self, session: AsyncSession, user_id: int) -> float:
+        """
+        Revoke every refresh token of a user issued until now, as part of the transaction of `session`.
+
+        Call `remember` with the result once the transaction is committed.
+
+        Parameters:
+            session (AsyncSession): The session of the change that revokes the tokens.
+            user_id (int): The user.
+
+        Returns:
+            float: The moment tokens are revoked up to.
+        """
+        revoked_before = time.time()
+        statement = pg_insert(TokenRevocation).values(user_id=user_id, revoked_before=revoked_before)
+        await session.execute(statement.on_conflict_do_update(
+            index_elements=[TokenRevocation.user_id], set_={"revoked_before": revoked_before}
+        ))
+        # Revocations older than a refresh token lifetime cannot revoke anything anymore
+        await session.execute(delete(TokenRevocation).where(
+            TokenRevocation.revoked_before < revoked_before - self.lifetime
+        ))
+        return revoked_before
+
+    def remember(self, user_id: int, revoked_before: float):
+        self._revoked_before[user_id] = max(revoked_before, self._revoked_before.get(user_id, revoked_before))
+
+    async def sync(self):
+        """Replace the revocations in memory with the ones recorded by every worker."""
+        self._syncing = True
+        started = time.time()
+        try:
+            async with async_session() as session:
+                rows = await session.execute(select(TokenRevocation.user_id, TokenRevocation.revoked_before).where(
+                    TokenRevocation.revoked_before >= started - self.lifetime
+                ))
+            revoked_before = dict(rows.all())
+            # Keep what this worker revoked while the query ran, the snapshot may predate the commit
+            for user_id, moment in self._revoked_before.items():
+                if moment >= started:
+                    revoked_before[user_id] = max(moment, revoked_before.get(user_id, moment))
+            self._revoked_before = revoked_before
+            self._synced_at = time.monotonic()
+        finally:
+            self._syncing = False
+
+    async def sync_if_stale(self):
+        """Sync if the last sync is older than `sync_interval` and no other request is already syncing."""
+        if not self._syncing and time.monotonic() - self._synced_at >= self.sync_interval:
+            await self.sync()
+
+    def __len__(self) -> int:
+        return len(self._revoked_before)
+
+
+token_revocations = TokenRevocations(REFRESH_TOKEN_EXPIRE_MINUTES * 60, TOKEN_REVOCATION_SYNC)
@@ -0,0 +1,134 @@
+"""
+Utilization statistics served from rollup tables instead of scans of `bookings`.
+
+`booking_stats_hourly` holds, for every hour, the bookings starting in it and the seconds booked in it, in all
+and on resources; `booking_stats_users` the bookings and booked seconds of every user. Statement level triggers
+on `bookings` keep both up to date in the transaction of every change: a statement inserting or deleting any
+number of bookings, be it `create_booking`, `remove_booking`, a bulk request or an import, updates each affected
+rollup row once. Days and weeks are summed from the hours, at most 168 rows a week whatever the number of bookings.
+
+Archived bookings keep counting, the archive job moves them without touching the rollups. The purge of a deleted
+user takes all of its bookings out of the rollups, live ones through the triggers and archived ones with the
+statement deleting them, see `jobs.purge_user`. Until a month is detached from the archive, the rollups thus
+equal what is recomputed from `bookings` and `bookings_archive`, which is done, e.g. after restoring `bookings`
+from a dump, with:
+
+    python rollups.py backfill
+"""
+import argparse
+import asyncio
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from models import format_datetime
+
+GRANULARITIES = {"hour": 3600, "day": 24 * 3600, "week": 7 * 24 * 3600}
+
+# Buckets without bookings are returned too, so series have no gaps
+OCCUPANCY_QUERY = text("""
+WITH totals AS (
+    SELECT date_trunc(:unit, hour) AS bucket, sum(bookings)::bigint AS bookings,
+           sum(booked_seconds)::bigint AS booked_seconds, sum(resource_seconds)::bigint AS resource_seconds
+    FROM booking_stats_hourly
+    WHERE hour >= date_trunc(:unit, CAST(:start AS timestamp)) AND hour < :end
+    GROUP BY 1
+)
+SELECT bucket, coalesce(bookings, 0) AS bookings, coalesce(booked_seconds, 0) AS booked_seconds,
+       coalesce(resource_seconds, 0) AS resource_seconds
+FROM generate_series(date_trunc(:unit, CAST(:start AS timestamp)), CAST(:end AS timestamp) - interval '1 microsecond',
+                     make_interval(secs => :step)) bucket
+LEFT JOIN totals USING (bucket)
+ORDER BY bucket
+""")
+ACTIVE_RESOURCES_QUERY = text("SELECT count(*) FROM resources WHERE active")
+# Scans the (booked_seconds, user_id) index backwards
+USERS_QUERY = """
+SELECT s.user_id, u.username, s.bookings, s.booked_seconds
+FROM booking_stats_users s JOIN users u ON u.id = s.user_id AND u.deleted_at IS NULL
+WHERE s.bookings > 0 {condition}
+ORDER BY s.booked_seconds DESC, s.user_id DESC
+LIMIT :limit
+"""
+
+
+def hours(seconds: int) -> float:
+    return round(seconds / 3600, 2)
+
+
+async def occupancy(session: AsyncSession, start: datetime, end: datetime, granularity: str) -> dict:
+    """
+    Bookings and booked time per hour, day or week of a window.
+
+    Parameters:
+        session (AsyncSession): The session to query with.
+        start (datetime): The start of the window, rounded down to the start of its hour, day or week (Monday).
+        end (datetime): The end of the window, the last bucket is cut short at it.
+        granularity (str): "hour", "day" or "week".
+
+    Returns:
+        dict: The number of active resources and the buckets in chronological order, each with its start, the
+            bookings starting in it, the hours booked in it in all and on resources, and the share of the time of
+            the active resources that was booked, null without resources.
+    """
+    step = GRANULARITIES[granularity]
+    rows = await session.execute(OCCUPANCY_QUERY, {"unit": granularity, "start": start, "end": end, "step": step})
+    resources = await session.scalar(ACTIVE_RESOURCES_QUERY)
+    buckets = [
+        {"start_time": format_datetime(bucket), "bookings": bookings, "booked_hours": hours(booked_seconds),
+         "resource_hours": hours(resource_seconds),
+         "occupancy": round(resource_seconds / (resources * step), 4) if resources else None}
+        for bucket, bookings, booked_seconds, resource_seconds in rows
+    ]
+    return {"resources": resources, "buckets": buckets}
+
+
+async def user_totals(session: AsyncSession, limit: int, user_id: Optional[int] = None) -> List[dict]:
+    """
+    The users with the most booked time, and how many bookings and hours they have in all, archived included.
+
+    Parameters:
+        session (AsyncSession): The session to query with.
+        limit (int): How many users to return.
+        user_id (Optional[int]): Only this user.
+
+    Returns:
+        List[dict]: The id, username, bookings and booked hours of every user, most booked time first.
+    """
+    condition = "AND s.user_id = :user_id" if user_id is not None else ""
+    rows = await session.execute(text(USERS_QUERY.format(condition=condition)), {"limit": limit, "user_id": user_id})
+    return [{"user_id": row_user_id, "username": username, "bookings": bookings, "booked_hours": hours(seconds)}
+            for row_user_id, username, bookings, seconds in rows]
+
+
+async def rebuild_rollups(engine: AsyncEngine) -> int:
+    """
+    Recompute the rollups from `bookings` and `bookings_archive` in one transaction.
+
+    Booking changes wait for it to finish, reads do not. Months detached from the archive are no longer counted
+    afterwards.
+
+    Returns:
+        int: The number of bookings counted.
+    """
+    async with engine.begin() as conn:
+        return await conn.scalar(text("SELECT rebuild_booking_rollups()"))
+
+
+async def main():
+    from database import dispose_engine, get_engine
+
+    parser = argparse.ArgumentParser(description="Maintain the booking rollups behind the /stats endpoints.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backfill", help="recompute the rollups from the bookings and the archive")
+    parser.parse_args()
+
+    counted = await rebuild_rollups(get_engine())
+    await dispose_engine()
+    print(f"rollups rebuilt from {counted} bookings")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
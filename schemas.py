@@ -0,0 +1,25 @@
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+
+class BookingItem(BaseModel):
+    start_time: str = Field(description='Start of the booking, "%d-%m-%Y %H:%M:%S"')
+    end_time: str = Field(description='End of the booking, "%d-%m-%Y %H:%M:%S"')
+    comment: Optional[str] = None
+
+
+class Recurrence(BaseModel):
+    freq: Literal["DAILY", "WEEKLY"]
+    interval: int = Field(1, ge=1, description="Repeat every `interval` days or weeks")
+    count: Optional[int] = Field(None, ge=1, description="Number of occurrences, including the first one")
+    until: Optional[str] = Field(None, description='No occurrence starts after this time, "%d-%m-%Y %H:%M:%S"')
+
+
+class BulkBookingCreate(BaseModel):
+    bookings: List[BookingItem]
+    recurrence: Optional[Recurrence] = Field(None, description="Repeat every booking of the batch")
+
+
+class BulkBookingDelete(BaseModel):
+    booking_ids: List[int]
@@ -0,0 +1,251 @@
+"""
+Bulk export and import of bookings with `COPY`.
+
+Exports stream `COPY (SELECT ...) TO STDOUT` as CSV or NDJSON, gzipped on the fly if asked, through a bounded
+queue: memory stays constant however many rows are exported and a slow client slows the copy down rather than
+piling rows up. They are served by a replica when there is one.
+
+Imports stream CSV or NDJSON, gzipped or not, with `COPY FROM STDIN` into a temporary staging table and merge it
+set-wise in the same transaction: rows that are invalid (no such user or resource, not ending after they start),
+repeated in the input or already booked with the same user, start and end are dropped, the rest is inserted and
+rows overlapping another booking of their user or resource are skipped by the exclusion constraints. Imported
+bookings get new IDs, an `id` column in the input is ignored, so an export can be imported into another
+database as is. Imports are for historical data, they schedule no reminders and notify no subscribers.
+
+    python transfer.py export --format ndjson --gzip --output bookings.ndjson.gz
+    python transfer.py import bookings.ndjson.gz
+"""
+import argparse
+import asyncio
+import sys
+import zlib
+from datetime import datetime
+from typing import AsyncIterable, AsyncIterator, Optional, Set, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from replicas import replica_router
+
+EXPORT_QUEUE_CHUNKS = 16  # COPY chunks buffered ahead of a slow reader
+EXPORT_COLUMNS = ("id", "user_id", "start_time", "end_time", "comment", "resource_id")
+FORMATS = ("csv", "ndjson")
+GZIP_MAGIC = b"\x1f\x8b"
+# CSV that never quotes: control characters JSON always escapes, so every line is copied verbatim
+VERBATIM = {"format": "csv", "delimiter": "\x02", "quote": "\x01"}
+
+STAGING = """
+CREATE TEMPORARY TABLE booking_import (
+    id BIGINT, user_id INTEGER, start_time TIMESTAMP, end_time TIMESTAMP, comment VARCHAR, resource_id INTEGER
+) ON COMMIT DROP
+"""
+STAGING_LINES = "CREATE TEMPORARY TABLE booking_import_lines (line TEXT) ON COMMIT DROP"
+STAGE_LINES = """
+INSERT INTO booking_import (user_id, start_time, end_time, comment, resource_id)
+SELECT (j ->> 'user_id')::integer, (j ->> 'start_time')::timestamp, (j ->> 'end_time')::timestamp, j ->> 'comment',
+       (j ->> 'resource_id')::integer
+FROM booking_import_lines, LATERAL (SELECT line::jsonb AS j) parsed
+WHERE line IS NOT NULL AND line <> ''
+"""
+# Each step removes the rows it rejects from the staging table and counts them
+DROP_INVALID = """
+DELETE FROM booking_import s
+WHERE s.user_id IS NULL OR s.start_time IS NULL OR s.end_time IS NULL OR s.start_time >= s.end_time
+   OR NOT EXISTS (SELECT 1 FROM users u WHERE u.id = s.user_id AND u.deleted_at IS NULL)
+   OR (s.resource_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM resources r WHERE r.id = s.resource_id))
+"""
+DROP_REPEATED = """
+DELETE FROM booking_import a USING booking_import b
+WHERE a.user_id = b.user_id AND a.start_time = b.start_time AND a.end_time = b.end_time AND a.ctid > b.ctid
+"""
+DROP_EXISTING = """
+DELETE FROM booking_import s USING bookings b
+WHERE b.user_id = s.user_id AND b.start_time = s.start_time AND b.end_time = s.end_time
+"""
+# Returns a row per user rather than per booking, an import may insert millions
+MERGE = """
+WITH merged AS (
+    INSERT INTO bookings (user_id, start_time, end_time, comment, resource_id)
+    SELECT user_id, start_time, end_time, comment, resource_id FROM booking_import ORDER BY user_id, start_time
+    ON CONFLICT DO NOTHING
+    RETURNING user_id
+)
+SELECT user_id, count(*) FROM merged GROUP BY user_id
+"""
+
+
+def export_query(fmt: str, archived: bool, user_id: Optional[int], start: Optional[datetime],
+                 end: Optional[datetime]) -> Tuple[str, list]:
+    """The SELECT of an export and its arguments, ordered like `/get_bookings`."""
+    table = "bookings_archive" if archived else "bookings"
+    conditions, args = [], []
+    for condition, value in (("user_id = ${}", user_id), ("start_time >= ${}", start), ("start_time < ${}", end)):
+        if value is not None:
+            args.append(value)
+            conditions.append(condition.format(len(args)))
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    if fmt == "ndjson":
+        pairs = ", ".join(f"'{column}', {column}" for column in EXPORT_COLUMNS)
+        columns = f"json_build_object({pairs})::text"
+    else:
+        columns = ", ".join(EXPORT_COLUMNS)
+    return f"SELECT {columns} FROM {table}{where} ORDER BY start_time, id", args
+
+
+async def export_bookings(fmt: str = "csv", compress: bool = False, archived: bool = False,
+                          user_id: Optional[int] = None, start: Optional[datetime] = None,
+                          end: Optional[datetime] = None) -> AsyncIterator[bytes]:
+    """
+    Stream bookings out of the database as they are copied.
+
+    Parameters:
+        fmt (str): "csv", with a header, or "ndjson".
+        compress (bool): Gzip the output.
+        archived (bool): Export `bookings_archive` instead of `bookings`.
+        user_id (Optional[int]): Only the bookings of this user.
+        start (Optional[datetime]): Only bookings starting at or after this time.
+        end (Optional[datetime]): Only bookings starting before this time.
+
+    Yields:
+        bytes: The next part of the output.
+    """
+    query, args = export_query(fmt, archived, user_id, start, end)
+    options = {"format": "csv", "header": True} if fmt == "csv" else VERBATIM
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    queue: asyncio.Queue = asyncio.Queue(EXPORT_QUEUE_CHUNKS)
+    async with replica_router.read_session() as session:
+        raw = await (await session.connection()).get_raw_connection()
+
+        async def copy():
+            try:
+                await raw.driver_connection.copy_from_query(query, *args, output=queue.put, **options)
+            finally:
+                await queue.put(None)
+
+        copying = asyncio.ensure_future(copy())
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                # asyncpg hands out views of its buffer
+                chunk = compressor.compress(chunk) if compressor is not None else bytes(chunk)
+                if chunk:
+                    yield chunk
+            # Raises if the copy failed, the output is incomplete then
+            await copying
+            if compressor is not None:
+                yield compressor.flush()
+        finally:
+            copying.cancel()
+            await asyncio.gather(copying, return_exceptions=True)
+
+
+async def decompressed(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """Pass chunks through, gunzipping them if the input starts like gzip."""
+    decompressor = None
+    async for chunk in chunks:
+        if decompressor is None:
+            if not chunk:
+                continue
+            decompressor = zlib.decompressobj(wbits=31) if chunk.startswith(GZIP_MAGIC) else False
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    if decompressor:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+
+async def import_bookings(conn: AsyncConnection, chunks: AsyncIterable[bytes],
+                          fmt: str = "csv") -> Tuple[dict, Set[int]]:
+    """
+    Merge streamed bookings into `bookings` in the transaction of `conn`.
+
+    Parameters:
+        conn (AsyncConnection): A connection to the primary in a transaction, the import is committed with it.
+        chunks (AsyncIterable[bytes]): The input, gzipped or not. CSV has a header and the columns of an export,
+            NDJSON objects need user_id, start_time and end_time and may have comment and resource_id.
+        fmt (str): "csv" or "ndjson".
+
+    Returns:
+        Tuple[dict, Set[int]]: How many rows were read, rejected at every step and inserted, and the users that
+            got bookings.
+
+    Raises:
+        asyncpg.PostgresError: If the input cannot be parsed, nothing is imported then.
+    """
+    raw = (await conn.get_raw_connection()).driver_connection
+    await conn.exec_driver_sql(STAGING)
+    if fmt == "ndjson":
+        await conn.exec_driver_sql(STAGING_LINES)
+        status = await raw.copy_to_table("booking_import_lines", source=decompressed(chunks), **VERBATIM)
+        await conn.exec_driver_sql(STAGE_LINES)
+    else:
+        status = await raw.copy_to_table("booking_import", source=decompressed(chunks), columns=list(EXPORT_COLUMNS),
+                                         format="csv", header=True)
+    # Temporary tables are never analyzed by autovacuum, the joins below need the statistics
+    await conn.exec_driver_sql("ANALYZE booking_import")
+    counts = {"rows": int(status.split()[-1])}
+    for name, statement in (("invalid", DROP_INVALID), ("repeated", DROP_REPEATED), ("existing", DROP_EXISTING)):
+        counts[name] = (await conn.exec_driver_sql(statement)).rowcount
+    merged = dict((await conn.exec_driver_sql(MERGE)).all())
+    counts["inserted"] = sum(merged.values())
+    counts["overlapping"] = (counts["rows"] - counts["invalid"] - counts["repeated"] - counts["existing"]
+                             - counts["inserted"])
+    return counts, set(merged)
+
+
+async def read_file(path: str, size: int = 1 << 20) -> AsyncIterator[bytes]:
+    with open(path, "rb") if path != "-" else sys.stdin.buffer as file:
+        while True:
+            chunk = await asyncio.get_running_loop().run_in_executor(None, file.read, size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def file_format(path: str) -> str:
+    name = path[:-3] if path.endswith(".gz") else path
+    return "ndjson" if name.endswith((".ndjson", ".jsonl")) else "csv"
+
+
+async def main():
+    from database import dispose_engine, get_engine
+
+    parser = argparse.ArgumentParser(description="Export or import bookings in bulk.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="stream bookings to a file or stdout")
+    export.add_argument("--format", choices=FORMATS, default="csv")
+    export.add_argument("--gzip", action="store_true")
+    export.add_argument("--archived", action="store_true", help="export the archive")
+    export.add_argument("--user-id", type=int)
+    export.add_argument("--from", dest="start", help='"%%d-%%m-%%Y %%H:%%M:%%S"')
+    export.add_argument("--to", dest="end", help='"%%d-%%m-%%Y %%H:%%M:%%S"')
+    export.add_argument("--output", default="-", help="the file to write, stdout by default")
+    load = commands.add_parser("import", help="merge bookings from a file or stdin")
+    load.add_argument("file", help="CSV or NDJSON, gzipped or not, - for stdin")
+    load.add_argument("--format", choices=FORMATS, help="by default from the file extension")
+    args = parser.parse_args()
+
+    engine = get_engine()
+    if args.command == "export":
+        start, end = (datetime.strptime(value, "%d-%m-%Y %H:%M:%S") if value else None
+                      for value in (args.start, args.end))
+        output = open(args.output, "wb") if args.output != "-" else sys.stdout.buffer
+        try:
+            async for chunk in export_bookings(args.format, args.gzip, args.archived, args.user_id, start, end):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+    else:
+        async with engine.begin() as conn:
+            counts, _ = await import_bookings(conn, read_file(args.file), args.format or file_format(args.file))
+        print(", ".join(f"{name}: {value}" for name, value in counts.items()))
+    await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,19 +1,26 @@
+import base64
+import hashlib
+import os
 import time
+from collections import OrderedDict
+from dataclasses import dataclass
 
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from typing import Union, Any
-import jwt
+from typing import List, Optional, Tuple, Union, Any
 from fastapi import Request, HTTPException
+from starlette.requests import HTTPConnection
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from instrumentation import timed
+from keys import access_keys, refresh_keys
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))  # cost factor, each step doubles the hashing time
+password_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 30  # 30 minutes
 REFRESH_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
-ALGORITHM = "HS256"
-JWT_SECRET_KEY = "TEST"  # should be kept secret
-JWT_REFRESH_SECRET_KEY = "TEST"  # should be kept secret
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
 
 
 def get_hashed_password(password: str) -> str:
@@ -37,24 +44,30 @@ def create_access_token(subject: Union[str, Any]) -> str:
     expires_delta = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
 
     to_encode = {"exp": expires_delta, "sub": str(subject)}
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, ALGORITHM)
+    with timed("jwt"):
+        encoded_jwt = access_keys.encode(to_encode)
     return encoded_jwt
 
 
-def create_refresh_token(subject: Union[str, Any]) -> str:
+def create_refresh_token(subject: Union[str, Any], user_id: int) -> str:
     """
     Generates a refresh token for the given subject.
 
+    The token carries the user ID and the issue time, which is all a refresh needs to check revocation.
+
     Args:
         subject (Union[str, Any]): The subject of the token.
+        user_id (int): The ID of the user.
 
     Returns:
         str: The encoded refresh token.
     """
     expires_delta = datetime.utcnow() + timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES)
 
-    to_encode = {"exp": expires_delta, "sub": {"refresh_for": str(subject)}}
-    encoded_jwt = jwt.encode(to_encode, JWT_REFRESH_SECRET_KEY, ALGORITHM)
+    to_encode = {"exp": expires_delta, "iat": time.time(), "typ": "refresh",
+                 "sub": {"refresh_for": str(subject)}, "uid": user_id}
+    with timed("jwt"):
+        encoded_jwt = refresh_keys.encode(to_encode)
     return encoded_jwt
 
 
@@ -68,11 +81,170 @@ def decodeJWT(token: str) -> dict:
     Returns:
         dict: The decoded payload as a dictionary, or an empty dictionary if decoding fails.
     """
+    return access_keys.decode(token) or {}
+
+
+def decode_refresh_token(token: str) -> Optional[dict]:
+    """
+    Decode a refresh token without rejecting it for being expired, so the caller can tell the two apart.
+
+    Parameters:
+        token (str): The encoded refresh token.
+
+    Returns:
+        Optional[dict]: The claims, or None if the token is not a validly signed refresh token.
+    """
+    with timed("jwt"):
+        payload = refresh_keys.decode(token, verify_exp=False)
+    if not payload or payload.get("typ") != "refresh" or "uid" not in payload or "iat" not in payload:
+        return None
+    return payload
+
+
+def expand_recurrence(start: datetime, end: datetime, freq: str, interval: int = 1, count: Optional[int] = None,
+                      until: Optional[datetime] = None, limit: int = 1000) -> List[Tuple[datetime, datetime]]:
+    """
+    Expand an RRULE-style recurrence of a booking into its occurrences.
+
+    Parameters:
+        start (datetime): The start of the first occurrence.
+        end (datetime): The end of the first occurrence.
+        freq (str): "DAILY" or "WEEKLY".
+        interval (int): Repeat every `interval` days or weeks.
+        count (Optional[int]): The number of occurrences.
+        until (Optional[datetime]): No occurrence starts after this time.
+        limit (int): Stop after this many occurrences even if neither `count` nor `until` is reached.
+
+    Returns:
+        List[Tuple[datetime, datetime]]: The start and end of every occurrence, the first one included.
+    """
+    step = timedelta(days=interval) if freq == "DAILY" else timedelta(weeks=interval)
+    occurrences = []
+    while len(occurrences) < limit and (count is None or len(occurrences) < count) \
+            and (until is None or start <= until):
+        occurrences.append((start, end))
+        start, end = start + step, end + step
+    return occurrences
+
+
+def encode_cursor(start_time: datetime, booking_id: int) -> str:
+    """
+    Encode the position of the last booking of a page into an opaque pagination cursor.
+
+    Parameters:
+        start_time (datetime): The start time of the last booking.
+        booking_id (int): The ID of the last booking.
+
+    Returns:
+        str: The URL-safe cursor.
+    """
+    raw = f"{start_time.isoformat()}|{booking_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple[datetime, int]]:
+    """
+    Decode a cursor produced by `encode_cursor`.
+
+    Parameters:
+        cursor (str): The cursor.
+
+    Returns:
+        Optional[Tuple[datetime, int]]: The start time and ID the next page starts after, or None if the cursor is malformed.
+    """
     try:
-        decoded_token = jwt.decode(token, JWT_SECRET_KEY, algorithms=[ALGORITHM])
-        return decoded_token if decoded_token["exp"] >= time.time() else None
-    except:
-        return {}
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        start_time, booking_id = raw.split("|")
+        return datetime.fromisoformat(start_time), int(booking_id)
+    except ValueError:
+        return None
+
+
+@dataclass(frozen=True)
+class Principal:
+    """The authenticated caller of a request, as carried by its access token."""
+    username: str
+    exp: float
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of already verified access tokens.
+
+    Entries are keyed by the SHA-256 of the token, so no token is kept in memory, and are dropped once the
+    token expires. A hit skips signature verification and claim parsing entirely.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[Principal]:
+        key = self._key(token)
+        principal = self._entries.get(key)
+        if principal is None:
+            return None
+        if principal.exp < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return principal
+
+    def put(self, token: str, principal: Principal):
+        key = self._key(token)
+        self._entries[key] = principal
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
+
+def decode_principal(token: str) -> Optional[Principal]:
+    """
+    Resolve an access token to its principal, verifying it only on a cache miss.
+
+    Parameters:
+        token (str): The encoded access token.
+
+    Returns:
+        Optional[Principal]: The principal, or None if the token is invalid, expired or not an access token.
+    """
+    principal = token_cache.get(token)
+    if principal is not None:
+        return principal
+    with timed("jwt"):
+        payload = decodeJWT(token)
+    if not payload or not isinstance(payload.get("sub"), str):
+        return None
+    principal = Principal(username=payload["sub"], exp=float(payload["exp"]))
+    token_cache.put(token, principal)
+    return principal
+
+
+def connection_principal(connection: HTTPConnection) -> Optional[Principal]:
+    """
+    Resolve the caller of a long-lived connection from the bearer token in its Authorization header or, for
+    browser EventSource and WebSocket clients that cannot set headers, its `access_token` query parameter.
+
+    Parameters:
+        connection (HTTPConnection): The request or WebSocket.
+
+    Returns:
+        Optional[Principal]: The principal, or None without a valid token.
+    """
+    scheme, _, token = connection.headers.get("Authorization", "").partition(" ")
+    if scheme != "Bearer":
+        token = connection.query_params.get("access_token", "")
+    return decode_principal(token) if token else None
 
 
 class JWTBearer(HTTPBearer):
@@ -82,12 +254,13 @@ class JWTBearer(HTTPBearer):
     async def __call__(self, request: Request):
         """
         Asynchronously processes a request by validating the JWT bearer token in the authorization header.
+        The resolved principal is also stored on `request.state.principal`.
 
         Args:
             request (Request): The incoming request object.
 
         Returns:
-            The JWT bearer token if it is valid and authorized.
+            Principal: The caller the token was issued for.
 
         Raises:
             HTTPException: If the authentication scheme is not "Bearer" or if the token is invalid or expired.
@@ -96,9 +269,11 @@ class JWTBearer(HTTPBearer):
         if credentials:
             if not credentials.scheme == "Bearer":
                 raise HTTPException(status_code=403, detail="Invalid authentication scheme.")
-            if not self.verify_jwt(credentials.credentials):
+            principal = decode_principal(credentials.credentials)
+            if principal is None:
                 raise HTTPException(status_code=403, detail="Invalid token or expired token.")
-            return credentials.credentials
+            request.state.principal = principal
+            return principal
         else:
             raise HTTPException(status_code=403, detail="Invalid authorization code.")
 
@@ -112,12 +287,4 @@ class JWTBearer(HTTPBearer):
         Returns:
             bool: True if the JWT token is valid, False otherwise.
         """
-        isTokenValid: bool = False
-
-        try:
-            payload = decodeJWT(jwtoken)
-        except:
-            payload = None
-        if payload:
-            isTokenValid = True
-        return isTokenValid
+        return decode_principal(jwtoken) is not None